@@ -9,8 +9,6 @@ from __future__ import print_function
 from __future__ import division
 
 import os
-import sys
-import time
 from datetime import datetime
 
 import numpy as np
@@ -18,7 +16,25 @@ import maple
 import maple.robotutil
 import maple.module
 
-import wpi_al1000
+import syringes
+import startup
+import calibration
+import run_config
+from workcell import (Workcell, grip_vial, release_vial, trace_robot, Gripper,
+    set_gripper)
+from scheduler import (SerialScheduler, PipelinedScheduler, DeckScheduler,
+    print_throughput, GRIP_CHANGING_PHASES)
+from deck import Deck
+from vial_map import (VialMap, VIAL_MAP_FILE, run_vials, print_out_vials,
+    print_vial_counts)
+from run_state import RunJournal
+from run_recorder import RunRecorder
+from mass_feedback import MassFeedbackDispenser
+import benchmark
+import tracing
+import path_planner
+import run_data
+import analysis
 
 
 try:
@@ -27,60 +43,27 @@ except NameError:
     pass
 
 
-def move_gripper_servo(robot, s_position):
-    """
-    Supposedly S5 is fully to the left and S10 is fully to the right...
-    So how is S0 "off"? Less than 5? More than 10? Interpretation of the #?
-
-    According to reprap docs: "`Snnn` Angle or microseconds"
-
-    Empirically:
-    S2.7 seems about fully open (2.5 strains a little)
-    S11.1 seems most closed, non-strained, position w/ (1/16"?) Viton pads
-    S11.25 will strain them a little
-
-    Requires different Smoothieware configuration than default MAPLE.
-    Use smoothie_config in this repository.
-    """
-    # TODO add trailing newline in sendSyncCmd/sendCmd automatically
-    cmd = 'M280 S{}\n'.format(s_position)
-    robot.smoothie.sendSyncCmd(cmd)
-
-
-def grip_vial(robot, pos=4.3):
-    # 4.3 might help keep the vial slightly straigher than 4.5?
-    # it is definitely a little looser
-    move_gripper_servo(robot, pos) #, 4.3) #4.5)
-    # TODO min delay that is appropriate?
-    robot.dwell_ms(1000)
-
-
-def release_vial(robot):
-    move_gripper_servo(robot, 2.65) # 2.7
-
-
 # TODO see choice module implementation of array subclass, to see whether i
 # changed the api
 class ScintillationVialBox(maple.module.Array):
     """
     """
     def __init__(self, robot, offset, vial_grip_height,
-        calibration_approach_from=None, verbose=False):
+        calibration_approach_from=None, verbose=False, start_letter='D',
+        end_letter='J', start_num=2, end_num=9):
         """
         #vial_grip_height: how high up from worksurface vial should be gripped,
         #    if vial were resting on worksurface
         vial_grip_height: defined w/ 0 as home point on Z2, and positive going
             down, now; for simplicity.
+        start_letter, end_letter, start_num, end_num: the region of the box
+            used (inclusive). offset is the corner of this region.
         """
         gripper_working_height = vial_grip_height
         # TODO calc offset from full bounds anyway prob, and just adjust based
         # on these bounds?
         # TODO TODO TODO go back to only using interior stuff. edge can be too
         # risky, since it's not always as tightly on the grid
-        start_letter = 'D'
-        end_letter = 'J'
-        start_num = 2
-        end_num = 9
 
         # TODO could switch them... (if making kwarg of init)
         assert start_letter <= end_letter
@@ -192,15 +175,223 @@ class ScintillationVialBox(maple.module.Array):
 
 
 if __name__ == '__main__':
-    weigh_aliquots = True
+    # Positions, serial ports, and the run settings below (and the defaults
+    # for the questions) are from aliquot_config.json, if it exists. See
+    # run_config.py. batch.py runs queues of jobs from the same settings.
+    config = run_config.load()
+    workcell_config = config['workcell']
+    run_settings = config['run']
+
+    weigh_aliquots = run_settings['weigh_aliquots']
+    # Requires a platform under the pump outlet (pump_platform_z) and
+    # ideally one other place to set a vial down (staging_xy / staging_z).
+    # See scheduler.PipelinedScheduler.
+    pipelined = run_settings['pipelined']
+    # Shortens the wait for drops to fall after each dispense, as far as the
+    # mass data (from this and previous runs) says is safe. drop_wait_s is
+    # still used as the conservative value. See calibration.AdaptiveDripWait.
+    adaptive_drip_wait = run_settings['adaptive_drip_wait']
+    # If False, the initial volume correction is used for every vial.
+    # Otherwise, it is updated from each vial's mass by a filter seeded from
+    # previous runs. See calibration.KalmanCorrection.
+    filter_correction = run_settings['filter_correction']
+    # Requires the scale to be moved under the pump outlet. Each vial is then
+    # filled on the scale, by mass, rather than carried between the two.
+    # See mass_feedback.MassFeedbackDispenser.
+    mass_feedback = run_settings['mass_feedback']
+    # Fills the vials marked failed in the vial map again (after they are
+    # emptied). See vial_map.py.
+    retry_failed = run_settings['retry_failed']
+    # Prints time spent in each phase of the cycle, and on each device, at the
+    # end, and saves it to benchmark_<start time>.json. See benchmark.py.
+    report_timing = run_settings['report_timing']
+    # Saves a timeline of every robot move, pump command and scale reading to
+    # trace_<start time>.json, for chrome://tracing or ui.perfetto.dev.
+    # See tracing.py.
+    trace = run_settings['trace']
+    # Takes vials in an order planned to cut travel, and approaches each slot
+    # from a fixed offset (rather than via approach_from), keeping the last
+    # move onto every slot the same. Prints the estimated time saved.
+    # See path_planner.py.
+    plan_path = run_settings['plan_path']
+    # Sends the robot commands for each step (e.g. getting a vial) as one
+    # G-code stream, rather than waiting for the robot to stop after each.
+    # See motion_batch.py.
+    batch_moves = run_settings['batch_moves']
+    # For the gripper open / closed positions in gripper_config.json (see
+    # workcell.Gripper). The defaults are for scintillation vials.
+    vial_type = run_settings['vial_type']
+    # Measures how long the gripper servo takes to move, with a vial on the
+    # scale, and saves it to gripper_config.json, so grips and releases only
+    # wait that long. Requires weigh_aliquots.
+    calibrate_gripper = run_settings['calibrate_gripper']
     print('Vialbox should be oriented so the side facing you reads A-J')
 
-    # TODO is this not the default config? just defer to whatever default
-    # settings there are, whether this file or something else?
-    robot = maple.robotutil.MAPLE(os.path.join(maple.__path__[0], 'MAPLE.cfg'),
+    # A run that did not finish (crash, power loss, Ctrl-C) is picked up where
+    # it left off, with the settings it was started with. See run_state.py.
+    # Only runs with scheduler.SerialScheduler are recorded.
+    journal = None
+    if not pipelined:
+        journal = RunJournal.interrupted()
+    settings = None
+    resume_vial = None
+    if journal is not None:
+        settings = journal.get('settings')
+        if settings.get('batch_job') is not None:
+            raise SystemExit('{} is from an interrupted batch.py run. Run the '
+                'same batch.py command again to resume it.'.format(
+                journal.path))
+        print('Found an interrupted run (started {}, last completed aliquot: '
+            '{}).'.format(settings['run_start_timestamp'],
+            journal.get('last_done')))
+        if input('Resume it (Y/n)? ').strip().lower().startswith('n'):
+            journal = None
+            settings = None
+        else:
+            resume_vial = journal.get('vial')
+    if (resume_vial is not None and
+        resume_vial['phase'] in GRIP_CHANGING_PHASES):
+        # Only the operator can tell whether it got as far as gripping or
+        # releasing the vial.
+        answer = input('Is the vial for aliquot #{} in the gripper '
+            '(y/n)? '.format(resume_vial['n']))
+        resume_vial['holding'] = answer.strip().lower().startswith('y')
+
+    # The liquid, for its density and for how fast it can be pumped without
+    # the syringe slipping. See syringes.py.
+    liquid = run_settings['liquid']
+    syringe_table = syringes.SyringeTable.load()
+
+    # The robot homes, and the pump and scale are connected and checked,
+    # while the questions below are answered. See startup.py.
+    tasks = startup.Startup()
+    robot_config = workcell_config['robot_config']
+    if robot_config is None:
+        robot_config = os.path.join(maple.__path__[0], 'MAPLE.cfg')
+    tasks.start('robot', maple.robotutil.MAPLE, robot_config,
         enable_z0=False, enable_z1=False, z2_has_crash_sensor=False)#, home=False)
-    # TODO TODO put these hardcoded offsets in some config? some override config
-    # where central config still does most stuff?
+    # What is left in the syringe, from previous runs. See syringes.py.
+    ledger = syringes.SyringeLedger()
+    tasks.start('pump', startup.connect_pump, workcell_config['pump_port'],
+        ledger=ledger)
+    if weigh_aliquots:
+        # TODO some scale command to automate this? setting to make it not
+        # sleep?
+        print('Tap the scale to wake it up, if it is not already.')
+        # Not with the interrupted vial possibly on it.
+        zero_scale = resume_vial is None or resume_vial['holding']
+        tasks.start('scale', startup.connect_scale,
+            workcell_config['scale_port'], zero=zero_scale)
+
+    if settings is None:
+        cc = run_settings['syringe_cc']
+        cc_str = tasks.input('Size of syringe in mL (default={})? '.format(cc))
+        if len(cc_str) != 0:
+            cc = int(cc_str)
+    else:
+        cc = settings['cc']
+
+    if settings is not None:
+        family = settings['family']
+    elif run_settings['syringe_family'] is not None:
+        family = run_settings['syringe_family']
+    elif cc == 60:
+        print('Assuming the 60mL syringe is a BD plastic syringe!')
+        family = 'B-D'
+    elif cc == 20:
+        print('Assuming the 20mL syringe is a Norm-Ject plastic syringe ' +
+            '(marked HSW)!')
+        family = 'NORM-JECT'
+    else:
+        family = tasks.input('Syringe family ({})? '.format(', '.join(
+            syringe_table.families(cc=cc)) or 'none in syringes.json'))
+
+    syringe = syringe_table.find(family=family, cc=cc)
+    ledger_ml = None
+    if ledger.syringe == [syringe.family, syringe.cc, liquid]:
+        ledger_ml = ledger.left_ml
+    capacity = None
+    if settings is None:
+        capacity = run_settings['syringe_ml']
+        capacity_str = tasks.input('What volume of pfo (mL) is in the ' +
+            'syringe (round DOWN) (default={})? '.format(
+            'syringe capacity' if ledger_ml is None else
+            '{:.2f}, from {}'.format(ledger_ml, ledger.path)))
+        if len(capacity_str) != 0:
+            capacity = float(capacity_str)
+
+    # The fastest this syringe should pump the liquid without slipping (rates
+    # as low as 2 have caused slipping with the 60mL BD syringe and pfo),
+    # rounded down to what the pump displays.
+    max_rate = int(syringe_table.safe_max_rate(syringe, liquid) * 100) / 100
+    rate = max_rate
+    if run_settings['rate'] is not None:
+        rate = run_settings['rate']
+        if rate > max_rate:
+            raise ValueError('rate in config must be at most {}'.format(
+                max_rate))
+    if settings is None:
+        rate_str = tasks.input('Pumping rate (mL/min) (default={}, max={})? '
+            .format(rate, max_rate))
+        if len(rate_str) != 0:
+            rate = float(rate_str)
+            if rate < 0 or rate > max_rate:
+                raise ValueError('rate must be between 0 and {}'.format(
+                    max_rate))
+    else:
+        rate = settings['rate']
+
+    # None to estimate from previous runs.
+    cv = run_settings['vol_correction_ml']
+    if settings is None:
+        target_vol_ml = run_settings['target_vol_ml']
+        vol_str = tasks.input('Target volume (mL) (default={:.2f})? '.format(
+            target_vol_ml))
+        # Just pressing Enter yields and empty string (at least in Python 2)
+        if len(vol_str) != 0:
+            # TODO also err if out of some range / too many sig figs?
+            target_vol_ml = float(vol_str)
+
+        cv_str = tasks.input('Initial volume correction (mL, added to ' +
+            'target volume) (default={})? '.format(
+            'estimated from previous runs' if cv is None else cv))
+        if len(cv_str) != 0:
+            cv = float(cv_str)
+
+        # TODO TODO maybe make the default the max given vol in syringe?
+        n_aliquots = run_settings['n_aliquots']
+        n_str = tasks.input('Number of aliquots (default={})? '.format(
+            n_aliquots))
+        if len(n_str) != 0:
+            n_aliquots = int(n_str)
+            if n_aliquots < 0:
+                raise ValueError('number of aliquots must be positive')
+    else:
+        target_vol_ml = settings['target_vol_ml']
+        n_aliquots = settings['n_aliquots']
+
+    start_n = run_settings['first_aliquot']
+    if settings is None and not os.path.exists(VIAL_MAP_FILE):
+        # For continuing runs from before there was a run_state.json (or a
+        # vial map, which otherwise says which vials are done).
+        start_n_str = tasks.input('Last completed aliquot # of previous ' +
+            'run (leave blank to start program program from beginning)? ')
+        if len(start_n_str) != 0:
+            # TODO maybe just get max from aliquot_masses.txt?
+            start_n = int(start_n_str) + 1
+
+    pump = tasks.result('pump')
+    # (assumed full if it is not the syringe the ledger has)
+    pump.set_syringe(family=family, cc=cc, liquid=liquid, table=syringe_table)
+    if capacity is not None:
+        pump.refilled(capacity)
+    pump.set_rate(rate, unit='MM')
+    # (served from the driver's cache, so this doesn't cost a round-trip)
+    remote_rate = pump.get_rate()
+    print('Using rate of {} mL/min'.format(remote_rate))
+    drop_wait_s = run_settings['drop_wait_s']
+
+    robot = tasks.result('robot')
     # TODO provide defaults in maple config even? or maybe have 0 at top if 
     # none provided? or have that as another mode?
 
@@ -210,7 +401,7 @@ if __name__ == '__main__':
     # TODO are the lhs and vial_grip_height really interacting as i want?
     # shouldn't changing vial_grip_height not affect where worksurface is
     # defined?
-    vial_grip_height = 59.5
+    vial_grip_height = workcell_config['vial_grip_height']
     # 60 is about as far down as i want the z axis to go
     # TODO try to only go to to 58 intead of 60 (vial_grip_height is subtracted
     # off when computing working height for gripper)? may need to change some
@@ -220,12 +411,22 @@ if __name__ == '__main__':
     # 61 doesn't work that well.
     #robot.z2_to_worksurface = 60 + vial_grip_height
     # currently just used for automatic return in module get_/put_
-    robot.z2_to_worksurface = 118
-
-    correction_x = -3
-    correction_y = 0
-    vialbox_offset = (754 + correction_x, -14.5 + correction_y)
-    vialbox = ScintillationVialBox(robot, vialbox_offset, vial_grip_height)
+    robot.z2_to_worksurface = workcell_config['z2_to_worksurface']
+
+    # All the vial boxes on the deck, used as one. See deck.py.
+    racks = run_config.racks(workcell_config, run_settings)
+    vialbox = Deck([(rack['name'], ScintillationVialBox(robot,
+        tuple(rack['offset']), vial_grip_height,
+        start_letter=rack['letters'][0], end_letter=rack['letters'][1],
+        start_num=rack['nums'][0], end_num=rack['nums'][1]))
+        for rack in racks])
+    # Which slots have vials, and which of those are done. See vial_map.py.
+    vial_map = VialMap(vialbox, racks)
+    max_aliquots = vialbox.n_slots
+    # Otherwise racks are swapped for ones of empty vials as they are done.
+    if n_aliquots > max_aliquots and not run_settings['swap_racks']:
+        raise ValueError('number of aliquots can not exceed # of reachable ' +
+            'vials ({})'.format(max_aliquots))
     # TODO delete
     '''
     wrong_ijs = [(n // vialbox.n_cols, n % vialbox.n_rows) for n in range(20)]
@@ -248,135 +449,60 @@ if __name__ == '__main__':
 
     # In hopes that after controlling backlash a little, the gripper can be
     # centered on each vial a little better, maybe making things reliable
-    # enough. Using a corner for the most consistent approach directions.
-    approach_from = vialbox.anchor_center(0, 0)
-
-    release_vial(robot)
-    robot.moveZ2(0)
-
-    syringepump_xy = (632, 179)
-    syringepump_z = 22
-    if weigh_aliquots:
-        pump_xy_approach = [
-            (syringepump_xy[0], 160)
-        ]
-    else:
-        pump_xy_approach = [
-            (660, 160),
-            (syringepump_xy[0], 160)
-        ]
-
-    # TODO should err if pump is off (right now, seems to still be able to open
-    # serial connection?)
-    pump = wpi_al1000.AL1000(port='/dev/ttyUSB0')
-
-    cc_str = input('Size of syringe in mL (default=60)? ')
-    cc = 60
-    if len(cc_str) != 0:
-        cc = int(cc_str)
-
-    if cc == 60:
-        print('Assuming the 60mL syringe is a BD plastic syringe!')
-        family = 'B-D'
-    elif cc == 20:
-        print('Assuming the 20mL syringe is a Norm-Ject plastic syringe ' +
-            '(marked HSW)!')
-        family = 'NORM-JECT'
-
-    capacity_str = input('What volume of pfo (mL) is in the syringe (round ' +
-        'DOWN) (default=syringe capacity)? ')
-    if len(capacity_str) != 0:
-        capacity = float(capacity_str)
-        pump.capacity = capacity
-
-    pump.set_syringe(family=family, cc=cc)
-    drop_wait_s = 20
-    def fill_vial(vol_ml):
-        """Moves vial under syringe pump output.
-        Assumes Z2 is at appropriate travel height already.
-        """
-        have_vol = pump.can_dispense(vol_ml)
-        if not have_vol:
-            input('Re-fill syringe and press Enter to continue...')
-            pump.clear_vol_disp()
-
-        for xy in pump_xy_approach:
-            robot.moveXY(xy)
-        # Only doing this after gripper is no longer over box,
-        # as a good height here might crash into box.
-        robot.moveZ2(syringepump_z)
-        robot.moveXY(syringepump_xy)
-        
-        pump.dispense(vol_ml)
-        print('Waiting {} seconds for drops to fall... '.format(drop_wait_s),
-            end='')
-        sys.stdout.flush()
-        time.sleep(drop_wait_s)
-        print('done')
-
-        robot.moveXY(pump_xy_approach[-1])
-        #zvial_travel = robot.z2_to_worksurface - 2 * vial_grip_height - 3
-        # (to simplify things for now)
-        zvial_travel = 0
-        robot.moveZ2(zvial_travel)
-        for xy in pump_xy_approach[:-1][::-1]:
-            robot.moveXY(xy)
-
+    # enough. Using a corner (of each rack) for the most consistent approach
+    # directions.
+    approach_from = vialbox.approach_from
+
+    gripper = Gripper.from_config(vial_type=vial_type)
+    if gripper.s_per_unit is None and not calibrate_gripper:
+        print('Gripper timing not calibrated. Waiting {}s after each '
+            'grip.'.format(gripper.uncalibrated_grip_s))
+    set_gripper(gripper)
+
+    # Otherwise the scheduler gets the robot clear, holding the vial or not.
+    if resume_vial is None:
+        release_vial(robot)
+        robot.moveZ2(0)
+
+    syringepump_xy = tuple(workcell_config['pump_xy'])
+    syringepump_z = workcell_config['pump_z']
+    pump_platform_z = workcell_config['pump_platform_z']
+    staging_xy = workcell_config['staging_xy']
+    if staging_xy is not None:
+        staging_xy = tuple(staging_xy)
+    staging_z = workcell_config['staging_z']
+    pump_xy_approach = run_config.pump_xy_approach(workcell_config,
+        weigh_aliquots)
+
+    scale = None
+    scale_xy = None
+    scale_z = None
     if weigh_aliquots:
-        from mettler_toledo_device import MettlerToledoDevice
-        scale = MettlerToledoDevice(port='/dev/ttyUSB2')
-
-        # TODO some scale command to automate this? setting to make it not
-        # sleep?
-        print('Tap the scale to wake it up, if it is not already.')
-        #
-        zeroed = False
-        # TODO this doesn't seem to work if we can't wake the scale...
-        print('Waiting for stable weight to zero... ', end='')
-        sys.stdout.flush()
-        while not zeroed:
-            zeroed = scale.zero_stable()
-        print('done')
-
-        scale_xy = (632, 2)
-        # 23 would stick sometimes
-        scale_z = 23
-
-        def weigh_vial():
-            """Returns vial weight in grams. Assumes start at safe Z height.
-            """
-            # just to be safe. could delete later.
-            robot.moveZ2(0)
-            #
-            robot.moveXY(scale_xy)
-            robot.moveZ2(scale_z - 0.5)
-
-            release_vial(robot)
-            robot.moveZ2(0)
-            time.sleep(1)
-        
-            ret = None
-            print('Waiting for stable weight... ', end='')
-            sys.stdout.flush()
-            while ret is None:
-                # 2-list w/ float value and str repr of unit (e.g. 'g')
-                # None if weight is not stable.
-                ret = scale.get_weight_stable()
-            print('done')
-
-            weight = ret[0]
-            assert ret[1] == 'g', \
-                'expected scale units in grams (got {})'.format(ret[1])
-
-            robot.moveZ2(scale_z)
-            grip_vial(robot)
-
-            #zvial_travel = robot.z2_to_worksurface - 2 * vial_grip_height - 3
-            # (to simplify things for now)
-            zvial_travel = 0
-            robot.moveZ2(zvial_travel)
-
-            return weight
+        scale = tasks.result('scale')
+
+        scale_xy = tuple(workcell_config['scale_xy'])
+        scale_z = workcell_config['scale_z']
+        if mass_feedback:
+            # TODO measure (scale_z too) once the scale is under the pump
+            scale_xy = syringepump_xy
+
+    tasks.print_durations()
+
+    workcell = Workcell(robot, vialbox, approach_from, pump=pump,
+        pump_xy=syringepump_xy, pump_z=syringepump_z,
+        pump_xy_approach=pump_xy_approach, pump_platform_z=pump_platform_z,
+        scale=scale, scale_xy=scale_xy, scale_z=scale_z,
+        staging_xy=staging_xy, staging_z=staging_z, drop_wait_s=drop_wait_s,
+        batch_moves=batch_moves, vial_map=vial_map)
+
+    if calibrate_gripper:
+        if scale is None:
+            raise ValueError('calibrate_gripper requires weigh_aliquots')
+        input('Put a vial on the scale and press Enter to calibrate the '
+            'gripper...')
+        workcell.calibrate_gripper(gripper)
+        gripper.save_config(vial_type=vial_type)
+        input('Take the vial off the scale and press Enter to continue...')
 
     # TODO delete
     # TODO prompt to integrate this as an optional check before starting
@@ -422,188 +548,193 @@ if __name__ == '__main__':
     robot.moveZ2(0)
     """
 
-    # TODO TODO allow user to answer questions while robot is homing
-
-    # rates as low as 2 have caused slipping in my use case
-    # (maybe also 1.5?)
-    max_rate = 1.5
-    rate = 1.2
-    rate_str = input('Pumping rate (mL/min) (default={}, max={})? '.format(
-        rate, max_rate))
-    if len(rate_str) != 0:
-        rate = float(rate_str)
-        if rate < 0 or rate > max_rate:
-            raise ValueError('rate must be between 0 and {}'.format(max_rate))
-
-    pump.set_rate(rate, unit='MM')
-    remote_rate = pump.get_rate()
-    print('Using rate of {} mL/min'.format(remote_rate))
-
-    vol_str = input('Target volume (mL) (default=2.00)? ')
-    # Just pressing Enter yields and empty string (at least in Python 2)
-    if len(vol_str) == 0:
-        target_vol_ml = 2.0
+    if settings is None:
+        run_start_timestamp = datetime.now()
     else:
-        # TODO also err if out of some range / too many sig figs?
-        target_vol_ml = float(vol_str)
-
-    cv = 0.02
-    # TODO option to always use const cv?
-    cv_str = input('Initial volume correction (mL, added to target volume) ' +
-        '(default={})? '.format(cv))
-    if len(cv_str) != 0:
-        cv = float(cv_str)
-    vol_ml = target_vol_ml + cv
-
-    max_aliquots = vialbox.n_cols * vialbox.n_rows
-    # TODO TODO maybe make the default the max given vol in syringe?
-    n_str = input('Number of aliquots (default=20)? ')
-    n_aliquots = 20
-    if len(n_str) != 0:
-        n_aliquots = int(n_str)
-        if n_aliquots < 0:
-            raise ValueError('number of aliquots must be positive')
-        elif n_aliquots > max_aliquots:
-            raise ValueError('number of aliquots can not exceed # of reachable '
-                + 'vials ({})'.format(max_aliquots))
-
-    empty_vial_weights = np.empty((vialbox.n_cols, vialbox.n_rows))
-    empty_vial_weights[:] = np.nan
-    pfo_weights = np.empty((vialbox.n_cols, vialbox.n_rows))
-    pfo_weights[:] = np.nan
+        # As a string, as written to the csv before.
+        run_start_timestamp = settings['run_start_timestamp']
 
     if weigh_aliquots:
+        # Data from before there was a database is imported from here.
+        # ./run_data.py --export writes a CSV with the same columns.
         csv_file = 'aliquot_masses.csv'
-        print('Will write aliquot weight data to {}'.format(csv_file))
-        run_start_timestamp = datetime.now()
-        # TODO use multiline str syntax
-        header = ('run_start_timestamp, n, col, row, empty_vial_g, pfo_g' +
-            ', target_vol, syringe_cc, syringe_family, rate, ' +
-            'vol_correction, drip_wait, start_syringe_vol, vol_from_mass, ' +
-            'num_this_run, time_taken\n')
-        line_fmt_str = ', '.join(['{}'] * len(header.split(','))) + '\n'
-
-        if not os.path.exists(csv_file):
-            # TODO maybe also replace header if differs / move existing
-            # file to some backup location in that case and then make a new one
-            # w/ current header
-            # TODO stop saving n?
-            with open(csv_file, 'w') as f:
-                f.write(header)
+        store = run_data.RunData(import_csv=csv_file)
+        print('Will write aliquot weight data to {}'.format(store.path))
 
     # TODO TODO calculate and print total time program will take
 
-    # TODO delete after getting to save state
-    start_n_str = input('Last completed aliquot # of previous run ' +
-        '(leave blank to start program program from beginning)? ')
-    start_n = 0
-    if len(start_n_str) != 0:
-        # TODO maybe just get max from aliquot_masses.txt?
-        start_n = int(start_n_str) + 1
-
-    # TODO need to account for cv? read from csv?
-    # (since pump get_vol_disp seems to reset across serial sessions)
-    pump.capacity = pump.capacity - (target_vol_ml * start_n)
-    # TODO delete
-    print('assuming syringe currently has vol of:', pump.capacity)
-    #
-
-    # TODO allow this to be configurable?
-    pfo_density_g_ml = 0.85
+    if settings is not None:
+        last_done = journal.get('last_done')
+        if resume_vial is not None:
+            start_n = resume_vial['n']
+        elif last_done is not None:
+            start_n = last_done + 1
+        else:
+            start_n = settings['start_n']
+    print('Syringe has {:.2f} mL'.format(pump.ledger.left_ml))
+
+    pfo_density_g_ml = syringe_table.liquid(liquid)['density_g_ml']
     target_mass = target_vol_ml * pfo_density_g_ml
     # TODO delete print
     print('target mass:', target_mass)
     #
 
+    history = []
+    if weigh_aliquots:
+        history = store.matching_rows(cc, family, remote_rate, target_vol_ml)
+
+    corrector = calibration.make_corrector(history, pfo_density_g_ml,
+        correction_ml=cv, filtered=weigh_aliquots and filter_correction)
+    if settings is not None:
+        vars(corrector).update(journal.get('corrector'))
+    print('Starting with volume correction of {:.3f} mL'.format(
+        corrector.correction()))
+
+    if mass_feedback:
+        if pipelined:
+            raise ValueError('mass_feedback is not supported with pipelined')
+        workcell.dispenser = MassFeedbackDispenser(pump, scale,
+            pfo_density_g_ml, target_mass, coarse_rate=remote_rate)
+
+    get_drip_wait = None
+    drip_waiter = None
+    # (filling on the scale has no drip wait)
+    if weigh_aliquots and adaptive_drip_wait and not mass_feedback:
+        initial_drip_wait_s = calibration.learn_drip_wait(history, drop_wait_s,
+            pfo_density_g_ml)
+        print('Starting with drip wait of {:.1f}s'.format(initial_drip_wait_s))
+        drip_waiter = calibration.AdaptiveDripWait(drop_wait_s, target_mass,
+            initial_s=initial_drip_wait_s)
+        get_drip_wait = drip_waiter.next_wait
+
     #
     # TODO TODO TODO also save enough extra info to csv to use it to calculate
     # appropriate calibrations (probably at least amt in syringe (maybe
     # adjusting as stuff is aliquoted w/in a run), **correction factor**, wait
     # times, rate[, possible to get whether scale is level from api?])
     num_this_run = 0
-    last_time = time.time()
-    for n in range(start_n, n_aliquots):
-        # TODO check this
-        curr_syringe_vol = pump.capacity - (num_this_run * start_n)
-
-        print('Aliquot #{}'.format(n))
-        i = n // vialbox.n_rows
-        j = n % vialbox.n_rows
-        col_letter, row_num = vialbox.coord_label(i, j)
-        print('{}{} (i={}, j={})'.format(col_letter, row_num, i, j))
-
-        # To keep backlash more consistent.
-        robot.moveXY(approach_from)
-        # Grips a vial and moves to working height.
-        vialbox.get_indices(i, j)
-
-        if weigh_aliquots:
-            empty_vial_g = weigh_vial()
-            print('empty vial weight:', empty_vial_g)
-            empty_vial_weights[i, j] = empty_vial_g
-
-        # TODO maybe make a platform for vial so the manipulator can do either
-        # things while (slow) pump is pumping?
-        fill_vial(vol_ml)
-
-        if weigh_aliquots:
-            full_vial_g = weigh_vial()
-            pfo_g = full_vial_g - empty_vial_g
-            print('pfo weight: {} g'.format(pfo_g))
-            pfo_weights[i, j] = pfo_g
-
-            # TODO set err thresh based on some relative deviation from expected
-            # mass, given density of pfo? (and like print the list of those that
-            # passed?)
-
-            # TODO maybe bound cv in case there is an erratic scale reading?
-            # TODO check this formula...
-            '''
-            #cv = target_vol_ml - vol_from_mass
-            cv = vol_ml - vol_from_mass
-            #vol_ml = target_vol_ml + (target_vol_ml - vol_from_mass)
-            #vol_ml = target_vol_ml + (vol_ml - vol_from_mass)
-            vol_ml = target_vol_ml + cv
-            '''
-            vol_from_mass = pfo_g / pfo_density_g_ml
-            mass_err = target_mass - pfo_g
-            cv = mass_err / pfo_density_g_ml
-            # TODO check this is what i want
-            # TODO TODO TODO i don't think this is exactly what i want
-            # (if commanded vol from previous aliquot produced no error,
-            # we should keep the same commanded vol, and thus cv, whether
-            # cv == 0 or not)
-            # (until resolved, should switch back to constant cv)
-            # TODO TODO TODO keep some kind of running average / filtered
-            # estimate of cv
-            vol_ml = target_vol_ml + cv
-            # TODO probably delete these prints
-            print('pfo vol from mass: {:.2f} mL'.format(vol_from_mass))
-            print('mass_err: {:.2f}'.format(mass_err))
-            print('using new vol correction of: {:.2f}'.format(cv))
-            print('new commanded volume: {:.2f}'.format(vol_ml))
-            #
-
-        # To keep backlash more consistent.
-        robot.moveXY(approach_from)
-        vialbox.put_indices(i, j)
-
-        curr_time = time.time()
-        time_taken = curr_time - last_time
-        last_time = curr_time
-
-        if weigh_aliquots:
-            with open(csv_file, 'a') as f:
-                f.write(line_fmt_str.format(run_start_timestamp,
-                    n, col_letter, row_num, empty_vial_g, pfo_g, target_vol_ml,
-                    cc, family, remote_rate, cv, drop_wait_s, curr_syringe_vol,
-                    vol_from_mass, num_this_run, time_taken))
-
-        num_this_run += 1
+    if settings is not None:
+        num_this_run = journal.get('num_this_run')
+
+    if settings is None:
+        if retry_failed:
+            vial_map.reset(vial_map.slots('failed'))
+        rack_ijs = None
+        if plan_path:
+            # Planned for every slot (the same way every time), so aliquot
+            # numbers from a previous run still refer to the same vials.
+            rack_ijs, path_estimate = path_planner.plan_deck(workcell,
+                vialbox.stream(vialbox.n_slots))
+            path_planner.print_estimate(path_estimate)
+
+        # Filled before there was a vial map. As before, the run ends at
+        # aliquot #n_aliquots - 1.
+        vial_map.reset(vialbox.stream(start_n, rack_ijs=rack_ijs), 'skipped',
+            from_states=('present',))
+        n_vials = n_aliquots - start_n
+        print_vial_counts(vial_map)
+        print_out_vials(vial_map)
+
+        # The present slots, a rack at a time, going round them again if they
+        # are swapped.
+        ijs, ns = run_vials(vial_map, n_vials, rack_ijs=rack_ijs,
+            swap_racks=run_settings['swap_racks'])
+        if len(ns) < n_vials:
+            raise ValueError('only {} slots have empty vials (present) in '
+                'the vial map. See ./vial_map.py'.format(len(ns)))
+    else:
+        ijs = [tuple(ij) for ij in settings['ijs']]
+        plan_path = settings['plan_path']
+        # (from before there was a vial map, if not there)
+        ns = settings.get('ns', range(settings['start_n'], n_aliquots))
+    if plan_path:
+        workcell.approach_offset = path_planner.APPROACH_OFFSET
+    vials = [(n,) + tuple(ijs[n]) for n in ns if n >= start_n]
+
+    # So a run that a full syringe would do isn't stopped partway through
+    # for a refill.
+    vial_ml = target_vol_ml + max(corrector.correction(), 0)
+    need_ml = len(vials) * vial_ml
+    left_ml = pump.ledger.left_ml
+    if need_ml >= left_ml:
+        print('This run needs about {:.1f} mL, but the syringe has {:.1f} mL '
+            '(about {} vials).'.format(need_ml, left_ml,
+            int(left_ml // vial_ml)))
+        if (need_ml < pump.capacity and input('Refill it before starting '
+            '(y/N)? ').strip().lower().startswith('y')):
+            input('Re-fill syringe and press Enter to continue...')
+            pump.invalidate()
+            pump.refilled()
+
+    if pipelined:
+        scheduler = PipelinedScheduler(workcell)
+    else:
+        if journal is None:
+            journal = RunJournal()
+            journal.update(settings={
+                'run_start_timestamp': str(run_start_timestamp),
+                'cc': cc,
+                'family': family,
+                'rate': rate,
+                'target_vol_ml': target_vol_ml,
+                'n_aliquots': n_aliquots,
+                'start_n': start_n,
+                'plan_path': plan_path,
+                'ijs': ijs,
+                'ns': ns
+            }, last_done=None, vial=None, corrector=vars(corrector),
+                num_this_run=num_this_run)
+        scheduler = SerialScheduler(workcell, journal=journal)
+    # Has each rack swapped once done, if the run comes back to it.
+    scheduler = DeckScheduler(scheduler, vialbox, ijs, vial_map=vial_map)
+
+    recorder = RunRecorder(vialbox, corrector, target_vol_ml, pfo_density_g_ml,
+        store=store if weigh_aliquots else None, run_info={
+            'run_start_timestamp': str(run_start_timestamp),
+            'syringe_cc': cc,
+            'syringe_family': family,
+            'rate': remote_rate
+        }, drip_waiter=drip_waiter, journal=journal, pump=pump,
+        num_this_run=num_this_run, vial_map=vial_map,
+        fill_tolerance_ml=run_settings['fill_tolerance_ml'])
+
+    if report_timing:
+        device_stats = benchmark.instrument(workcell)
+    if trace:
+        trace_path = 'trace_{}.json'.format(
+            datetime.now().strftime('%Y%m%d_%H%M%S'))
+        tracing.start(trace_path)
+        trace_robot(robot)
+    results = scheduler.run(vials, recorder.get_volume, recorder.on_done,
+        get_drip_wait=get_drip_wait, resume=resume_vial)
+    if journal is not None:
+        journal.finish()
+    print_throughput(results)
+    print_vial_counts(vial_map)
+    if trace:
+        print('Trace saved to {}'.format(tracing.stop()))
+    if report_timing:
+        device_stats.restore()
+    if report_timing and len(results) > 0:
+        summary = benchmark.summarize(results, device_stats,
+            target_vol_ml=target_vol_ml, pipelined=pipelined,
+            mass_feedback=mass_feedback)
+        benchmark.print_report(summary)
+        benchmark.save(summary, 'benchmark_{}.json'.format(
+            datetime.fromtimestamp(results[0]['start_time']).strftime(
+            '%Y%m%d_%H%M%S')))
+    if weigh_aliquots:
+        # Across all runs: ./analysis.py
+        print('This run (all of it, if resumed):')
+        analysis.print_summary(analysis.summarize(analysis.load(store,
+            run_start_timestamp), density_g_ml=pfo_density_g_ml))
+        store.close()
+    if weigh_aliquots and len(scale.settle_times_s) > 0:
+        print('time to stable weight (s): median={:.1f}, max={:.1f}'.format(
+            np.median(scale.settle_times_s), np.max(scale.settle_times_s)))
     
     # So box / scale can be picked up without the traveling part of the robot
     # getting in the way.
-    outoftheway_xy = (425, 0)
     robot.moveZ2(0)
-    robot.moveXY(outoftheway_xy)
+    robot.moveXY(tuple(workcell_config['outoftheway_xy']))
 
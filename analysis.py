@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+"""
+Summarizes aliquoting history (see run_data.py) for each configuration
+(syringe, target volume, rate): bias and precision of the delivered volume,
+drift with the volume left in the syringe, and time per vial. Recommends a
+rate, volume correction and drip wait for each syringe and target volume.
+
+    ./analysis.py
+    ./analysis.py --cc 60 --family B-D --target 2.0 --json summary.json
+
+Everything is computed on arrays of all the rows at once, grouped with
+np.bincount, so tens of thousands of rows take a fraction of a second.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+import run_data
+import syringes
+
+
+CONFIG_COLUMNS = ('syringe_cc', 'syringe_family', 'target_vol', 'rate')
+
+
+def load(store, run_start_timestamp=None):
+    """Returns dict of run_data.COLUMN_NAMES -> arrays, for all rows (or one
+    run's), in order.
+
+    Numeric columns are float arrays, with nan where values are missing. Text
+    columns are object arrays, with '' where values are missing.
+    """
+    columns = store.columns(run_start_timestamp)
+    history = dict()
+    for name, sql_type in run_data.COLUMNS:
+        if sql_type == 'TEXT':
+            history[name] = np.array(['' if v is None else v
+                for v in columns[name]], dtype=object)
+        else:
+            history[name] = np.array(columns[name], dtype=float)
+    return history
+
+
+def select(history, mask):
+    return dict((k, v[mask]) for k, v in history.items())
+
+
+def commanded_ml(history):
+    """Returns the volume commanded for each row, nan where unknown.
+
+    Vectorized calibration.commanded_volumes: the commanded_vol_ml column, or
+    for older rows, the target plus the correction recorded on the previous
+    row of the same run.
+    """
+    runs = history['run_start_timestamp']
+    commanded = np.full(len(runs), np.nan)
+    if len(runs) > 1:
+        same_run = runs[1:] == runs[:-1]
+        commanded[1:] = np.where(same_run, history['target_vol'][1:] +
+            history['vol_correction'][:-1], np.nan)
+    recorded = history['commanded_vol_ml']
+    return np.where(np.isfinite(recorded), recorded, commanded)
+
+
+def _codes(values):
+    if values.dtype.kind == 'f':
+        # Rates that differ by less than this are the same setting.
+        values = np.round(np.where(np.isnan(values), -1, values), 3)
+    uniques, codes = np.unique(values, return_inverse=True)
+    return codes.ravel(), len(uniques)
+
+
+def group_by(history, columns):
+    """Returns (group index of each row, index of the first row of each
+    group), grouping rows with equal values in all of columns.
+    """
+    combined = np.zeros(len(history[columns[0]]), dtype=np.int64)
+    for name in columns:
+        codes, n_uniques = _codes(history[name])
+        combined = combined * n_uniques + codes
+    _, first, groups = np.unique(combined, return_index=True,
+        return_inverse=True)
+    return groups.ravel(), first
+
+
+def _group_mean(values, groups, n_groups):
+    ok = np.isfinite(values)
+    n = np.bincount(groups[ok], minlength=n_groups)
+    total = np.bincount(groups[ok], weights=values[ok], minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / n, n
+
+
+def _group_sd(values, groups, n_groups):
+    mean, n = _group_mean(values, groups, n_groups)
+    ok = np.isfinite(values)
+    dev_sq = (values[ok] - mean[groups[ok]]) ** 2
+    ss = np.bincount(groups[ok], weights=dev_sq, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 1, np.sqrt(ss / (n - 1)), np.nan)
+
+
+def _group_percentile(values, groups, n_groups, q):
+    """As np.percentile (linear interpolation), within each group.
+    """
+    ok = np.isfinite(values)
+    values = values[ok]
+    groups = groups[ok]
+    order = np.lexsort((values, groups))
+    values = values[order]
+    n = np.bincount(groups, minlength=n_groups)
+    start = np.cumsum(n) - n
+    pos = start + (n - 1) * q / 100.0
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    if len(values) == 0:
+        return np.full(n_groups, np.nan)
+    lo = np.clip(lo, 0, len(values) - 1)
+    hi = np.clip(hi, 0, len(values) - 1)
+    interpolated = values[lo] + (values[hi] - values[lo]) * (pos - lo)
+    return np.where(n > 0, interpolated, np.nan)
+
+
+def _group_slope(x, y, groups, n_groups, min_samples=3):
+    """Least-squares slope of y against x, within each group.
+    """
+    ok = np.isfinite(x) & np.isfinite(y)
+    x = x[ok]
+    y = y[ok]
+    g = groups[ok]
+
+    def total(weights):
+        return np.bincount(g, weights=weights, minlength=n_groups)
+
+    n = np.bincount(g, minlength=n_groups)
+    sx = total(x)
+    sy = total(y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sxx = total(x * x) - sx * sx / n
+        sxy = total(x * y) - sx * sy / n
+        return np.where((n >= min_samples) & (sxx > 1e-9), sxy / sxx, np.nan)
+
+
+def _learn_drip_waits(history, groups, n_groups, fraction, commanded,
+    density_g_ml, conservative_s, tolerance_g, min_samples):
+    """Returns the drip wait to use for each group, as
+    calibration.learn_drip_wait would pick from that group's rows.
+    """
+    wait_s = history['drip_wait']
+    ok = np.isfinite(fraction) & np.isfinite(wait_s) & (commanded > 0)
+
+    baseline = ok & (wait_s >= conservative_s)
+    baseline_fraction, n_baseline = _group_mean(np.where(baseline, fraction,
+        np.nan), groups, n_groups)
+
+    # Sub-groups of each group, by drip wait.
+    wait_groups, first = group_by({'group': groups, 'wait': wait_s},
+        ('group', 'wait'))
+    n_wait_groups = len(first)
+    wait_fraction = np.where(ok, fraction, np.nan)
+    mean_v, n = _group_mean(np.where(ok, commanded, np.nan), wait_groups,
+        n_wait_groups)
+    mean_fv, _ = _group_mean(wait_fraction * commanded, wait_groups,
+        n_wait_groups)
+    # Mean over the rows of (baseline_fraction - fraction) * vol * density.
+    loss_g = density_g_ml * (baseline_fraction[groups[first]] * mean_v -
+        mean_fv)
+
+    learned_s = np.full(n_groups, float(conservative_s))
+    stopped = n_baseline < min_samples
+    # Longest waits first, so each is only accepted if every longer one was.
+    for k in np.argsort(-wait_s[first], kind='mergesort'):
+        group = groups[first[k]]
+        if (stopped[group] or wait_s[first[k]] >= conservative_s or
+            n[k] < min_samples):
+            continue
+        if loss_g[k] > tolerance_g:
+            stopped[group] = True
+        else:
+            learned_s[group] = wait_s[first[k]]
+    return learned_s
+
+
+def summarize(history, density_g_ml, conservative_drip_s=20,
+    tolerance_g=0.01, min_samples=5):
+    """Returns a list with a dict of statistics for each configuration
+    (CONFIG_COLUMNS) in history (from load), of a liquid with density_g_ml
+    (from syringes.json):
+
+    n: number of vials
+    bias_ml: mean delivered volume (from mass) minus the target
+    sd_ml, cv: standard deviation and coefficient of variation of the
+        delivered volume
+    offset_ml, offset_sd_ml: median and standard deviation of the delivered
+        minus commanded volume (the offset calibration.KalmanCorrection
+        estimates). correction_ml is the correction that would cancel it.
+    drift_ml_per_10ml: change in that offset per 10 mL more in the syringe
+        (from start_syringe_vol, as recorded)
+    time_p50_s, time_p90_s: time per vial
+    drip_wait_s: drip wait as calibration.learn_drip_wait picks it
+    """
+    n_rows = len(history['run_start_timestamp'])
+    if n_rows == 0:
+        return []
+    groups, first = group_by(history, CONFIG_COLUMNS)
+    n_groups = len(first)
+
+    delivered = history['pfo_g'] / density_g_ml
+    commanded = commanded_ml(history)
+    offset = delivered - commanded
+
+    mean_delivered, n = _group_mean(delivered, groups, n_groups)
+    bias = mean_delivered - history['target_vol'][first]
+    sd = _group_sd(delivered, groups, n_groups)
+    median_offset = _group_percentile(offset, groups, n_groups, 50)
+    offset_sd = _group_sd(offset, groups, n_groups)
+    drift = _group_slope(history['start_syringe_vol'], offset, groups,
+        n_groups) * 10
+    time_p50 = _group_percentile(history['time_taken'], groups, n_groups, 50)
+    time_p90 = _group_percentile(history['time_taken'], groups, n_groups, 90)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = delivered / commanded
+        cv = sd / mean_delivered
+    drip_wait = _learn_drip_waits(history, groups, n_groups, fraction,
+        commanded, density_g_ml, conservative_drip_s, tolerance_g,
+        min_samples)
+
+    def value(x):
+        # JSON has no nan.
+        return None if not np.isfinite(x) else float(x)
+
+    summary = []
+    for k in range(n_groups):
+        config = dict((name, history[name][first[k]])
+            for name in CONFIG_COLUMNS)
+        config['syringe_cc'] = value(config['syringe_cc'])
+        config['target_vol'] = value(config['target_vol'])
+        config['rate'] = value(config['rate'])
+        config.update({
+            'n': int(n[k]),
+            'bias_ml': value(bias[k]),
+            'sd_ml': value(sd[k]),
+            'cv': value(cv[k]),
+            'offset_ml': value(median_offset[k]),
+            'offset_sd_ml': value(offset_sd[k]),
+            'correction_ml': value(-median_offset[k]),
+            'drift_ml_per_10ml': value(drift[k]),
+            'time_p50_s': value(time_p50[k]),
+            'time_p90_s': value(time_p90[k]),
+            'drip_wait_s': value(drip_wait[k])
+        })
+        summary.append(config)
+    return summary
+
+
+def recommend(summary, max_sd_ml=0.02, min_samples=5):
+    """Returns a list with one recommendation (a summary entry) per syringe
+    and target volume: the fastest rate whose offset_sd_ml is at most
+    max_sd_ml, or the most precise rate if none is.
+
+    Only configurations with at least min_samples vials are considered.
+    """
+    by_target = dict()
+    for s in summary:
+        if s['n'] < min_samples or s['offset_sd_ml'] is None:
+            continue
+        key = (s['syringe_cc'], s['syringe_family'], s['target_vol'])
+        by_target.setdefault(key, []).append(s)
+
+    recommendations = []
+    for key in sorted(by_target, key=str):
+        configs = by_target[key]
+        precise = [s for s in configs if s['offset_sd_ml'] <= max_sd_ml]
+        if len(precise) > 0:
+            best = max(precise, key=lambda s: s['rate'])
+        else:
+            best = min(configs, key=lambda s: s['offset_sd_ml'])
+        recommendations.append(best)
+    return recommendations
+
+
+def _fmt(x, spec):
+    return '-' if x is None else format(x, spec)
+
+
+def print_summary(summary):
+    print('{:>4} {:<10} {:>6} {:>5} {:>5} {:>7} {:>6} {:>6} {:>7} {:>7} '
+        '{:>6} {:>6}'.format('cc', 'family', 'target', 'rate', 'n', 'bias',
+        'cv', 'offset', 'off_sd', 'drift10', 't_p50', 't_p90'))
+    for s in summary:
+        print('{:>4} {:<10} {:>6} {:>5} {:>5d} {:>7} {:>6} {:>6} {:>7} {:>7} '
+            '{:>6} {:>6}'.format(_fmt(s['syringe_cc'], '.0f'),
+            s['syringe_family'], _fmt(s['target_vol'], '.2f'),
+            _fmt(s['rate'], '.2f'), s['n'], _fmt(s['bias_ml'], '+.3f'),
+            _fmt(s['cv'], '.2%'), _fmt(s['offset_ml'], '+.3f'),
+            _fmt(s['offset_sd_ml'], '.3f'),
+            _fmt(s['drift_ml_per_10ml'], '+.4f'),
+            _fmt(s['time_p50_s'], '.1f'), _fmt(s['time_p90_s'], '.1f')))
+
+
+def print_recommendations(recommendations):
+    for r in recommendations:
+        print('{:.0f}mL {} syringe, {:.2f} mL: rate {:.2f} mL/min, volume '
+            'correction {} mL, drip wait {}s ({} vials)'.format(
+            r['syringe_cc'], r['syringe_family'], r['target_vol'], r['rate'],
+            _fmt(r['correction_ml'], '+.3f'), _fmt(r['drip_wait_s'], '.1f'),
+            r['n']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=run_data.RUN_DATA_DB,
+        help='(default: %(default)s)')
+    parser.add_argument('--run', metavar='RUN_START_TIMESTAMP',
+        help='only this run')
+    parser.add_argument('--cc', type=float)
+    parser.add_argument('--family')
+    parser.add_argument('--target', type=float, metavar='ML')
+    parser.add_argument('--liquid', default='pfo',
+        help='for its density, from syringes.json (default: %(default)s)')
+    parser.add_argument('--conservative-drip-wait', type=float, default=20,
+        metavar='S', help='(default: %(default)s)')
+    parser.add_argument('--max-sd', type=float, default=0.02, metavar='ML',
+        help='imprecision allowed when recommending a rate '
+        '(default: %(default)s)')
+    parser.add_argument('--json', metavar='JSON',
+        help='also save the summary and recommendations here')
+    args = parser.parse_args()
+
+    start = time.time()
+    with run_data.RunData(args.db) as store:
+        history = load(store, run_start_timestamp=args.run)
+
+    mask = np.ones(len(history['run_start_timestamp']), dtype=bool)
+    if args.cc is not None:
+        mask &= history['syringe_cc'] == args.cc
+    if args.family is not None:
+        mask &= history['syringe_family'] == args.family
+    if args.target is not None:
+        mask &= np.isclose(history['target_vol'], args.target)
+    history = select(history, mask)
+
+    density_g_ml = syringes.SyringeTable.load().liquid(args.liquid)[
+        'density_g_ml']
+    summary = summarize(history, density_g_ml=density_g_ml,
+        conservative_drip_s=args.conservative_drip_wait)
+    recommendations = recommend(summary, max_sd_ml=args.max_sd)
+    print('{} vials, {} configurations ({:.2f}s)'.format(mask.sum(),
+        len(summary), time.time() - start))
+    print_summary(summary)
+    print()
+    print_recommendations(recommendations)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'summary': summary, 'recommendations': recommendations},
+                f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+asyncio wrappers around the (blocking) pump, scale and robot drivers, so I/O
+on different devices can overlap, e.g.:
+
+    pump = AsyncAL1000(wpi_al1000.AL1000(...))
+    scale = AsyncScale(weighing.StreamingScale(...))
+    robot = AsyncRobot(robot)
+    empty_g, _ = await asyncio.gather(scale.read_stable(),
+        robot.moveXY(pump_xy))
+
+Each device gets its own worker thread, and every call on a device holds that
+device's lock, so calls to one device are serialized while calls to different
+devices run concurrently. The synchronous drivers are still what talk to the
+hardware (and can still be used directly, from code that holds `lock` if an
+async wrapper may be in use at the same time).
+
+Nothing uses these yet: the schedulers overlap devices with threads (see
+scheduler.PipelinedScheduler), and still run on Python 2. These are for an
+asyncio scheduler to be built on.
+
+Python 3 only.
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from workcell import move_gripper_servo
+
+
+class AsyncDevice(object):
+    """Makes every method of a blocking device awaitable.
+
+    `await adev.some_method(*args)` runs device.some_method(*args) in the
+    device's thread. Attributes that are not callable are returned as is.
+    """
+    def __init__(self, device, name=None):
+        self.device = device
+        self.name = name if name is not None else type(device).__name__
+        # Re-entrant so a function passed to run can still call device methods
+        # that other code may also wrap in the lock.
+        self.lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix=self.name)
+
+    def _locked(self, fn, args, kwargs):
+        with self.lock:
+            return fn(*args, **kwargs)
+
+    async def call(self, fn, *args, **kwargs):
+        """Returns fn(*args, **kwargs), run in this device's thread, under its
+        lock.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+            functools.partial(self._locked, fn, args, kwargs))
+
+    async def run(self, fn, *args, **kwargs):
+        """Returns fn(device, *args, **kwargs), for sequences of calls that
+        should not have calls from elsewhere interleaved.
+        """
+        return await self.call(fn, self.device, *args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.device, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.call(attr, *args, **kwargs)
+        return method
+
+    def close(self):
+        """Stops the device's thread, once any pending calls finish.
+        """
+        self._executor.shutdown(wait=True)
+
+
+class AsyncAL1000(AsyncDevice):
+    """Wraps a wpi_al1000.AL1000.
+    """
+    async def dispense(self, ml, poll_interval_s=None):
+        """Dispenses ml, returning the wpi_al1000.Dispense handle once done.
+
+        Unlike AL1000.dispense(block=True), the pump's thread is only busy
+        while actually talking to the pump, and sleeps between polls happen
+        on the event loop. If the awaiting task is cancelled, the pump is
+        stopped.
+        """
+        d = await self.call(self.device.dispense, ml, block=False,
+            poll_interval_s=poll_interval_s)
+        try:
+            while not await self.call(d.poll):
+                await asyncio.sleep(d.poll_interval_s)
+        except asyncio.CancelledError:
+            await self.call(d.cancel)
+            raise
+
+        if d.error is not None:
+            raise d.error
+        return d
+
+
+class AsyncScale(AsyncDevice):
+    """Wraps a weighing.StreamingScale.
+    """
+    async def read_stable(self, timeout_s=None):
+        """Same as StreamingScale.read_stable, but only holding the scale's
+        lock for each immediate reading.
+        """
+        scale = self.device
+        read = functools.partial(self._locked, scale.read_immediate, (), {})
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(
+            scale.read_stable, timeout_s, read=read))
+
+
+class AsyncRobot(AsyncDevice):
+    """Wraps a maple.robotMaple (or simulation.SimulatedRobot).
+    """
+    async def move_gripper_servo(self, s_position):
+        """Same as workcell.move_gripper_servo.
+        """
+        return await self.call(move_gripper_servo, self.device,
+            s_position)
+
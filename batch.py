@@ -0,0 +1,537 @@
+#!/usr/bin/env python
+
+"""
+Runs a queue of aliquoting jobs back to back, without asking anything.
+
+    ./batch.py jobs.json [--config aliquot_config.json] [--simulate]
+
+jobs.json is a list of jobs, each setting any of the 'run' settings in
+run_config.py (anything not set is from the config file, or the defaults):
+
+    [
+      {"name": "pfo 2mL", "target_vol_ml": 2.0, "n_aliquots": 20},
+      {"name": "pfo 1mL", "target_vol_ml": 1.0, "n_aliquots": 40,
+       "vialbox_offset": [751, 220]}
+    ]
+
+Each job fills the slots the vial map (vial_map.json, see vial_map.py) has as
+present, so a job carries on in a box another job left partly filled.
+
+With swap_racks, a job can go round the racks (see deck.py) more than once:
+press Enter once each finished rack is swapped for one of empty vials.
+
+All jobs are checked before any starts. Which jobs are done is saved to
+batch_state.json, and each job's run to run_state.json (as for aliquot.py),
+so running the same command again after an interruption skips the finished
+jobs and resumes the interrupted one. If a vial was being gripped or released
+when it stopped, say whether it is in the gripper with --holding.
+
+The syringe is not refilled between jobs: a job that would need more than is
+in it stops the batch before it starts (refill, then rerun with --syringe-ml).
+What is left in it is kept in syringe_ledger.json (see syringes.py), so jobs
+(and batches) on the same syringe and no syringe_ml carry on with what the
+last one left. A different syringe is assumed full.
+
+--simulate runs the jobs on simulation.py's devices (with the real pump driver
+talking to a fake pump), in virtual time, keeping its state and data in
+sim_* files.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import syringes
+import startup
+import calibration
+import run_config
+import run_data
+import analysis
+import path_planner
+from workcell import Workcell, Gripper, set_gripper, release_vial
+from scheduler import SerialScheduler, DeckScheduler, GRIP_CHANGING_PHASES
+from deck import Deck, RackSwaps
+from vial_map import (VialMap, VIAL_MAP_FILE, run_vials, print_out_vials,
+    print_vial_counts)
+from run_state import RunJournal, RUN_STATE_FILE
+from run_recorder import RunRecorder
+from mass_feedback import MassFeedbackDispenser
+
+
+BATCH_STATE_FILE = 'batch_state.json'
+SIM_PREFIX = 'sim_'
+
+
+class BatchError(RuntimeError):
+    pass
+
+
+def load_jobs(path, config):
+    """Returns the settings for each job in the JSON file at path.
+
+    Raises run_config.ConfigError if any job is invalid.
+    """
+    with open(path, 'r') as f:
+        jobs = json.load(f)
+    if not isinstance(jobs, list) or len(jobs) == 0:
+        raise run_config.ConfigError('{}: expected a list of jobs'.format(
+            path))
+    all_settings = []
+    for k, job in enumerate(jobs):
+        where = '{}[{}]'.format(path, k)
+        if not isinstance(job, dict):
+            raise run_config.ConfigError('{}: expected an object'.format(
+                where))
+        settings = run_config.job_settings(config, job, where=where)
+        if settings['name'] is None:
+            settings['name'] = 'job {}'.format(k)
+        all_settings.append(settings)
+    return all_settings
+
+
+def check_jobs(jobs, workcell_config, syringe_table):
+    """Raises run_config.ConfigError for any job that can't run: an unknown
+    syringe or liquid, or a rate too fast for them.
+    """
+    for settings in jobs:
+        where = settings['name']
+        family = run_config.syringe_family(settings)
+        try:
+            syringe = syringe_table.find(family=family,
+                cc=settings['syringe_cc'])
+            max_rate = job_max_rate(syringe_table, syringe, settings['liquid'])
+        except ValueError as err:
+            raise run_config.ConfigError('{}: {}'.format(where, err))
+        if settings['rate'] is not None and settings['rate'] > max_rate:
+            raise run_config.ConfigError('{}: rate {} is over the max of {} '
+                'mL/min for this syringe and liquid'.format(where,
+                settings['rate'], max_rate))
+        if settings['first_aliquot'] > settings['n_aliquots']:
+            raise run_config.ConfigError('{}: first_aliquot is past '
+                'n_aliquots'.format(where))
+        try:
+            run_config.racks(workcell_config, settings)
+        except run_config.ConfigError as err:
+            raise run_config.ConfigError('{}: {}'.format(where, err))
+
+
+def job_max_rate(syringe_table, syringe, liquid):
+    # Rounded down to what the pump displays, as in aliquot.py.
+    return int(syringe_table.safe_max_rate(syringe, liquid) * 100) / 100
+
+
+class Devices(object):
+    """The robot, pump and scale, shared by all jobs.
+    """
+    def __init__(self, robot, pump, scale, clock, simulated=False):
+        self.robot = robot
+        self.pump = pump
+        self.scale = scale
+        self.clock = clock
+        self.simulated = simulated
+
+    @classmethod
+    def connect(cls, workcell_config, weigh_aliquots=True, zero_scale=True,
+        ledger_path=syringes.SYRINGE_LEDGER_FILE):
+        """Homes the robot and connects to the pump and scale, at the same
+        time (see startup.py).
+        """
+        import maple
+        import maple.robotutil
+
+        robot_config = workcell_config['robot_config']
+        if robot_config is None:
+            robot_config = os.path.join(maple.__path__[0], 'MAPLE.cfg')
+        tasks = startup.Startup()
+        tasks.start('robot', maple.robotutil.MAPLE, robot_config,
+            enable_z0=False, enable_z1=False, z2_has_crash_sensor=False)
+        tasks.start('pump', startup.connect_pump, workcell_config['pump_port'],
+            ledger=syringes.SyringeLedger(ledger_path))
+        if weigh_aliquots:
+            tasks.start('scale', startup.connect_scale,
+                workcell_config['scale_port'], zero=zero_scale)
+        pump = tasks.result('pump')
+        robot = tasks.result('robot')
+        robot.z2_to_worksurface = workcell_config['z2_to_worksurface']
+        scale = tasks.result('scale') if weigh_aliquots else None
+        tasks.print_durations()
+        return cls(robot, pump, scale, time)
+
+    @classmethod
+    def simulate(cls, ledger_path=SIM_PREFIX + syringes.SYRINGE_LEDGER_FILE):
+        import simulation
+
+        sim = simulation.make_workcell(clock=simulation.VirtualClock(),
+            pty_pump=True)
+        sim.pump.ledger = syringes.SyringeLedger(ledger_path)
+        sim.pump.reconcile_ledger()
+        return cls(sim.robot, sim.pump, sim.scale, sim.clock, simulated=True)
+
+    def rack(self, rack, vial_grip_height):
+        """Returns the vial box for rack (as from run_config.racks).
+        """
+        offset = tuple(rack['offset'])
+        letters = rack['letters']
+        nums = rack['nums']
+        if self.simulated:
+            import simulation
+            return simulation.SimulatedVialBox(self.robot, offset=offset,
+                n_cols=ord(letters[1]) - ord(letters[0]) + 1,
+                n_rows=nums[1] - nums[0] + 1,
+                vial_grip_height=vial_grip_height, start_letter=letters[0],
+                start_num=nums[0])
+        from aliquot import ScintillationVialBox
+        return ScintillationVialBox(self.robot, offset, vial_grip_height,
+            start_letter=letters[0], end_letter=letters[1],
+            start_num=nums[0], end_num=nums[1])
+
+    def rack_swaps(self, deck):
+        """Returns a deck.RackSwaps: asking the operator, or (if simulated)
+        emptying the rack straight away.
+        """
+        if not self.simulated:
+            return RackSwaps()
+
+        def swap(name):
+            r = deck.names.index(name)
+            self.robot.world.clear([deck.anchor_center(i, j)
+                for i, j in deck.rack_ijs(r)])
+        return RackSwaps(confirm=swap)
+
+
+def make_workcell(devices, workcell_config, settings, refill_syringe=None,
+    vial_map_path=VIAL_MAP_FILE):
+    """Returns a Workcell laid out as in workcell_config, for a job, with the
+    vial map (see vial_map.py) of its racks.
+    """
+    wc = workcell_config
+    racks = run_config.racks(wc, settings)
+    vialbox = Deck([(rack['name'], devices.rack(rack, wc['vial_grip_height']))
+        for rack in racks])
+
+    weigh_aliquots = settings['weigh_aliquots']
+    scale = None
+    scale_xy = None
+    scale_z = None
+    if weigh_aliquots:
+        scale = devices.scale
+        scale_xy = tuple(wc['scale_xy'])
+        scale_z = wc['scale_z']
+        if settings['mass_feedback']:
+            # TODO measure (scale_z too) once the scale is under the pump
+            scale_xy = tuple(wc['pump_xy'])
+
+    staging_xy = wc['staging_xy']
+    return Workcell(devices.robot, vialbox, vialbox.approach_from,
+        pump=devices.pump, pump_xy=tuple(wc['pump_xy']), pump_z=wc['pump_z'],
+        pump_xy_approach=run_config.pump_xy_approach(wc, weigh_aliquots),
+        pump_platform_z=wc['pump_platform_z'], scale=scale, scale_xy=scale_xy,
+        scale_z=scale_z,
+        staging_xy=None if staging_xy is None else tuple(staging_xy),
+        staging_z=wc['staging_z'], drop_wait_s=settings['drop_wait_s'],
+        refill_syringe=refill_syringe, batch_moves=settings['batch_moves'],
+        vial_map=VialMap(vialbox, racks, path=vial_map_path),
+        clock=devices.clock)
+
+
+def run_job(devices, workcell_config, settings, job_index, syringe_table,
+    syringe_ml, store=None, journal=None, resume_vial=None,
+    journal_path=RUN_STATE_FILE, vial_map_path=VIAL_MAP_FILE):
+    """Runs one job, returning (scheduler results, run_start_timestamp).
+
+    syringe_ml: mL in the syringe to start, if not what the pump's ledger
+        has (e.g. after a refill).
+    journal: an interrupted run_state.RunJournal of this job, to resume.
+    resume_vial: its 'vial' state, with 'holding' set if needed.
+    """
+    pump = devices.pump
+    liquid = settings['liquid']
+    cc = settings['syringe_cc']
+    family = run_config.syringe_family(settings)
+    syringe = syringe_table.find(family=family, cc=cc)
+    rate = settings['rate']
+    if rate is None:
+        rate = job_max_rate(syringe_table, syringe, liquid)
+
+    if journal is not None:
+        saved = journal.get('settings')
+        run_start_timestamp = saved['run_start_timestamp']
+        ijs = [tuple(ij) for ij in saved['ijs']]
+        # (from before there was a vial map, if not there)
+        ns = saved.get('ns', range(saved['start_n'], saved['n_aliquots']))
+        last_done = journal.get('last_done')
+        if resume_vial is not None:
+            start_n = resume_vial['n']
+        elif last_done is not None:
+            start_n = last_done + 1
+        else:
+            start_n = saved['start_n']
+    else:
+        run_start_timestamp = datetime.now()
+        ijs = None
+        start_n = settings['first_aliquot']
+
+    # (assumed full if it is not the syringe the ledger has)
+    pump.set_syringe(family=family, cc=cc, liquid=liquid, table=syringe_table)
+    if syringe_ml is not None:
+        pump.refilled(syringe_ml)
+    pump.set_rate(rate, unit='MM')
+    remote_rate = pump.get_rate()
+    print('Using rate of {} mL/min'.format(remote_rate))
+
+    def refill_syringe():
+        raise BatchError('syringe needs refilling during {!r}. Refill it and '
+            'rerun with --syringe-ml'.format(settings['name']))
+
+    workcell = make_workcell(devices, workcell_config, settings,
+        refill_syringe=refill_syringe, vial_map_path=vial_map_path)
+    vialbox = workcell.vialbox
+    vial_map = workcell.vial_map
+    n_aliquots = settings['n_aliquots']
+    if n_aliquots > vialbox.n_slots and not settings['swap_racks']:
+        raise BatchError('{}: number of aliquots can not exceed # of '
+            'reachable vials ({}) without swap_racks'.format(
+            settings['name'], vialbox.n_slots))
+
+    gripper = Gripper.from_config(vial_type=settings['vial_type'])
+    set_gripper(gripper)
+
+    density_g_ml = syringe_table.liquid(liquid)['density_g_ml']
+    target_vol_ml = settings['target_vol_ml']
+    target_mass = target_vol_ml * density_g_ml
+    weigh_aliquots = settings['weigh_aliquots']
+    if not weigh_aliquots:
+        store = None
+
+    history = []
+    if store is not None:
+        history = store.matching_rows(cc, family, remote_rate, target_vol_ml)
+    corrector = calibration.make_corrector(history, density_g_ml,
+        correction_ml=settings['vol_correction_ml'],
+        filtered=weigh_aliquots and settings['filter_correction'])
+    num_this_run = 0
+    if journal is not None:
+        vars(corrector).update(journal.get('corrector'))
+        num_this_run = journal.get('num_this_run')
+
+    if settings['mass_feedback']:
+        workcell.dispenser = MassFeedbackDispenser(pump, workcell.scale,
+            density_g_ml, target_mass, coarse_rate=remote_rate,
+            clock=devices.clock)
+
+    get_drip_wait = None
+    drip_waiter = None
+    drop_wait_s = settings['drop_wait_s']
+    # (filling on the scale has no drip wait)
+    if (weigh_aliquots and settings['adaptive_drip_wait'] and
+        not settings['mass_feedback']):
+        initial_drip_wait_s = calibration.learn_drip_wait(history, drop_wait_s,
+            density_g_ml)
+        print('Starting with drip wait of {:.1f}s'.format(initial_drip_wait_s))
+        drip_waiter = calibration.AdaptiveDripWait(drop_wait_s, target_mass,
+            initial_s=initial_drip_wait_s)
+        get_drip_wait = drip_waiter.next_wait
+
+    plan_path = settings['plan_path']
+    if ijs is None:
+        rack_ijs = None
+        if plan_path:
+            rack_ijs, path_estimate = path_planner.plan_deck(workcell,
+                vialbox.stream(vialbox.n_slots),
+                motion=getattr(devices.robot, 'motion', None))
+            path_planner.print_estimate(path_estimate)
+
+        if settings['retry_failed']:
+            vial_map.reset(vial_map.slots('failed'))
+        # As in aliquot.py
+        vial_map.reset(vialbox.stream(start_n, rack_ijs=rack_ijs), 'skipped',
+            from_states=('present',))
+        n_vials = n_aliquots - start_n
+        print_vial_counts(vial_map)
+        print_out_vials(vial_map)
+        ijs, ns = run_vials(vial_map, n_vials, rack_ijs=rack_ijs,
+            swap_racks=settings['swap_racks'])
+        if len(ns) < n_vials:
+            raise BatchError('{!r} needs {} vials, but only {} slots have '
+                'empty vials (present) in {}. See ./vial_map.py'.format(
+                settings['name'], n_vials, len(ns), vial_map_path))
+    else:
+        plan_path = journal.get('settings')['plan_path']
+    if plan_path:
+        workcell.approach_offset = path_planner.APPROACH_OFFSET
+    vials = [(n,) + tuple(ijs[n]) for n in ns if n >= start_n]
+
+    need_ml = len(vials) * (target_vol_ml + max(corrector.correction(), 0))
+    if need_ml >= pump.ledger.left_ml:
+        raise BatchError('{!r} needs about {:.1f} mL, but the syringe has '
+            '{:.1f} mL. Refill it and rerun with --syringe-ml'.format(
+            settings['name'], need_ml, pump.ledger.left_ml))
+
+    if journal is None:
+        journal = RunJournal(path=journal_path)
+        journal.update(settings={
+            'run_start_timestamp': str(run_start_timestamp),
+            'cc': cc,
+            'family': family,
+            'rate': rate,
+            'target_vol_ml': target_vol_ml,
+            'n_aliquots': n_aliquots,
+            'start_n': start_n,
+            'plan_path': plan_path,
+            'ijs': ijs,
+            'ns': ns,
+            'batch_job': job_index
+        }, last_done=None, vial=None, corrector=vars(corrector),
+            num_this_run=num_this_run)
+
+    recorder = RunRecorder(vialbox, corrector, target_vol_ml, density_g_ml,
+        store=store, run_info={
+            'run_start_timestamp': str(run_start_timestamp),
+            'syringe_cc': cc,
+            'syringe_family': family,
+            'rate': remote_rate
+        }, drip_waiter=drip_waiter, journal=journal, pump=pump,
+        num_this_run=num_this_run, vial_map=vial_map,
+        fill_tolerance_ml=settings['fill_tolerance_ml'], clock=devices.clock)
+    print('Starting with volume correction of {:.3f} mL'.format(recorder.cv))
+
+    scheduler = DeckScheduler(SerialScheduler(workcell, journal=journal),
+        vialbox, ijs, swaps=devices.rack_swaps(vialbox), vial_map=vial_map)
+    results = scheduler.run(vials, recorder.get_volume, recorder.on_done,
+        get_drip_wait=get_drip_wait, resume=resume_vial)
+    journal.finish()
+    print_vial_counts(vial_map)
+    return results, run_start_timestamp
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a queue of aliquoting '
+        'jobs without prompting.')
+    parser.add_argument('jobs', help='JSON list of jobs (see batch.py)')
+    parser.add_argument('--config', default=run_config.CONFIG_FILE,
+        help='workcell and default run settings (default: %(default)s)')
+    parser.add_argument('--simulate', action='store_true',
+        help='run on simulated devices, in virtual time')
+    parser.add_argument('--syringe-ml', type=float, default=None,
+        help='mL in the syringe now (e.g. after refilling). Default: what '
+        'the last job left, or full for a new syringe.')
+    parser.add_argument('--holding', choices=('yes', 'no'), default=None,
+        help='whether the interrupted vial is in the gripper, if it was '
+        'being gripped or released')
+    parser.add_argument('--restart', action='store_true',
+        help='start the queue from the first job, even if a previous batch '
+        'did not finish')
+    args = parser.parse_args()
+
+    prefix = SIM_PREFIX if args.simulate else ''
+    batch_state_path = prefix + BATCH_STATE_FILE
+    journal_path = prefix + RUN_STATE_FILE
+    vial_map_path = prefix + VIAL_MAP_FILE
+    db_path = prefix + run_data.RUN_DATA_DB
+
+    try:
+        config = run_config.load(args.config)
+        jobs = load_jobs(args.jobs, config)
+        syringe_table = syringes.SyringeTable.load()
+        check_jobs(jobs, config['workcell'], syringe_table)
+    except (run_config.ConfigError, ValueError) as err:
+        sys.exit(str(err))
+
+    jobs_path = os.path.abspath(args.jobs)
+    batch = None
+    if not args.restart:
+        batch = RunJournal.interrupted(batch_state_path)
+    if batch is not None and batch.get('jobs_path') != jobs_path:
+        sys.exit('{} has an unfinished batch from {}. Finish it, or pass '
+            '--restart.'.format(batch_state_path, batch.get('jobs_path')))
+    if batch is None:
+        batch = RunJournal(path=batch_state_path)
+        batch.update(jobs_path=jobs_path, done=[], current=None)
+    done = set(batch.get('done'))
+
+    # A job's run that was interrupted, and where its vial was.
+    journal = RunJournal.interrupted(journal_path)
+    resume_vial = None
+    if journal is not None:
+        job_index = journal.get('settings').get('batch_job')
+        if job_index is None or job_index != batch.get('current'):
+            sys.exit('{} has an interrupted run that is not from this batch. '
+                'Resume it with aliquot.py first.'.format(journal_path))
+        resume_vial = journal.get('vial')
+    if (resume_vial is not None and
+        resume_vial['phase'] in GRIP_CHANGING_PHASES):
+        if args.holding is None:
+            sys.exit('Aliquot #{} was interrupted during {}. Rerun with '
+                '--holding yes or --holding no, for whether it is in the '
+                'gripper.'.format(resume_vial['n'], resume_vial['phase']))
+        resume_vial['holding'] = args.holding == 'yes'
+
+    weigh_aliquots = any(s['weigh_aliquots'] for s in jobs)
+    if args.simulate:
+        devices = Devices.simulate()
+    else:
+        # Not with the interrupted vial possibly on it.
+        zero_scale = resume_vial is None or resume_vial['holding']
+        devices = Devices.connect(config['workcell'],
+            weigh_aliquots=weigh_aliquots, zero_scale=zero_scale)
+    store = None
+    if weigh_aliquots:
+        store = run_data.RunData(db_path)
+
+    # Otherwise the scheduler gets the robot clear, holding the vial or not.
+    if resume_vial is None:
+        release_vial(devices.robot)
+        devices.robot.moveZ2(0)
+
+    syringe_ml = args.syringe_ml
+    start_time = devices.clock.time()
+    for k, settings in enumerate(jobs):
+        if k in done:
+            continue
+        print('\nJob {}/{}: {}'.format(k + 1, len(jobs), settings['name']))
+        if journal is None and syringe_ml is None:
+            syringe_ml = settings['syringe_ml']
+        batch.update(current=k)
+
+        try:
+            results, run_start_timestamp = run_job(devices,
+                config['workcell'], settings, k, syringe_table, syringe_ml,
+                store=store, journal=journal, resume_vial=resume_vial,
+                journal_path=journal_path, vial_map_path=vial_map_path)
+        except BatchError as err:
+            sys.exit(str(err))
+
+        left_ml = devices.pump.ledger.left_ml
+        done.add(k)
+        batch.update(done=sorted(done), current=None)
+        journal = None
+        resume_vial = None
+        syringe_ml = None
+
+        print('{}: {} aliquots. {:.1f} mL left in the syringe.'.format(
+            settings['name'], len(results), left_ml))
+        if store is not None and settings['weigh_aliquots']:
+            analysis.print_summary(analysis.summarize(analysis.load(store,
+                run_start_timestamp), density_g_ml=syringe_table.liquid(
+                settings['liquid'])['density_g_ml']))
+
+    batch.finish()
+    print('\nBatch done: {} jobs in {:.1f} min'.format(len(jobs),
+        (devices.clock.time() - start_time) / 60))
+    if store is not None:
+        store.close()
+
+    # So box / scale can be picked up without the traveling part of the robot
+    # getting in the way.
+    devices.robot.moveZ2(0)
+    devices.robot.moveXY(tuple(config['workcell']['outoftheway_xy']))
+
+
+if __name__ == '__main__':
+    main()
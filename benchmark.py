@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+"""
+Breaks aliquot cycle time down by phase (fetch, weigh_empty, travel_to_pump,
+pump, drip_wait, ...) and by device call, and compares runs against a saved
+JSON baseline.
+
+From the command line, runs on a simulated workcell (see simulation.py):
+
+    ./benchmark.py -n 200 --save baseline.json
+    # ...change something...
+    ./benchmark.py -n 200 --compare baseline.json
+
+To benchmark real hardware, wrap a scheduler run on the real Workcell:
+
+    stats = benchmark.instrument(workcell)
+    results = scheduler.run(vials, get_volume, on_done)
+    stats.restore()
+    benchmark.print_report(benchmark.summarize(results, stats))
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+import tracing
+from workcell import trace_robot
+from scheduler import (SerialScheduler, PipelinedScheduler,
+    throughput_vials_per_hour)
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def describe(values):
+    """Returns dict with the mean, max and PERCENTILES of values.
+    """
+    if len(values) == 0:
+        return None
+    values = np.asarray(values, dtype=float)
+    summary = {'mean': float(values.mean()), 'max': float(values.max())}
+    for p in PERCENTILES:
+        summary['p{}'.format(p)] = float(np.percentile(values, p))
+    return summary
+
+
+class _Timed(object):
+    """Stands in for device, recording how long each method call takes.
+    """
+    def __init__(self, device, name, clock, calls):
+        self._device = device
+        self._name = name
+        self._clock = clock
+        self._calls = calls
+
+    def __getattr__(self, attr_name):
+        attr = getattr(self._device, attr_name)
+        if not callable(attr):
+            return attr
+
+        key = '{}.{}'.format(self._name, attr_name)
+        clock = self._clock
+        calls = self._calls
+
+        def timed(*args, **kwargs):
+            start = clock.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                calls.setdefault(key, []).append(clock.time() - start)
+        return timed
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._device, name, value)
+
+
+class DeviceStats(object):
+    """Durations of calls to each device method, made while instrumented.
+    """
+    def __init__(self, workcell):
+        self.workcell = workcell
+        # 'device.method' -> list of seconds
+        self.calls = dict()
+        self._restore = []
+
+        pump_stats = getattr(workcell.pump, 'command_stats', None)
+        # Mnemonic -> count, so only commands sent during the run are counted.
+        self._pump_counts_before = dict()
+        if pump_stats is not None:
+            for mnemonic, s in pump_stats.items():
+                self._pump_counts_before[mnemonic] = (s.count,
+                    s.total_latency_s, s.bytes_sent, s.bytes_received)
+
+    def _wrap(self, obj, attr_name, device_name):
+        device = getattr(obj, attr_name)
+        if device is None:
+            return
+        setattr(obj, attr_name, _Timed(device, device_name,
+            self.workcell.clock, self.calls))
+        self._restore.append((obj, attr_name, device))
+
+    def restore(self):
+        """Puts the original devices back.
+        """
+        for obj, attr_name, device in self._restore[::-1]:
+            setattr(obj, attr_name, device)
+        self._restore = []
+
+    def pump_commands(self):
+        """Returns dict of pump command mnemonic -> serial stats for the run,
+        if the pump keeps them (wpi_al1000.AL1000 does).
+        """
+        pump_stats = getattr(self.workcell.pump, 'command_stats', None)
+        if pump_stats is None:
+            return dict()
+
+        commands = dict()
+        for mnemonic, s in pump_stats.items():
+            count, latency_s, sent, received = self._pump_counts_before.get(
+                mnemonic, (0, 0.0, 0, 0))
+            count = s.count - count
+            if count == 0:
+                continue
+            commands[mnemonic] = {
+                'count': count,
+                'mean_latency_s': (s.total_latency_s - latency_s) / count,
+                'max_latency_s': s.max_latency_s,
+                'bytes_sent': s.bytes_sent - sent,
+                'bytes_received': s.bytes_received - received
+            }
+        return commands
+
+
+def instrument(workcell):
+    """Times calls to the robot (and its smoothie board), pump and scale.
+
+    Returns DeviceStats. Call its restore method when done.
+    """
+    stats = DeviceStats(workcell)
+    robot = workcell.robot
+    if getattr(robot, 'smoothie', None) is not None:
+        stats._wrap(robot, 'smoothie', 'smoothie')
+    timed_robot = _Timed(robot, 'robot', workcell.clock, stats.calls)
+    for obj in (workcell, workcell.vialbox):
+        stats._restore.append((obj, 'robot', obj.robot))
+        obj.robot = timed_robot
+
+    stats._wrap(workcell, 'pump', 'pump')
+    if workcell.scale is not None:
+        # The device under the StreamingScale, so each reading is counted.
+        stats._wrap(workcell.scale, 'scale', 'scale')
+    return stats
+
+
+def summarize(results, stats=None, **info):
+    """Returns a JSON serializable summary of a scheduler run.
+
+    results: list of result dicts from a scheduler run
+    stats: DeviceStats from instrument, if it was used
+    info: anything else to record (e.g. the settings benchmarked)
+    """
+    phases = sorted(set(p for r in results for p in r['phase_times']))
+    summary = {
+        'info': info,
+        'n_vials': len(results),
+        'vials_per_hour': throughput_vials_per_hour(results),
+        'cycle_s': describe([r['end_time'] - r['start_time']
+            for r in results]),
+        # Vials that skipped a phase count as 0 for it.
+        'phases_s': dict((p, describe([r['phase_times'].get(p, 0.0)
+            for r in results])) for p in phases)
+    }
+    if stats is not None:
+        calls = dict()
+        for key, durations in stats.calls.items():
+            calls[key] = describe(durations)
+            calls[key]['count'] = len(durations)
+        summary['device_calls_s'] = calls
+        summary['pump_commands'] = stats.pump_commands()
+    return summary
+
+
+def print_report(summary):
+    print('{} vials, {:.1f} vials/hour'.format(summary['n_vials'],
+        summary['vials_per_hour']))
+
+    columns = ['mean'] + ['p{}'.format(p) for p in PERCENTILES] + ['max']
+    header = '{:<28}'.format('') + ''.join('{:>9}'.format(c)
+        for c in columns)
+
+    def row(name, d):
+        return '{:<28}'.format(name) + ''.join('{:>9.3f}'.format(d[c])
+            for c in columns)
+
+    print()
+    print(header + ' (seconds per vial)')
+    print(row('cycle', summary['cycle_s']))
+    for name, d in sorted(summary['phases_s'].items(),
+        key=lambda x: -x[1]['mean']):
+        print(row(name, d))
+
+    calls = summary.get('device_calls_s')
+    if calls:
+        print()
+        print(header + '    count (seconds per call)')
+        for name, d in sorted(calls.items()):
+            print(row(name, d) + '{:>9}'.format(d['count']))
+
+    commands = summary.get('pump_commands')
+    if commands:
+        print()
+        print('{:<28}{:>9}{:>12}{:>12}{:>9}{:>9}'.format('pump command',
+            'count', 'mean (ms)', 'max (ms)', 'sent', 'recv'))
+        for mnemonic, d in sorted(commands.items()):
+            print('{:<28}{:>9}{:>12.2f}{:>12.2f}{:>9}{:>9}'.format(mnemonic,
+                d['count'], d['mean_latency_s'] * 1000,
+                d['max_latency_s'] * 1000, d['bytes_sent'],
+                d['bytes_received']))
+
+
+def save(summary, path):
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def compare(baseline, summary, tolerance=0.05, min_change_s=0.05):
+    """Prints how summary differs from baseline.
+
+    Returns list of str describing regressions: throughput down, or a phase
+    median up, by more than tolerance (a fraction), and (for phases) by more
+    than min_change_s.
+    """
+    regressions = []
+
+    def change(old, new):
+        if not old:
+            return 0.0 if new == old else float('inf')
+        return (new - old) / old
+
+    old_rate = baseline['vials_per_hour']
+    new_rate = summary['vials_per_hour']
+    print('{:<28}{:>10}{:>10}{:>9}'.format('', 'baseline', 'now', 'change'))
+    print('{:<28}{:>10.1f}{:>10.1f}{:>+9.1%}'.format('vials/hour', old_rate,
+        new_rate, change(old_rate, new_rate)))
+    if new_rate < old_rate * (1 - tolerance):
+        regressions.append('throughput down {:.1%}'.format(
+            -change(old_rate, new_rate)))
+
+    phases = sorted(set(baseline['phases_s']) | set(summary['phases_s']))
+    for phase in phases:
+        old = (baseline['phases_s'].get(phase) or {}).get('p50', 0.0)
+        new = (summary['phases_s'].get(phase) or {}).get('p50', 0.0)
+        print('{:<28}{:>10.3f}{:>10.3f}{:>+9.1%}'.format(phase + ' p50 (s)',
+            old, new, change(old, new)))
+        if new - old > max(old * tolerance, min_change_s):
+            regressions.append('{} median up {:.3f}s'.format(phase,
+                new - old))
+
+    old_calls = baseline.get('device_calls_s') or {}
+    new_calls = summary.get('device_calls_s') or {}
+    for key in sorted(set(old_calls) | set(new_calls)):
+        old = (old_calls.get(key) or {}).get('count', 0) / baseline['n_vials']
+        new = (new_calls.get(key) or {}).get('count', 0) / summary['n_vials']
+        if old != new:
+            print('{:<28}{:>10.2f}{:>10.2f}{:>+9.1%}'.format(
+                key + ' /vial', old, new, change(old, new)))
+    return regressions
+
+
+def main():
+    import simulation
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--vials', type=int, default=100)
+    parser.add_argument('--vol', type=float, default=2.0,
+        help='mL per vial (default: %(default)s)')
+    parser.add_argument('--pipelined', action='store_true')
+    parser.add_argument('--speedup', type=float, default=None,
+        help='run in real time, this many times faster, rather than in '
+        'virtual time')
+    parser.add_argument('--pty-pump', action='store_true',
+        help='use the real AL1000 driver with a fake pump on a pty')
+    parser.add_argument('--mass-feedback', type=float, default=None,
+        metavar='GRAMS', help='fill vials on the scale to this mass')
+    parser.add_argument('--batch-moves', action='store_true',
+        help='send the robot commands for each step as one G-code stream '
+        '(see motion_batch.py)')
+    parser.add_argument('--plan-path', action='store_true',
+        help='reorder vials and approach each slot as path_planner.py plans')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='JSON')
+    parser.add_argument('--compare', metavar='JSON')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+        help='fractional change counted as a regression (default: '
+        '%(default)s)')
+    parser.add_argument('--trace', metavar='JSON',
+        help='also save a Chrome trace of the run (see tracing.py)')
+    args = parser.parse_args()
+
+    if args.speedup is None:
+        clock = simulation.VirtualClock()
+    else:
+        clock = simulation.ScaledClock(args.speedup)
+    scheduler_class = PipelinedScheduler if args.pipelined else \
+        SerialScheduler
+
+    workcell = simulation.make_workcell(clock=clock, seed=args.seed,
+        pty_pump=args.pty_pump, mass_feedback_g=args.mass_feedback,
+        batch_moves=args.batch_moves)
+    if args.trace:
+        tracing.start(args.trace, clock=clock)
+        trace_robot(workcell.robot)
+    stats = instrument(workcell)
+    results, _ = simulation.simulate(args.vials,
+        scheduler_class=scheduler_class, vol_ml=args.vol, workcell=workcell,
+        plan_path=args.plan_path)
+    stats.restore()
+    if args.trace:
+        tracing.stop()
+
+    summary = summarize(results, stats, scheduler=scheduler_class.__name__,
+        vol_ml=args.vol, speedup=args.speedup, pty_pump=args.pty_pump,
+        mass_feedback_g=args.mass_feedback, batch_moves=args.batch_moves,
+        plan_path=args.plan_path,
+        seed=args.seed)
+    print_report(summary)
+
+    if args.save:
+        save(summary, args.save)
+        print('\nSaved to {}'.format(args.save))
+    if args.trace:
+        print('Trace saved to {}'.format(args.trace))
+
+    if args.compare:
+        print()
+        regressions = compare(load(args.compare), summary,
+            tolerance=args.tolerance)
+        if regressions:
+            print('\nRegressions:\n' + '\n'.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+"""
+Uses data from previous aliquoting runs (see run_data.py, or a CSV exported
+from it) and the current one to choose pumping parameters.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import csv
+import os
+from collections import deque
+
+
+def load_history(csv_file='aliquot_masses.csv'):
+    """Returns list of dicts, one per row of a CSV with run_data.COLUMN_NAMES.
+
+    Numeric values are converted to float. Returns an empty list if the file
+    does not exist.
+    """
+    if not os.path.exists(csv_file):
+        return []
+
+    rows = []
+    with open(csv_file, 'r') as f:
+        for row in csv.DictReader(f, skipinitialspace=True):
+            for k, v in row.items():
+                try:
+                    row[k] = float(v)
+                except (TypeError, ValueError):
+                    pass
+            rows.append(row)
+    return rows
+
+
+def matching_rows(rows, syringe_cc, syringe_family, rate, target_vol,
+    rate_tolerance=0.001):
+    """Returns rows from runs with the same syringe, rate and target volume.
+    """
+    return [r for r in rows if
+        r.get('syringe_cc') == syringe_cc and
+        r.get('syringe_family') == syringe_family and
+        isinstance(r.get('rate'), float) and
+        abs(r['rate'] - rate) <= rate_tolerance and
+        r.get('target_vol') == target_vol
+    ]
+
+
+def commanded_volumes(rows):
+    """Returns list of volume commanded for each row, or None where unknown.
+
+    From the commanded_vol_ml column, where rows have it. Older rows only
+    have the correction computed *after* each aliquot (vol_correction), so
+    for them it is taken to be the target plus the previous row's correction
+    (from the same run), which is wrong for pipelined and mass feedback runs.
+    The first such row of each run is unknown.
+    """
+    commanded = []
+    prev = None
+    for r in rows:
+        if isinstance(r.get('commanded_vol_ml'), float):
+            commanded.append(r['commanded_vol_ml'])
+        elif (prev is not None and
+            prev['run_start_timestamp'] == r['run_start_timestamp'] and
+            isinstance(prev.get('vol_correction'), float)):
+            commanded.append(r['target_vol'] + prev['vol_correction'])
+        else:
+            commanded.append(None)
+        prev = r
+    return commanded
+
+
+def _mean(xs):
+    return sum(xs) / len(xs)
+
+
+def _open_loop(row):
+    # Vials filled on the scale by mass feedback are recorded without a
+    # drip wait. Their volumes say nothing about the pump on its own.
+    return isinstance(row.get('drip_wait'), (int, float))
+
+
+def learn_drip_wait(rows, conservative_s, density_g_ml, tolerance_g=0.01,
+    min_samples=5):
+    """Returns shortest drip wait (s) that history suggests loses at most
+    tolerance_g relative to waiting conservative_s.
+
+    rows should already be filtered with matching_rows. Rows from mass
+    feedback runs (without a drip_wait) are skipped. Drip loss is estimated
+    from the fraction of the commanded volume that ended up in the vial. A wait
+    is only accepted if it and every longer wait with enough data are within
+    tolerance. Returns conservative_s if there is not enough data.
+    """
+    by_wait = dict()
+    for r, vol in zip(rows, commanded_volumes(rows)):
+        if (vol is None or vol <= 0 or not isinstance(r.get('pfo_g'), float)
+            or not _open_loop(r)):
+            continue
+        fraction = r['pfo_g'] / density_g_ml / vol
+        by_wait.setdefault(r['drip_wait'], []).append((fraction, vol))
+
+    baseline = []
+    for wait_s, samples in by_wait.items():
+        if wait_s >= conservative_s:
+            baseline.extend(samples)
+    if len(baseline) < min_samples:
+        return conservative_s
+    baseline_fraction = _mean([f for f, _ in baseline])
+
+    learned_s = conservative_s
+    for wait_s in sorted([w for w in by_wait if w < conservative_s],
+        reverse=True):
+
+        samples = by_wait[wait_s]
+        if len(samples) < min_samples:
+            continue
+        loss_g = _mean([(baseline_fraction - f) * v * density_g_ml
+            for f, v in samples])
+        if loss_g > tolerance_g:
+            break
+        learned_s = wait_s
+    return learned_s
+
+
+class AdaptiveDripWait(object):
+    """Shortens the drip wait while mass data says no liquid is being lost.
+
+    Every verify_every-th vial is a control, which gets the conservative wait.
+    Once there are `window` vials at the current (shorter) wait, and `window`
+    controls, their mean delivered fractions are compared. If the short wait
+    loses more than tolerance_g per vial, the wait goes back to conservative
+    and will not go that low again. Otherwise, it is shortened by `step`.
+    """
+    def __init__(self, conservative_s, target_mass_g, initial_s=None,
+        min_s=1.0, step=0.8, tolerance_g=0.01, verify_every=5, window=5):
+        self.conservative_s = conservative_s
+        self.target_mass_g = target_mass_g
+        self.current_s = conservative_s if initial_s is None else initial_s
+        self.min_s = min_s
+        self.step = step
+        self.tolerance_g = tolerance_g
+        self.verify_every = verify_every
+
+        self.floor_s = min_s
+        self.n = 0
+        self.control = deque(maxlen=window)
+        self.trial = deque(maxlen=window)
+
+    def next_wait(self):
+        """Returns drip wait (s) to use for the next vial.
+        """
+        self.n += 1
+        if (self.current_s >= self.conservative_s or
+            self.n % self.verify_every == 0):
+            return self.conservative_s
+        return self.current_s
+
+    def update(self, wait_s, vol_ml, mass_g, density_g_ml):
+        """Records the result of a vial filled with vol_ml then waited wait_s.
+        """
+        fraction = mass_g / density_g_ml / vol_ml
+        if wait_s >= self.conservative_s:
+            self.control.append(fraction)
+        elif wait_s == self.current_s:
+            self.trial.append(fraction)
+
+        if self.current_s >= self.conservative_s:
+            # Nothing to compare yet, so just try something shorter once there
+            # is a baseline.
+            if len(self.control) == self.control.maxlen:
+                self._shorten()
+            return
+
+        if (len(self.control) < self.control.maxlen or
+            len(self.trial) < self.trial.maxlen):
+            return
+
+        loss_g = (_mean(self.control) - _mean(self.trial)) * self.target_mass_g
+        if loss_g > self.tolerance_g:
+            print('Drip wait of {:.1f}s lost {:.3f}g. Going back to {:.1f}s.'
+                .format(self.current_s, loss_g, self.conservative_s))
+            self.floor_s = min(self.current_s / self.step, self.conservative_s)
+            self.current_s = self.conservative_s
+            self.trial.clear()
+        else:
+            self._shorten()
+
+    def _shorten(self):
+        shorter_s = max(self.current_s * self.step, self.floor_s, self.min_s)
+        if shorter_s < self.current_s:
+            self.current_s = shorter_s
+            self.trial.clear()
+            print('Trying drip wait of {:.1f}s'.format(self.current_s))
+
+
+# mL added to the target volume, if there is nothing better to go on.
+DEFAULT_CORRECTION_ML = 0.02
+
+
+def make_corrector(history, density_g_ml, correction_ml=None, filtered=True):
+    """Returns the volume correction to start a run with.
+
+    history: rows from previous runs, as from matching_rows. Rows from mass
+        feedback runs are ignored.
+    correction_ml: mL to add to the target volume to start. If None, estimated
+        from history (or DEFAULT_CORRECTION_ML, if there is too little).
+    filtered: if False, the correction stays the same for every vial.
+    """
+    if not filtered:
+        if correction_ml is None:
+            correction_ml = DEFAULT_CORRECTION_ML
+        return ConstantCorrection(correction_ml)
+    if correction_ml is not None:
+        return KalmanCorrection(initial_offset_ml=-correction_ml)
+    return KalmanCorrection.from_history(history, density_g_ml,
+        initial_offset_ml=-DEFAULT_CORRECTION_ML)
+
+
+class ConstantCorrection(object):
+    """Always adds the same volume correction (mL).
+    """
+    def __init__(self, correction_ml):
+        self.correction_ml = correction_ml
+
+    def correction(self):
+        return self.correction_ml
+
+    def update(self, commanded_ml, delivered_ml):
+        pass
+
+
+class KalmanCorrection(object):
+    """Estimates the systematic dispense offset (delivered - commanded, mL)
+    with a scalar Kalman filter, and corrects by the negative of it.
+
+    The offset is modelled as a random walk (process_var per vial), observed
+    with measurement_var noise (scale, drips, pump backlash). Observations
+    more than gate_sd standard deviations from the prediction are rejected as
+    outliers (e.g. a bad scale read), unless max_rejections of them happen in
+    a row, in which case the offset is assumed to have really changed and the
+    estimate is reset to the latest observation.
+    """
+    def __init__(self, initial_offset_ml=0.0, initial_var=0.01**2,
+        process_var=0.002**2, measurement_var=0.01**2, gate_sd=4.0,
+        max_rejections=3, max_correction_ml=0.2):
+        """
+        max_correction_ml: the correction is clipped to +/- this.
+        """
+        self.offset_ml = initial_offset_ml
+        self.var = initial_var
+        self.process_var = process_var
+        self.measurement_var = measurement_var
+        self.gate_sd = gate_sd
+        self.max_rejections = max_rejections
+        self.max_correction_ml = max_correction_ml
+        self.n_rejected_in_a_row = 0
+
+    @classmethod
+    def from_history(cls, rows, density_g_ml, n_recent=20, **kwargs):
+        """Returns a KalmanCorrection seeded from previous runs.
+
+        rows should already be filtered with matching_rows. Only rows from
+        open loop runs (not mass feedback) are used. If there are not at least
+        3 usable rows, kwargs alone are used (so initial_offset_ml can be
+        passed as a fallback).
+        """
+        offsets = []
+        for r, vol in zip(rows, commanded_volumes(rows)):
+            if (vol is None or not isinstance(r.get('pfo_g'), float) or
+                not _open_loop(r)):
+                continue
+            offsets.append(r['pfo_g'] / density_g_ml - vol)
+        offsets = offsets[-n_recent:]
+        if len(offsets) < 3:
+            return cls(**kwargs)
+
+        # Median, so old outliers don't throw off the seed either.
+        kwargs.pop('initial_offset_ml', None)
+        initial_offset_ml = sorted(offsets)[len(offsets) // 2]
+        mean = _mean(offsets)
+        var = sum((o - mean)**2 for o in offsets) / (len(offsets) - 1)
+        kwargs.setdefault('initial_var', var / len(offsets))
+        return cls(initial_offset_ml=initial_offset_ml, **kwargs)
+
+    def correction(self):
+        """Returns mL to add to the target volume for the next dispense.
+        """
+        return max(-self.max_correction_ml, min(self.max_correction_ml,
+            -self.offset_ml))
+
+    def update(self, commanded_ml, delivered_ml):
+        """Updates the estimate with one dispense. Returns False if rejected.
+        """
+        observed = delivered_ml - commanded_ml
+        predicted_var = self.var + self.process_var
+        innovation = observed - self.offset_ml
+        innovation_var = predicted_var + self.measurement_var
+
+        if innovation**2 > self.gate_sd**2 * innovation_var:
+            self.n_rejected_in_a_row += 1
+            if self.n_rejected_in_a_row < self.max_rejections:
+                print('Ignoring outlier dispense offset of {:.3f} mL '
+                    '(expected {:.3f})'.format(observed, self.offset_ml))
+                self.var = predicted_var
+                return False
+
+            print('Dispense offset seems to have changed. Resetting estimate.')
+            self.offset_ml = observed
+            self.var = self.measurement_var
+            self.n_rejected_in_a_row = 0
+            return True
+
+        self.n_rejected_in_a_row = 0
+        gain = predicted_var / innovation_var
+        self.offset_ml += gain * innovation
+        self.var = (1 - gain) * predicted_var
+        return True
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""
+Several vial boxes (racks) on the deck at once, used as one vial box, so one
+run can fill more vials than one box holds.
+
+    deck = Deck([('A', box_a), ('B', box_b)])
+    ijs = deck.stream(n_vials)
+    scheduler = DeckScheduler(SerialScheduler(workcell), deck, ijs)
+
+Column i of the deck is column i of the first rack, then the columns of the
+next rack, and so on, so (i, j) indices work as they do for one box. A run
+longer than the deck goes back to the first rack once the last is done, by
+which time the operator should have swapped the first for a rack of empty
+vials (see RackSwaps and scheduler.DeckScheduler).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import select
+import sys
+
+try:
+    input = raw_input
+except NameError:
+    pass
+
+
+class Deck(object):
+    """Racks (e.g. aliquot.ScintillationVialBox), presented as one vial box.
+    """
+    def __init__(self, racks):
+        """
+        racks: list of (name, vial box). Names label the racks in coord_label
+            (when there is more than one) and in messages to the operator.
+        """
+        if len(racks) == 0:
+            raise ValueError('need at least one rack')
+        self.names = [name for name, _ in racks]
+        self.racks = [rack for _, rack in racks]
+        # Deck column -> (rack index, column in rack)
+        self._columns = [(r, i) for r, rack in enumerate(self.racks)
+            for i in range(rack.n_cols)]
+        self.n_cols = len(self._columns)
+        self.n_rows = max(rack.n_rows for rack in self.racks)
+
+    # So the robot can be swapped for all racks at once (e.g. for
+    # motion_batch.MotionBatch, or benchmark.instrument).
+    @property
+    def robot(self):
+        return self.racks[0].robot
+
+    @robot.setter
+    def robot(self, robot):
+        for rack in self.racks:
+            rack.robot = robot
+
+    def _rack(self, i):
+        r, rack_i = self._columns[i]
+        return self.racks[r], rack_i
+
+    def rack_of(self, i):
+        """Returns the index of the rack deck column i is in.
+        """
+        return self._columns[i][0]
+
+    def rack_ijs(self, r):
+        """Returns deck (i, j) of every slot in rack r, in index order.
+        """
+        rack = self.racks[r]
+        first_i = [c for c, (rc, _) in enumerate(self._columns) if rc == r][0]
+        return [(first_i + k // rack.n_rows, k % rack.n_rows)
+            for k in range(rack.n_cols * rack.n_rows)]
+
+    @property
+    def n_slots(self):
+        return sum(rack.n_cols * rack.n_rows for rack in self.racks)
+
+    def anchor_center(self, i, j):
+        rack, rack_i = self._rack(i)
+        return rack.anchor_center(rack_i, j)
+
+    def approach_from(self, i, j):
+        """Returns the corner of slot (i, j)'s rack, to approach it from (see
+        workcell.Workcell), so backlash is the same for every slot in a rack.
+        """
+        rack, _ = self._rack(i)
+        return rack.anchor_center(0, 0)
+
+    def get_indices(self, i, j):
+        rack, rack_i = self._rack(i)
+        return rack.get_indices(rack_i, j)
+
+    def put_indices(self, i, j):
+        rack, rack_i = self._rack(i)
+        return rack.put_indices(rack_i, j)
+
+    def coord_label(self, i, j):
+        r, rack_i = self._columns[i]
+        letter, num = self.racks[r].coord_label(rack_i, j)
+        if len(self.racks) > 1:
+            letter = '{}:{}'.format(self.names[r], letter)
+        return letter, num
+
+    def rack_label(self, i, j):
+        """Returns slot (i, j)'s label within its rack (e.g. 'D3').
+        """
+        rack, rack_i = self._rack(i)
+        return '{}{}'.format(*rack.coord_label(rack_i, j))
+
+    def stream(self, n_vials, rack_order=None, rack_ijs=None):
+        """Returns (i, j) for each of n_vials vials: every slot of one rack,
+        then the next, going round the racks again (after they are swapped)
+        if n_vials is more than the deck holds.
+
+        rack_order: rack indices, in the order to fill them. Defaults to the
+            order given.
+        rack_ijs: rack index -> its slots, in the order to fill them (e.g.
+            planned with path_planner.plan). Defaults to rack_ijs(r).
+        """
+        if rack_order is None:
+            rack_order = list(range(len(self.racks)))
+        if rack_ijs is None:
+            rack_ijs = dict()
+        ijs = []
+        while len(ijs) < n_vials:
+            for r in rack_order:
+                ijs.extend(rack_ijs.get(r, None) or self.rack_ijs(r))
+        return [tuple(ij) for ij in ijs[:n_vials]]
+
+    def segments(self, vials):
+        """Splits vials ((n, i, j), in order) into runs in the same load of
+        the same rack (a slot coming up again means the rack was swapped).
+
+        Returns a list of (rack index, vials).
+        """
+        segments = []
+        slots = set()
+        for vial in vials:
+            r = self.rack_of(vial[1])
+            if (len(segments) == 0 or segments[-1][0] != r or
+                tuple(vial[1:]) in slots):
+                segments.append((r, []))
+                slots = set()
+            segments[-1][1].append(vial)
+            slots.add(tuple(vial[1:]))
+        return segments
+
+
+class RackSwaps(object):
+    """Racks that are done, waiting for the operator to swap them for racks of
+    empty vials, while the run goes on with the other racks.
+
+    The operator presses Enter once a rack is swapped (for the oldest rack
+    waiting). Lines typed while the robot is working are read after each
+    vial (poll), and only if none are left does wait block. Where stdin can't
+    be polled (Windows), they are all read by wait.
+
+    confirm: if not None, called with a rack's name when the run needs it,
+        and returns once it is swapped, instead of reading stdin (e.g. for
+        simulation).
+    """
+    def __init__(self, confirm=None):
+        self.confirm = confirm
+        self.pending = []
+
+    def request(self, name):
+        print('Rack {} is done. Swap it for a rack of empty vials and press '
+            'Enter.'.format(name))
+        self.pending.append(name)
+
+    def _confirmed(self):
+        name = self.pending.pop(0)
+        print('Rack {} swapped.'.format(name))
+
+    def poll(self):
+        """Takes any Enter presses so far as racks having been swapped.
+        """
+        if self.confirm is not None:
+            return
+        while len(self.pending) > 0:
+            try:
+                ready = select.select([sys.stdin], [], [], 0)[0]
+            except (select.error, OSError, ValueError):
+                # select only takes sockets on Windows (and stdin may not be
+                # a file at all). Presses are then only read by wait.
+                return
+            if not ready:
+                return
+            if len(sys.stdin.readline()) == 0:
+                # End of input (not a terminal). Left to wait to fail.
+                return
+            self._confirmed()
+
+    def wait(self, name):
+        """Returns once rack name is not waiting to be swapped: True if it
+        was, False if it wasn't.
+        """
+        if name not in self.pending:
+            return False
+        if self.confirm is not None:
+            self.confirm(name)
+            self.pending.remove(name)
+            print('Rack {} swapped.'.format(name))
+            return True
+        self.poll()
+        while name in self.pending:
+            input('Waiting for rack {} to be swapped (press Enter when it '
+                'is)... '.format(self.pending[0]))
+            self._confirmed()
+        return True
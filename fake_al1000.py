@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+"""
+A fake AL1000 syringe pump, speaking the basic mode serial protocol on a
+pseudo-terminal, so wpi_al1000.AL1000 can be run without the pump:
+
+    fake = FakeAL1000()
+    pump = wpi_al1000.AL1000(port=fake.port)
+
+Only implements the commands wpi_al1000 uses. POSIX only (needs a pty).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import re
+import select
+import threading
+import time
+import tty
+
+from wpi_al1000 import STX, ETX, ERROR_CODES
+
+
+_COMMAND = re.compile(r'^(\d*)([A-Z]{3})(.*)$')
+_NUMBER = re.compile(r'^(\d*\.?\d*)([A-Z]{2})?$')
+
+# What FakeAL1000.faults can make go wrong with a command. Any of
+# wpi_al1000.ERROR_CODES is also allowed, and is replied with instead of
+# carrying out the command.
+FAULTS = {
+    'drop': 'the command is carried out, but the reply is lost',
+    'no_etx': 'the reply is sent without its ETX',
+    'split': 'the reply is sent in two parts, SPLIT_S seconds apart'
+}
+SPLIT_S = 0.05
+
+
+def _format_number(num):
+    # Same as the pump: at most 4 digits and 3 after the decimal point.
+    return '{:.3f}'.format(num)[:5].rstrip('.')
+
+
+class FakeAL1000(object):
+    """Pump state, updated from the clock whenever a command comes in.
+
+    Args:
+        clock: provides time(). Should be the same clock the AL1000 object
+            using this pump is given.
+        on_deliver: called with mL each time liquid comes out of the pump
+            (e.g. simulation.SimulatedWorld.add_liquid, via a lambda)
+        capacity_ml: infusing past this stalls the motor (the '?S' alarm), as
+            at the end of a syringe. None for no limit.
+        power_on_alarm: if True, replies to the first command with the '?R'
+            (power interrupted) alarm, as the real pump does.
+        reply_delay_s: real seconds to wait before each reply.
+        faults: command mnemonic (e.g. 'RUN') -> what goes wrong with it
+            (see FAULTS), for testing how the driver copes. Can be changed at
+            any time.
+    """
+    def __init__(self, clock=time, on_deliver=None, capacity_ml=None,
+        diameter=26.59, address=0, power_on_alarm=False, reply_delay_s=0.0,
+        faults=None):
+
+        self.clock = clock
+        self.on_deliver = on_deliver
+        self.capacity_ml = capacity_ml
+        self.address = address
+        self.reply_delay_s = reply_delay_s
+        self.faults = dict() if faults is None else faults
+
+        self.diameter = diameter
+        # In the units implied by diameter (see volume_units).
+        self.rate = 1.0
+        self.rate_units = 'MM'
+        self.volume = 0.0
+        self.direction = 'INF'
+        # mL, since last CLD
+        self.infused_ml = 0.0
+        self.withdrawn_ml = 0.0
+        # mL in the syringe, for stall detection
+        self.total_infused_ml = 0.0
+
+        # One of wpi_al1000.PROMPTS
+        self.prompt = 'S'
+        self.alarm = '?R' if power_on_alarm else None
+        # For the phase currently running: clock time it (re)started, mL
+        # already pumped before that, and mL still to pump as of then.
+        self._phase_start = None
+        self._phase_done_ml = 0.0
+        self._phase_ml = 0.0
+
+        self.n_commands = 0
+
+        self._lock = threading.Lock()
+        self._master, slave = os.openpty()
+        tty.setraw(slave)
+        self._slave = slave
+        self.port = os.ttyname(slave)
+
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def volume_units(self):
+        return 'UL' if self.diameter <= 14.0 else 'ML'
+
+    def _to_ml(self, vol):
+        return vol / 1000.0 if self.volume_units() == 'UL' else vol
+
+    def _from_ml(self, ml):
+        return ml * 1000.0 if self.volume_units() == 'UL' else ml
+
+    def rate_ml_per_min(self):
+        rate = self.rate
+        if self.rate_units[0] == 'U':
+            rate = rate / 1000.0
+        if self.rate_units[1] == 'H':
+            rate = rate / 60.0
+        return rate
+
+    def _serve(self):
+        buf = b''
+        while not self._closed:
+            # Also wakes up periodically, so liquid comes out while nothing is
+            # talking to the pump.
+            readable, _, _ = select.select([self._master], [], [], 0.01)
+            with self._lock:
+                self._update()
+            if not readable:
+                continue
+            try:
+                buf += os.read(self._master, 1024)
+            except OSError:
+                return
+
+            while b'\r' in buf:
+                command, buf = buf.split(b'\r', 1)
+                command = command.decode('ascii')
+                if self.reply_delay_s > 0:
+                    time.sleep(self.reply_delay_s)
+                with self._lock:
+                    fault = self._fault(command)
+                    prompt, data = self._handle(command)
+                reply = STX + '{:02d}{}{}'.format(self.address, prompt,
+                    data).encode('ascii') + ETX
+                if fault == 'drop':
+                    continue
+                if fault == 'no_etx':
+                    reply = reply[:-1]
+                elif fault == 'split':
+                    half = len(reply) // 2
+                    os.write(self._master, reply[:half])
+                    time.sleep(SPLIT_S)
+                    reply = reply[half:]
+                os.write(self._master, reply)
+
+    def send_raw(self, data):
+        """Writes bytes to the port unprompted, as if from the pump (e.g. line
+        noise, or a reply that came too late).
+        """
+        os.write(self._master, data)
+
+    def _fault(self, command):
+        match = _COMMAND.match(command)
+        if match is None:
+            return None
+        return self.faults.get(match.group(2))
+
+    def _update(self):
+        """Advances a running phase to the current clock time.
+        """
+        if self.prompt not in ('I', 'W'):
+            return
+        elapsed_min = (self.clock.time() - self._phase_start) / 60.0
+        ml = min(self.rate_ml_per_min() * elapsed_min, self._phase_ml)
+        new_ml = ml - self._phase_done_ml
+
+        stalled = False
+        if (self.prompt == 'I' and self.capacity_ml is not None and
+            self.total_infused_ml + new_ml > self.capacity_ml):
+            new_ml = max(self.capacity_ml - self.total_infused_ml, 0.0)
+            stalled = True
+
+        self._phase_done_ml += new_ml
+        if self.prompt == 'I':
+            self.infused_ml += new_ml
+            self.total_infused_ml += new_ml
+            if self.on_deliver is not None and new_ml > 0:
+                self.on_deliver(new_ml)
+        else:
+            self.withdrawn_ml += new_ml
+            self.total_infused_ml = max(self.total_infused_ml - new_ml, 0.0)
+
+        if stalled:
+            self.prompt = 'A'
+            self.alarm = '?S'
+        elif self._phase_done_ml >= self._phase_ml:
+            self.prompt = 'S'
+
+    def _handle(self, command):
+        """Returns (prompt, data) to reply to command with.
+        """
+        self.n_commands += 1
+        self._update()
+
+        if self.alarm is not None:
+            # The alarm is reported once, then the pump is stopped.
+            alarm = self.alarm
+            self.alarm = None
+            self.prompt = 'S'
+            return 'A', alarm
+
+        match = _COMMAND.match(command)
+        if match is None:
+            return self.prompt, '?'
+        address, mnemonic, arg = match.groups()
+        if address != '' and int(address) != self.address:
+            return self.prompt, '?COM'
+
+        if self.faults.get(mnemonic) in ERROR_CODES:
+            return self.prompt, self.faults[mnemonic]
+
+        handler = getattr(self, '_' + mnemonic.lower(), None)
+        if handler is None:
+            return self.prompt, '?'
+        data = handler(arg)
+        return self.prompt, data
+
+    def _running(self):
+        return self.prompt in ('I', 'W', 'P')
+
+    def _parse(self, arg, units=()):
+        """Returns (number, units) from a command argument, or None if it is
+        not valid.
+        """
+        match = _NUMBER.match(arg)
+        if match is None or match.group(1) in ('', '.'):
+            return None
+        num, unit = match.groups()
+        if unit is not None and unit not in units:
+            return None
+        return float(num), unit
+
+    def _ver(self, arg):
+        return 'NE1000V3.928'
+
+    def _saf(self, arg):
+        return ''
+
+    def _fun(self, arg):
+        if arg not in ('', 'RAT'):
+            return '?'
+        return '' if arg else 'RAT'
+
+    def _dia(self, arg):
+        if arg == '':
+            return _format_number(self.diameter)
+        if self._running():
+            return '?NA'
+        parsed = self._parse(arg)
+        if parsed is None:
+            return '?'
+        if not 0.1 <= parsed[0] <= 50.0:
+            return '?OOR'
+        self.diameter = parsed[0]
+        return ''
+
+    def _rat(self, arg):
+        if arg == '':
+            return _format_number(self.rate) + self.rate_units
+        parsed = self._parse(arg, units=('UM', 'MM', 'UH', 'MH'))
+        if parsed is None:
+            return '?'
+        if self.prompt in ('I', 'W'):
+            # Changing rate mid-phase: account for what has been pumped so far.
+            self._update()
+            self._phase_ml -= self._phase_done_ml
+            self._phase_done_ml = 0.0
+            self._phase_start = self.clock.time()
+        self.rate = parsed[0]
+        if parsed[1] is not None:
+            self.rate_units = parsed[1]
+        return ''
+
+    def _vol(self, arg):
+        if arg == '':
+            return _format_number(self.volume) + self.volume_units()
+        if self._running():
+            return '?NA'
+        parsed = self._parse(arg)
+        if parsed is None:
+            return '?'
+        self.volume = parsed[0]
+        return ''
+
+    def _dir(self, arg):
+        if arg == '':
+            return self.direction
+        if arg == 'REV':
+            arg = 'WDR' if self.direction == 'INF' else 'INF'
+        if arg not in ('INF', 'WDR'):
+            return '?'
+        self.direction = arg
+        return ''
+
+    def _dis(self, arg):
+        return 'I{}W{}{}'.format(_format_number(self._from_ml(self.infused_ml)),
+            _format_number(self._from_ml(self.withdrawn_ml)),
+            self.volume_units())
+
+    def _cld(self, arg):
+        if self._running():
+            return '?NA'
+        if arg == 'INF':
+            self.infused_ml = 0.0
+        elif arg == 'WDR':
+            self.withdrawn_ml = 0.0
+        else:
+            return '?'
+        return ''
+
+    def _run(self, arg):
+        if self.prompt in ('I', 'W'):
+            return '?NA'
+        if self.prompt == 'P':
+            # Resumes the paused phase.
+            self._phase_ml -= self._phase_done_ml
+        else:
+            self._phase_ml = self._to_ml(self.volume)
+        self._phase_done_ml = 0.0
+        self._phase_start = self.clock.time()
+        self.prompt = 'I' if self.direction == 'INF' else 'W'
+        return ''
+
+    def _stp(self, arg):
+        if self.prompt in ('I', 'W'):
+            self.prompt = 'P'
+        elif self.prompt == 'P':
+            self.prompt = 'S'
+        return ''
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Dispenses by mass, with the vial sitting on the scale under the pump outlet:
+a coarse fraction at a high rate, then small pulses at a low rate, stopping
+each pulse early if the streamed weight says the target is about to be
+reached.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import time
+
+
+class MassFeedbackDispenser(object):
+    """
+    Args:
+        pump: a wpi_al1000.AL1000
+        scale: a weighing.StreamingScale, with the vial on it
+        density_g_ml: of the liquid being dispensed
+        target_g: mass of liquid to dispense
+        coarse_fraction: fraction of target_g (by nominal volume) to dispense
+            at coarse_rate, without looking at the scale
+        coarse_rate: mL/min. Defaults to whatever rate the pump is set to.
+        fine_rate: mL/min, for the pulses after the coarse phase
+        max_pulse_ml: largest single fine pulse
+        lag_s: how far behind the flow the scale readings are (scale
+            filtering + liquid in the air). A pulse is stopped once the reading
+            plus lag_s worth of flow reaches target_g.
+        tolerance_g: stop once within this much under target_g
+        max_pulses: error if still not within tolerance after this many
+        clock: provides time() and sleep(). Defaults to the time module.
+    """
+    def __init__(self, pump, scale, density_g_ml, target_g,
+        coarse_fraction=0.9, coarse_rate=None, fine_rate=0.2,
+        max_pulse_ml=0.05, lag_s=0.5, tolerance_g=0.005, max_pulses=20,
+        clock=time):
+
+        if not 0 < coarse_fraction < 1:
+            raise ValueError('coarse_fraction must be in (0, 1)')
+
+        self.pump = pump
+        self.scale = scale
+        self.density_g_ml = density_g_ml
+        self.target_g = target_g
+        self.coarse_fraction = coarse_fraction
+        self.coarse_rate = coarse_rate
+        self.fine_rate = fine_rate
+        self.max_pulse_ml = max_pulse_ml
+        self.lag_s = lag_s
+        self.tolerance_g = tolerance_g
+        self.max_pulses = max_pulses
+        self.clock = clock
+
+    def _start(self, ml):
+        if not self.pump.can_dispense(ml):
+            raise RuntimeError('not enough volume left in syringe')
+        return self.pump.dispense(ml, block=False)
+
+    def dispense(self, tare_g=None):
+        """Dispenses target_g of liquid onto the scale.
+
+        tare_g: weight with the empty vial on the scale. Read if not passed.
+
+        Returns dict with the stable weight after dispensing ('final_g'), the
+        total volume the pump dispensed ('vol_ml', counting pulses stopped
+        early only as far as they got), and the number of fine pulses.
+        """
+        start = self.clock.time()
+        if tare_g is None:
+            tare_g = self.scale.read_stable()
+        goal_g = tare_g + self.target_g
+
+        original_rate = self.pump.get_rate()
+        coarse_rate = self.coarse_rate
+        if coarse_rate is None:
+            coarse_rate = original_rate
+
+        coarse_ml = self.coarse_fraction * self.target_g / self.density_g_ml
+        self.pump.set_rate(coarse_rate, unit='MM')
+        handle = self._start(coarse_ml)
+        handle.wait()
+        vol_ml = handle.volume_dispensed
+        weight_g = self.scale.read_stable()
+
+        fine_g_s = self.fine_rate / 60.0 * self.density_g_ml
+        self.pump.set_rate(self.fine_rate, unit='MM')
+        n_pulses = 0
+        try:
+            while goal_g - weight_g > self.tolerance_g:
+                if n_pulses >= self.max_pulses:
+                    raise RuntimeError('still {:.3f}g short of target after '
+                        '{} pulses'.format(goal_g - weight_g, n_pulses))
+
+                pulse_ml = min(self.max_pulse_ml,
+                    (goal_g - weight_g) / self.density_g_ml)
+                handle = self._start(pulse_ml)
+                n_pulses += 1
+
+                while not handle.done():
+                    streamed_g = self.scale.read_immediate()
+                    if streamed_g + fine_g_s * self.lag_s >= goal_g:
+                        handle.cancel()
+                        break
+                # (raises if the pump alarmed)
+                handle.wait()
+                vol_ml += handle.volume_dispensed
+
+                weight_g = self.scale.read_stable()
+        finally:
+            self.pump.set_rate(original_rate, unit='MM')
+
+        print('Dispensed {:.3f}g (target {:.3f}g) with {} fine pulses in '
+            '{:.1f}s'.format(weight_g - tare_g, self.target_g, n_pulses,
+            self.clock.time() - start))
+
+        return {
+            'final_g': weight_g,
+            'vol_ml': vol_ml,
+            'n_pulses': n_pulses
+        }
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+How long MAPLE moves take, from the feed rates and acceleration in a
+Smoothieware config (by default, smoothie_config in this repository).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import math
+import os
+
+
+SMOOTHIE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'smoothie_config')
+
+
+def read_smoothie_config(path=SMOOTHIE_CONFIG):
+    """Returns dict of setting name -> str value from a Smoothieware config.
+    """
+    settings = dict()
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split('#', 1)[0].split()
+            if len(parts) >= 2:
+                settings[parts[0]] = parts[1]
+    return settings
+
+
+def move_time_s(distance, max_speed, acceleration):
+    """Returns seconds for a move from rest to rest, with a trapezoidal (or,
+    if too short to reach max_speed, triangular) velocity profile.
+    """
+    if distance <= 0:
+        return 0.0
+    if distance >= max_speed**2 / acceleration:
+        return distance / max_speed + max_speed / acceleration
+    return 2 * math.sqrt(distance / acceleration)
+
+
+class SmoothieMotion(object):
+    """How long XY and Z2 moves take, assuming each starts and ends at rest
+    (each MAPLE move waits for the last to finish).
+
+    Speeds are in mm/s, acceleration in mm/s^2. actuator_max_mm_s limits the
+    speed of each of the two CoreXY belts, which move dX + dY and dX - dY.
+    """
+    def __init__(self, xy_mm_s, z_mm_s, acceleration, actuator_max_mm_s=None,
+        corexy=True):
+        self.xy_mm_s = xy_mm_s
+        self.z_mm_s = z_mm_s
+        self.acceleration = acceleration
+        self.actuator_max_mm_s = actuator_max_mm_s
+        self.corexy = corexy
+
+    @classmethod
+    def from_config(cls, path=SMOOTHIE_CONFIG, z_axis='epsilon'):
+        """
+        z_axis: Smoothieware name of the Z2 actuator ('epsilon' is the B axis).
+        """
+        config = read_smoothie_config(path)
+        # mm/min -> mm/s
+        seek = float(config.get('default_seek_rate',
+            config['default_feed_rate'])) / 60.0
+        actuator_max = min(float(config['alpha_max_rate']),
+            float(config['beta_max_rate'])) / 60.0
+        z_max = float(config[z_axis + '_max_rate']) / 60.0
+        return cls(seek, min(seek, z_max), float(config['acceleration']),
+            actuator_max_mm_s=actuator_max,
+            corexy=config.get('arm_solution') == 'corexy')
+
+    def xy_time_s(self, start, end):
+        dx = end[0] - start[0]
+        dy = end[1] - start[1]
+        distance = math.sqrt(dx**2 + dy**2)
+        if distance == 0:
+            return 0.0
+
+        speed = self.xy_mm_s
+        if self.actuator_max_mm_s is not None:
+            if self.corexy:
+                fastest = max(abs(dx + dy), abs(dx - dy))
+            else:
+                fastest = max(abs(dx), abs(dy))
+            speed = min(speed, self.actuator_max_mm_s * distance / fastest)
+        return move_time_s(distance, speed, self.acceleration)
+
+    def z_time_s(self, start, end):
+        return move_time_s(abs(end - start), self.z_mm_s, self.acceleration)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""
+Sends a sequence of robot moves, gripper servo commands and dwells to the
+smoothie as one G-code stream, rather than as one synchronous command each.
+
+MAPLE's moveXY / moveZ2 / dwell_ms (and move_gripper_servo, via sendSyncCmd)
+each wait for the robot to stop before returning, so the smoothie's planner
+queue (planner_queue_size in smoothie_config) never holds more than one move,
+and every command costs a round trip on top of the motion. A MotionBatch
+stands in for the robot, and records those calls instead:
+
+    batch = MotionBatch(robot)
+    vialbox.robot = batch
+    vialbox.get_indices(i, j)
+    vialbox.robot = robot
+    batch.send(sync=True)
+
+send only waits for the smoothie to acknowledge each line ('ok'), which it
+does once the line is in its planner queue, so moves run back to back and
+whatever is sent next queues up behind them. Only sync (M400) waits for the
+robot to stop, which is needed before anything that depends on it being still
+(reading the scale, running the pump). The smoothie itself still waits for
+preceding moves to finish before M280 (servo) and G4 (dwell), so the gripper
+only opens and closes in place.
+
+Positions are sent as given, in smoothie coordinates (as the rest of this
+repository uses them), without anything else MAPLE's move methods may do.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import time
+
+import tracing
+
+
+# G-code axis letter for Z2 (the epsilon actuator in smoothie_config).
+Z2_AXIS = 'B'
+
+
+class MotionBatch(object):
+    """Records robot.moveXY, moveZ2, dwell_ms and smoothie.sendSyncCmd calls,
+    to send as one G-code stream.
+
+    Calling any other robot method first sends what has been recorded (so
+    calls still happen in order), then calls it as normal.
+
+    Args:
+        robot: a maple.robotutil.MAPLE (or simulation.SimulatedRobot)
+        port: the smoothie's serial port (a pyserial Serial), to stream to
+            directly, with up to max_outstanding lines not yet acknowledged.
+            If None, each line is sent with robot.smoothie.sendCmd, which
+            waits for the line's 'ok' before the next is sent.
+        max_outstanding: only needs to be small enough that the lines waiting
+            for room in the planner queue fit in the smoothie's serial receive
+            buffer.
+        timeout_s: seconds to wait for any reply before giving up. Replies to
+            M400, M280 and G4 only come once the robot has stopped.
+    """
+    def __init__(self, robot, port=None, max_outstanding=4, timeout_s=60.0):
+        self.robot = robot
+        self.port = port
+        self.max_outstanding = max_outstanding
+        self.timeout_s = timeout_s
+        self.smoothie = _RecordingSmoothie(self)
+        self.lines = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.robot, name)
+        if not callable(attr):
+            return attr
+
+        def flushed(*args, **kwargs):
+            self.send()
+            return attr(*args, **kwargs)
+        return flushed
+
+    def moveXY(self, xy):
+        self.lines.append('G0 X{:.3f} Y{:.3f}'.format(xy[0], xy[1]))
+
+    def moveZ2(self, z):
+        self.lines.append('G0 {}{:.3f}'.format(Z2_AXIS, z))
+
+    def dwell_ms(self, ms):
+        self.lines.append('G4 P{:d}'.format(int(round(ms))))
+
+    def command(self, cmd):
+        """Records a raw G-code line (e.g. 'M280 S4.3').
+        """
+        self.lines.append(cmd.strip())
+
+    def sync(self):
+        """Records a wait for the robot to stop (M400).
+        """
+        if len(self.lines) == 0 or self.lines[-1] != 'M400':
+            self.lines.append('M400')
+
+    def send(self, sync=False):
+        """Sends the lines recorded so far, returning once all are
+        acknowledged.
+
+        sync: if True, also waits for the robot to stop.
+        """
+        if sync:
+            self.sync()
+        lines = self.lines
+        self.lines = []
+        if len(lines) == 0:
+            return
+
+        with tracing.span('motion_batch', device='robot', lines=len(lines)):
+            if self.port is None:
+                smoothie = self.robot.smoothie
+                for line in lines:
+                    smoothie.sendCmd(line + '\n')
+            else:
+                self._stream(lines)
+
+    def _stream(self, lines):
+        outstanding = 0
+        for line in lines:
+            while outstanding >= self.max_outstanding:
+                self._read_ok()
+                outstanding -= 1
+            self.port.write((line + '\n').encode('ascii'))
+            outstanding += 1
+        while outstanding > 0:
+            self._read_ok()
+            outstanding -= 1
+
+    def _read_ok(self):
+        last_reply = time.time()
+        while True:
+            reply = self.port.readline().decode('ascii', 'replace').strip()
+            if reply.startswith('ok'):
+                return
+            if reply.startswith('error') or reply.startswith('!!'):
+                raise IOError('smoothie replied: {}'.format(reply))
+            if len(reply) > 0:
+                # Informational output (e.g. from M280) comes before the 'ok'.
+                last_reply = time.time()
+            elif time.time() - last_reply > self.timeout_s:
+                raise IOError('no reply from smoothie within {} '
+                    'seconds'.format(self.timeout_s))
+
+
+class _RecordingSmoothie(object):
+    def __init__(self, batch):
+        self._batch = batch
+
+    def sendSyncCmd(self, cmd):
+        self._batch.command(cmd)
+
+    sendCmd = sendSyncCmd
+
+    def __getattr__(self, name):
+        attr = getattr(self._batch.robot.smoothie, name)
+        if not callable(attr):
+            return attr
+
+        def flushed(*args, **kwargs):
+            self._batch.send()
+            return attr(*args, **kwargs)
+        return flushed
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+Plans the order vials are taken from the box in, and how each box slot is
+approached, to cut XY travel without making backlash any less consistent.
+
+Without a plan, the gripper moves to one corner of the box (approach_from)
+before every get and put, so that the last move onto a slot is always in +X
+and +Y. Approaching every slot from the same offset (APPROACH_OFFSET) instead
+makes that last move identical for every slot, without the detour. Then only
+the move from one vial's slot to the next depends on the order, which
+plan_order keeps short.
+
+    ijs, estimate = path_planner.plan(workcell, ijs)
+    path_planner.print_estimate(estimate)
+    workcell.approach_offset = path_planner.APPROACH_OFFSET
+
+Move times are from motion.SmoothieMotion (smoothie_config).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+from motion import SmoothieMotion
+
+
+# (dX, dY) of the last move onto each slot. Both positive, as when coming from
+# the approach_from corner, and with dX > dY so that both CoreXY belts (which
+# move dX + dY and dX - dY) also always finish moving the same way. Should be
+# more than the backlash.
+APPROACH_OFFSET = (6.0, 3.0)
+
+
+def approach_xy(xy, approach_offset):
+    return (xy[0] - approach_offset[0], xy[1] - approach_offset[1])
+
+
+def path_time_s(motion, points):
+    """Returns seconds to move through the XY points, stopping at each.
+    """
+    return sum(motion.xy_time_s(a, b) for a, b in zip(points[:-1], points[1:]))
+
+
+def box_path(vialbox, ijs, start_xy, station_xy, approach_from=None,
+    approach_offset=None):
+    """Returns the XY points the robot moves through to get each of ijs from
+    the box, take it to station_xy, and put it back, in order.
+
+    The rest of each cycle does not depend on the order or on how slots are
+    approached, so it is left out.
+
+    approach_from / approach_offset: as for workcell.Workcell
+    """
+    points = [start_xy]
+    for i, j in ijs:
+        xy = vialbox.anchor_center(i, j)
+        if approach_offset is None:
+            approach = approach_from
+            if callable(approach_from):
+                approach = approach_from(i, j)
+        else:
+            approach = approach_xy(xy, approach_offset)
+        points.extend([approach, xy, station_xy, approach, xy])
+    return points
+
+
+def _order_cost(first_s, move_s, order):
+    total = first_s[order[0]]
+    for a, b in zip(order[:-1], order[1:]):
+        total += move_s[a][b]
+    return total
+
+
+def plan_order(motion, slots, start_xy, approach_offset=APPROACH_OFFSET):
+    """Returns indices into slots (a list of XY), in the order to visit them.
+
+    Minimizes time moving from where each vial was put back to the next slot
+    (via its approach point), starting from start_xy: nearest neighbor, then
+    reversing sections of the order while that helps (2-opt).
+    """
+    n = len(slots)
+    if n == 0:
+        return []
+
+    def to_slot_s(xy, b):
+        approach = approach_xy(slots[b], approach_offset)
+        return (motion.xy_time_s(xy, approach) +
+            motion.xy_time_s(approach, slots[b]))
+
+    first_s = [to_slot_s(start_xy, b) for b in range(n)]
+    move_s = [[to_slot_s(slots[a], b) for b in range(n)] for a in range(n)]
+
+    order = [min(range(n), key=lambda b: first_s[b])]
+    left = set(range(n)) - set(order)
+    while left:
+        # Ties broken by index, so the plan is the same every time.
+        nearest = min(left, key=lambda b: (move_s[order[-1]][b], b))
+        order.append(nearest)
+        left.remove(nearest)
+
+    # The costs are not symmetric (approach points are all to one side), so
+    # each candidate is costed in full.
+    best = _order_cost(first_s, move_s, order)
+    improved = True
+    while improved:
+        improved = False
+        for start in range(n - 1):
+            for end in range(start + 2, n + 1):
+                candidate = (order[:start] + order[start:end][::-1] +
+                    order[end:])
+                cost = _order_cost(first_s, move_s, candidate)
+                if cost < best - 1e-9:
+                    order = candidate
+                    best = cost
+                    improved = True
+    return order
+
+
+def station_xy(workcell):
+    """Returns where vials go first after leaving the box: the scale, if there
+    is one, otherwise the first pump waypoint.
+    """
+    if workcell.scale is not None:
+        return workcell.scale_xy
+    return workcell.pump_xy_approach[0]
+
+
+def plan(workcell, ijs, approach_offset=APPROACH_OFFSET, motion=None,
+    start_xy=None):
+    """Returns (ijs reordered, estimate).
+
+    estimate is a dict of estimated seconds of XY travel near the box for
+    all the vials, both as before ('baseline_s': ijs in the order given, each
+    approached from workcell.approach_from) and as planned ('planned_s'), and
+    'saved_s', the difference. Assumes each vial goes to station_xy and back
+    (as with scheduler.SerialScheduler).
+
+    motion: a motion.SmoothieMotion. Defaults to one from smoothie_config.
+    start_xy: where the robot is before the first vial. Defaults to
+        workcell.approach_from (for the first of ijs).
+    """
+    if motion is None:
+        motion = SmoothieMotion.from_config()
+    if start_xy is None:
+        start_xy = workcell.approach_from
+        if callable(start_xy):
+            start_xy = start_xy(*ijs[0]) if len(ijs) > 0 else None
+    vialbox = workcell.vialbox
+    station = station_xy(workcell)
+
+    slots = [vialbox.anchor_center(i, j) for i, j in ijs]
+    planned = [ijs[k] for k in plan_order(motion, slots, start_xy,
+        approach_offset=approach_offset)]
+
+    baseline_s = path_time_s(motion, box_path(vialbox, ijs, start_xy,
+        station, approach_from=workcell.approach_from))
+    planned_s = path_time_s(motion, box_path(vialbox, planned, start_xy,
+        station, approach_offset=approach_offset))
+    estimate = {
+        'n_vials': len(ijs),
+        'baseline_s': baseline_s,
+        'planned_s': planned_s,
+        'saved_s': baseline_s - planned_s
+    }
+    return planned, estimate
+
+
+def plan_deck(workcell, ijs, approach_offset=APPROACH_OFFSET, motion=None):
+    """Returns (rack_ijs, estimate) for deck.Deck.stream, with workcell.vialbox
+    a deck.Deck: the slots in ijs in each rack, in the order from plan.
+
+    estimate is as from plan, summed over one load of every rack.
+    """
+    if motion is None:
+        motion = SmoothieMotion.from_config()
+    deck = workcell.vialbox
+    used = set(tuple(ij) for ij in ijs)
+    rack_ijs = dict()
+    estimate = {'n_vials': 0, 'baseline_s': 0.0, 'planned_s': 0.0,
+        'saved_s': 0.0}
+    for r in range(len(deck.racks)):
+        slots = [ij for ij in deck.rack_ijs(r) if ij in used]
+        if len(slots) == 0:
+            continue
+        rack_ijs[r], rack_estimate = plan(workcell, slots,
+            approach_offset=approach_offset, motion=motion)
+        for k in estimate:
+            estimate[k] += rack_estimate[k]
+    return rack_ijs, estimate
+
+
+def print_estimate(estimate):
+    n_vials = estimate['n_vials']
+    if n_vials == 0:
+        return
+    print('Estimated XY travel near the vial box: {:.0f}s via approach_from, '
+        '{:.0f}s as planned (saves {:.0f}s, {:.1f}s per vial)'.format(
+        estimate['baseline_s'], estimate['planned_s'], estimate['saved_s'],
+        estimate['saved_s'] / n_vials))
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+"""
+Settings for aliquot.py and batch.py, from aliquot_config.json (if it exists)
+over DEFAULTS:
+
+    {
+      "workcell": {"vialbox_offset": [751, -14.5]},
+      "run": {"target_vol_ml": 1.0, "n_aliquots": 42}
+    }
+
+'workcell' is where things are (positions in smoothie coordinates, serial
+ports). 'run' is what to do: aliquot.py uses it for its flags and for the
+defaults of its questions, and each job in a batch.py job list overrides it.
+
+Every value is checked against SCHEMA, and unknown keys are errors (so a typo
+can't silently leave a default in place).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import copy
+import json
+import os
+
+
+CONFIG_FILE = 'aliquot_config.json'
+
+DEFAULTS = {
+    'workcell': {
+        # None for MAPLE.cfg in the maple package
+        'robot_config': None,
+        'pump_port': '/dev/ttyUSB0',
+        'scale_port': '/dev/ttyUSB2',
+        # Z2, with 0 as home and positive going down
+        'vial_grip_height': 59.5,
+        # Just used for automatic return in module get_ / put_
+        'z2_to_worksurface': 118,
+        'vialbox_offset': [751, -14.5],
+        # Vial boxes on the deck, each
+        # {"name": "A", "offset": [x, y], "letters": ["D", "J"], "nums": [2, 9]}
+        # (letters and nums, the region used, default to the ones shown), or
+        # None for one at vialbox_offset. See deck.py.
+        'racks': None,
+        'pump_xy': [632, 179],
+        'pump_z': 22,
+        # None for what aliquot.py used (which depends on weigh_aliquots)
+        'pump_xy_approach': None,
+        # Z2 to release a vial at, on a platform under the pump outlet.
+        # TODO measure these once platforms exist
+        'pump_platform_z': None,
+        'staging_xy': None,
+        'staging_z': None,
+        'scale_xy': [632, 2],
+        # 23 would stick sometimes
+        'scale_z': 23,
+        # So box / scale can be picked up without the traveling part of the
+        # robot getting in the way.
+        'outoftheway_xy': [425, 0]
+    },
+    'run': {
+        # For batch.py output and progress
+        'name': None,
+        # In syringes.json
+        'liquid': 'pfo',
+        'syringe_cc': 60,
+        # None to assume from syringe_cc, as aliquot.py does
+        'syringe_family': None,
+        # mL in the syringe at the start. None for a full syringe.
+        'syringe_ml': None,
+        # mL/min. None for the fastest that shouldn't slip (syringes.py).
+        'rate': None,
+        'target_vol_ml': 2.0,
+        # mL added to the target. None to estimate from previous runs.
+        'vol_correction_ml': None,
+        # Vials to fill, in the slots the vial map has as present (see
+        # vial_map.py).
+        'n_aliquots': 20,
+        # Aliquot # to start from, to continue a box partly done before there
+        # was a vial map. Slots before it are marked skipped, and the run
+        # ends at aliquot #n_aliquots - 1, as it used to.
+        'first_aliquot': 0,
+        # Vials whose volume (from mass) is further than this from
+        # target_vol_ml are marked failed in the vial map. None to not check.
+        'fill_tolerance_ml': None,
+        # Whether to fill the vials marked failed again (after emptying them).
+        'retry_failed': False,
+        # None for workcell.vialbox_offset (a different box on the deck)
+        'vialbox_offset': None,
+        # None for workcell.racks
+        'racks': None,
+        # Whether to go back to each rack, once swapped for one of empty
+        # vials, if n_aliquots is more than the racks hold.
+        'swap_racks': False,
+        'drop_wait_s': 20,
+        'weigh_aliquots': True,
+        'filter_correction': True,
+        'adaptive_drip_wait': False,
+        'mass_feedback': False,
+        'plan_path': False,
+        'batch_moves': False,
+        'vial_type': 'scintillation',
+        # aliquot.py only (batch.py runs every job serially, untimed)
+        'pipelined': False,
+        'report_timing': False,
+        'trace': False,
+        'calibrate_gripper': False
+    }
+}
+
+
+# The region of a rack used, if not given.
+RACK_DEFAULTS = {
+    'letters': ['D', 'J'],
+    'nums': [2, 9]
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+def _xy(x):
+    return isinstance(x, (list, tuple)) and len(x) == 2 and all(
+        _number(v) for v in x)
+
+
+def _str(x):
+    return isinstance(x, str) or type(x).__name__ == 'unicode'
+
+
+def _rack(x):
+    if not isinstance(x, dict) or not set(x) <= set(RACK_DEFAULTS) | set(
+        ['name', 'offset']):
+        return False
+    if not _str(x.get('name')) or not _xy(x.get('offset')):
+        return False
+    letters = x.get('letters', RACK_DEFAULTS['letters'])
+    nums = x.get('nums', RACK_DEFAULTS['nums'])
+    return (isinstance(letters, list) and len(letters) == 2 and
+        all(_str(v) and len(v) == 1 for v in letters) and
+        letters[0] <= letters[1] and
+        isinstance(nums, list) and len(nums) == 2 and
+        all(isinstance(v, int) and not isinstance(v, bool) for v in nums) and
+        nums[0] <= nums[1])
+
+
+# (check, description) for each type name in SCHEMA.
+_TYPES = {
+    'number': (_number, 'a number'),
+    'positive': (lambda x: _number(x) and x > 0, 'a positive number'),
+    'count': (lambda x: isinstance(x, int) and not isinstance(x, bool) and
+        x >= 0, 'a non-negative integer'),
+    'bool': (lambda x: isinstance(x, bool), 'true or false'),
+    'str': (_str, 'a string'),
+    'xy': (_xy, 'an [x, y] pair'),
+    'xy_list': (lambda x: isinstance(x, list) and all(_xy(v) for v in x),
+        'a list of [x, y] pairs'),
+    'racks': (lambda x: isinstance(x, list) and len(x) > 0 and
+        all(_rack(v) for v in x) and
+        len(set(v['name'] for v in x)) == len(x),
+        'a list of racks with different names, each {"name": ..., '
+        '"offset": [x, y]} and optionally "letters": [first, last] and '
+        '"nums": [first, last]')
+}
+
+# Key -> type name in _TYPES. A trailing '?' means None is also allowed.
+SCHEMA = {
+    'workcell': {
+        'robot_config': 'str?',
+        'pump_port': 'str',
+        'scale_port': 'str',
+        'vial_grip_height': 'number',
+        'z2_to_worksurface': 'number',
+        'vialbox_offset': 'xy',
+        'racks': 'racks?',
+        'pump_xy': 'xy',
+        'pump_z': 'number',
+        'pump_xy_approach': 'xy_list?',
+        'pump_platform_z': 'number?',
+        'staging_xy': 'xy?',
+        'staging_z': 'number?',
+        'scale_xy': 'xy',
+        'scale_z': 'number',
+        'outoftheway_xy': 'xy'
+    },
+    'run': {
+        'name': 'str?',
+        'liquid': 'str',
+        'syringe_cc': 'positive',
+        'syringe_family': 'str?',
+        'syringe_ml': 'positive?',
+        'rate': 'positive?',
+        'target_vol_ml': 'positive',
+        'vol_correction_ml': 'number?',
+        'n_aliquots': 'count',
+        'first_aliquot': 'count',
+        'fill_tolerance_ml': 'positive?',
+        'retry_failed': 'bool',
+        'vialbox_offset': 'xy?',
+        'racks': 'racks?',
+        'swap_racks': 'bool',
+        'drop_wait_s': 'number',
+        'weigh_aliquots': 'bool',
+        'filter_correction': 'bool',
+        'adaptive_drip_wait': 'bool',
+        'mass_feedback': 'bool',
+        'plan_path': 'bool',
+        'batch_moves': 'bool',
+        'vial_type': 'str',
+        'pipelined': 'bool',
+        'report_timing': 'bool',
+        'trace': 'bool',
+        'calibrate_gripper': 'bool'
+    }
+}
+
+
+def _check_section(section, values, where):
+    errors = []
+    schema = SCHEMA[section]
+    for key in sorted(values):
+        if key not in schema:
+            errors.append('{}: unknown key {!r}'.format(where, key))
+            continue
+        type_name = schema[key]
+        value = values[key]
+        if type_name.endswith('?'):
+            if value is None:
+                continue
+            type_name = type_name[:-1]
+        check, description = _TYPES[type_name]
+        if not check(value):
+            errors.append('{}.{}: expected {}, got {!r}'.format(where, key,
+                description, value))
+    return errors
+
+
+def validate(config, where='config'):
+    """Raises ConfigError listing everything wrong with config (a dict with
+    'workcell' and / or 'run' sections).
+    """
+    if not isinstance(config, dict):
+        raise ConfigError('{}: expected an object'.format(where))
+    errors = []
+    for section in sorted(config):
+        if section not in SCHEMA:
+            errors.append('{}: unknown section {!r}'.format(where, section))
+        elif not isinstance(config[section], dict):
+            errors.append('{}.{}: expected an object'.format(where, section))
+        else:
+            errors.extend(_check_section(section, config[section],
+                '{}.{}'.format(where, section)))
+    if errors:
+        raise ConfigError('\n'.join(errors))
+
+
+def load(path=CONFIG_FILE):
+    """Returns DEFAULTS, updated from the JSON file at path if it exists.
+    """
+    config = copy.deepcopy(DEFAULTS)
+    if path is None or not os.path.exists(path):
+        return config
+    with open(path, 'r') as f:
+        overrides = json.load(f)
+    validate(overrides, where=path)
+    for section, values in overrides.items():
+        config[section].update(values)
+    return config
+
+
+def job_settings(config, job, where='job'):
+    """Returns the 'run' section of config, updated from job (a dict of 'run'
+    keys).
+    """
+    validate({'run': job}, where=where)
+    settings = dict(config['run'])
+    settings.update(job)
+    return settings
+
+
+def syringe_family(settings):
+    """Returns settings['syringe_family'], or the family aliquot.py assumes
+    for settings['syringe_cc'] (None if it doesn't assume one).
+    """
+    if settings['syringe_family'] is not None:
+        return settings['syringe_family']
+    return {60: 'B-D', 20: 'NORM-JECT'}.get(settings['syringe_cc'])
+
+
+def pump_xy_approach(workcell_config, weigh_aliquots=True):
+    """Returns workcell_config['pump_xy_approach'], or the waypoints
+    aliquot.py has used to get to the pump (from the scale, or the box).
+    """
+    if workcell_config['pump_xy_approach'] is not None:
+        return [tuple(xy) for xy in workcell_config['pump_xy_approach']]
+    pump_x = workcell_config['pump_xy'][0]
+    if weigh_aliquots:
+        return [(pump_x, 160)]
+    return [(660, 160), (pump_x, 160)]
+
+
+def racks(workcell_config, settings):
+    """Returns the racks for a run (see DEFAULTS), with every key set.
+    """
+    racks = settings['racks']
+    if racks is None:
+        racks = workcell_config['racks']
+    if racks is None:
+        offset = settings['vialbox_offset']
+        if offset is None:
+            offset = workcell_config['vialbox_offset']
+        racks = [{'name': 'A', 'offset': offset}]
+    elif settings['vialbox_offset'] is not None:
+        raise ConfigError('vialbox_offset can not be used with racks (set '
+            'the offsets of the racks instead)')
+    full = []
+    for rack in racks:
+        rack_config = dict(RACK_DEFAULTS)
+        rack_config.update(rack)
+        full.append(rack_config)
+    return full
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""
+Stores the data aliquot.py records for each vial (one row per vial, the same
+columns aliquot_masses.csv had) in an SQLite database, indexed by run and by
+syringe / target volume / rate, so calibration can look up matching rows
+without reading every run ever done.
+
+    store = run_data.RunData(import_csv='aliquot_masses.csv')
+    store.add(run_start_timestamp=..., n=0, ...)
+    rows = store.matching_rows(60, 'B-D', 1.2, 2.0)
+
+Rows are returned as dicts, in the order they were added, as
+calibration.load_history returns them. From the command line, exports the
+database to CSV (or imports a CSV into it):
+
+    ./run_data.py --export aliquot_masses.csv
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import csv
+import os
+import sqlite3
+
+
+RUN_DATA_DB = 'aliquot_data.db'
+
+# (name, SQLite type), in CSV column order. Columns added after the first
+# schema version are at the end, in the order MIGRATIONS added them.
+COLUMNS = [
+    ('run_start_timestamp', 'TEXT'),
+    ('n', 'INTEGER'),
+    ('col', 'TEXT'),
+    ('row', 'INTEGER'),
+    ('empty_vial_g', 'REAL'),
+    ('pfo_g', 'REAL'),
+    ('target_vol', 'REAL'),
+    ('syringe_cc', 'REAL'),
+    ('syringe_family', 'TEXT'),
+    ('rate', 'REAL'),
+    ('vol_correction', 'REAL'),
+    ('drip_wait', 'REAL'),
+    ('start_syringe_vol', 'REAL'),
+    ('vol_from_mass', 'REAL'),
+    ('num_this_run', 'INTEGER'),
+    ('time_taken', 'REAL'),
+    # The volume the vial was filled with (what the pump was told to
+    # dispense, or for mass feedback, what it did). NULL for rows from before
+    # it was recorded (see calibration.commanded_volumes).
+    ('commanded_vol_ml', 'REAL')
+]
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+
+# MIGRATIONS[v] takes a database from schema version v to v + 1. The version
+# is kept in SQLite's user_version. Only ever append to this.
+MIGRATIONS = [
+    [
+        'CREATE TABLE aliquots (id INTEGER PRIMARY KEY, {})'.format(
+            ', '.join('{} {}'.format(n, t) for n, t in COLUMNS[:16])),
+        'CREATE INDEX aliquots_run ON aliquots (run_start_timestamp)',
+        'CREATE INDEX aliquots_params ON aliquots '
+            '(syringe_cc, syringe_family, target_vol, rate)'
+    ],
+    [
+        'ALTER TABLE aliquots ADD COLUMN commanded_vol_ml REAL'
+    ]
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def _from_csv_value(value):
+    # As written by aliquot.py, which formatted missing values as None.
+    if value is None or value == '' or value == 'None' or value == 'nan':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class RunData(object):
+    """The run-data database at path, created (and brought up to the current
+    SCHEMA_VERSION) if needed. The connection stays open until close.
+
+    import_csv: if the database is new, rows from this CSV (as aliquot.py
+        used to write) are imported, if it exists.
+    """
+    def __init__(self, path=RUN_DATA_DB, import_csv=None):
+        self.path = path
+        is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        # Each add is one small append, which WAL makes cheap to commit.
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self._migrate()
+        if is_new and import_csv is not None and os.path.exists(import_csv):
+            n_rows = self.import_csv(import_csv)
+            print('Imported {} rows from {} into {}'.format(n_rows,
+                import_csv, path))
+
+    def _migrate(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError('{} has schema version {}, newer than this code '
+                '({})'.format(self.path, version, SCHEMA_VERSION))
+        for v in range(version, SCHEMA_VERSION):
+            with self.conn:
+                for statement in MIGRATIONS[v]:
+                    self.conn.execute(statement)
+                self.conn.execute('PRAGMA user_version = {:d}'.format(v + 1))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _insert(self, rows):
+        for row in rows:
+            unknown = set(row) - set(COLUMN_NAMES)
+            if unknown:
+                raise ValueError('unknown columns: {}'.format(
+                    ', '.join(sorted(unknown))))
+        self.conn.executemany('INSERT INTO aliquots ({}) VALUES ({})'.format(
+            ', '.join(COLUMN_NAMES), ', '.join(['?'] * len(COLUMN_NAMES))),
+            [[row.get(name) for name in COLUMN_NAMES] for row in rows])
+
+    def add(self, **row):
+        """Adds the row for one vial, and commits it.
+
+        Keyword arguments are COLUMN_NAMES. Missing ones are stored as NULL.
+        """
+        with self.conn:
+            self._insert([row])
+
+    def _select(self, where='', args=()):
+        cursor = self.conn.execute('SELECT {} FROM aliquots {} '
+            'ORDER BY id'.format(', '.join(COLUMN_NAMES), where), args)
+        return [dict(zip(COLUMN_NAMES, r)) for r in cursor]
+
+    def rows(self):
+        """Returns all rows.
+        """
+        return self._select()
+
+    def run_rows(self, run_start_timestamp):
+        """Returns the rows for one run.
+        """
+        return self._select('WHERE run_start_timestamp = ?',
+            (str(run_start_timestamp),))
+
+    def columns(self, run_start_timestamp=None):
+        """Returns dict of column name -> list of values, for all rows (or
+        those for one run), in order. Quicker than rows, for many rows.
+        """
+        where = ''
+        args = ()
+        if run_start_timestamp is not None:
+            where = 'WHERE run_start_timestamp = ?'
+            args = (str(run_start_timestamp),)
+        cursor = self.conn.execute('SELECT {} FROM aliquots {} '
+            'ORDER BY id'.format(', '.join(COLUMN_NAMES), where), args)
+        # Tuples, rather than sqlite3.Row, so zip can transpose them.
+        cursor.row_factory = None
+        values = list(zip(*cursor.fetchall()))
+        if len(values) == 0:
+            values = [()] * len(COLUMN_NAMES)
+        return dict((name, list(v)) for name, v in zip(COLUMN_NAMES, values))
+
+    def matching_rows(self, syringe_cc, syringe_family, rate, target_vol,
+        rate_tolerance=0.001):
+        """Returns rows from runs with the same syringe, rate and target
+        volume, as calibration.matching_rows does.
+        """
+        return self._select('WHERE syringe_cc = ? AND syringe_family = ? AND '
+            'target_vol = ? AND rate BETWEEN ? AND ?', (syringe_cc,
+            syringe_family, target_vol, rate - rate_tolerance,
+            rate + rate_tolerance))
+
+    def import_csv(self, csv_file):
+        """Adds the rows of a CSV with (a subset of) COLUMN_NAMES as its
+        header. Returns the number of rows added.
+        """
+        with open(csv_file, 'r') as f:
+            rows = [dict((k, _from_csv_value(v)) for k, v in r.items()
+                if k in COLUMN_NAMES)
+                for r in csv.DictReader(f, skipinitialspace=True)]
+        with self.conn:
+            self._insert(rows)
+        return len(rows)
+
+    def export_csv(self, csv_file):
+        """Writes all rows to csv_file, readable by calibration.load_history.
+        Returns the number of rows written.
+        """
+        rows = self.rows()
+        with open(csv_file, 'w') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(COLUMN_NAMES)
+            for row in rows:
+                writer.writerow(['' if row[name] is None else row[name]
+                    for name in COLUMN_NAMES])
+        return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=RUN_DATA_DB,
+        help='(default: %(default)s)')
+    parser.add_argument('--export', metavar='CSV')
+    parser.add_argument('--import', dest='import_csv', metavar='CSV')
+    args = parser.parse_args()
+
+    if args.export is None and args.import_csv is None:
+        parser.error('nothing to do (pass --export and / or --import)')
+
+    with RunData(args.db) as store:
+        if args.import_csv is not None:
+            print('Imported {} rows'.format(store.import_csv(args.import_csv)))
+        if args.export is not None:
+            print('Exported {} rows'.format(store.export_csv(args.export)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+What happens after each vial is done (the scheduler's on_done), for both
+aliquot.py and batch.py: the volume correction (and drip wait, if adaptive)
+are updated from the vial's mass, and a row is added to the run data.
+
+    recorder = RunRecorder(vialbox, corrector, target_vol_ml, density_g_ml,
+        store=store, run_info=run_info, pump=pump)
+    scheduler.run(vials, recorder.get_volume, recorder.on_done)
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import time
+
+
+class RunRecorder(object):
+    """
+    store: a run_data.RunData, or None if aliquots aren't weighed.
+    run_info: columns that are the same for every row of this run
+        (run_start_timestamp, syringe_cc, syringe_family, rate).
+    drip_waiter: a calibration.AdaptiveDripWait, to update from each mass.
+    journal: a run_state.RunJournal, to save the correction in along with
+        each vial being done.
+    vial_map: a vial_map.VialMap, to mark each vial's slot filled or failed
+        in.
+    fill_tolerance_ml: if not None, vials whose volume (from mass) is further
+        than this from target_vol_ml are marked failed.
+    """
+    def __init__(self, vialbox, corrector, target_vol_ml, density_g_ml,
+        store=None, run_info=None, drip_waiter=None, journal=None, pump=None,
+        num_this_run=0, vial_map=None, fill_tolerance_ml=None, clock=time):
+        self.vialbox = vialbox
+        self.corrector = corrector
+        self.target_vol_ml = target_vol_ml
+        self.density_g_ml = density_g_ml
+        self.target_mass = target_vol_ml * density_g_ml
+        self.store = store
+        self.run_info = run_info if run_info is not None else dict()
+        self.drip_waiter = drip_waiter
+        self.journal = journal
+        self.pump = pump
+        self.num_this_run = num_this_run
+        self.vial_map = vial_map
+        self.fill_tolerance_ml = fill_tolerance_ml
+        self.clock = clock
+
+        self.cv = corrector.correction()
+        self.vol_ml = target_vol_ml + self.cv
+        self.last_time = clock.time()
+
+    def get_volume(self):
+        return self.vol_ml
+
+    def on_done(self, result):
+        """Updates the volume correction and saves data for one vial.
+        """
+        n = result['n']
+        col_letter, row_num = self.vialbox.coord_label(result['i'],
+            result['j'])
+
+        # What was in the syringe before this vial (by the pump's ledger).
+        # Unknown if the vial's fill on the scale was interrupted, before
+        # it could say how much it dispensed.
+        curr_syringe_vol = None
+        if result['vol_ml'] is not None:
+            curr_syringe_vol = self.pump.ledger.left_ml + result['vol_ml']
+
+        # Its mass (if any) says nothing about the dispense volume.
+        weighed = self.store is not None and not result['interrupted_dispense']
+        if result['interrupted_dispense']:
+            print('Dispensing into aliquot #{} ({}{}) was interrupted. Check '
+                'its volume.'.format(n, col_letter, row_num))
+
+        if weighed:
+            empty_vial_g = result['empty_vial_g']
+            print('empty vial weight:', empty_vial_g)
+
+            full_vial_g = result['full_vial_g']
+            pfo_g = full_vial_g - empty_vial_g
+            print('pfo weight: {} g'.format(pfo_g))
+
+            # TODO set err thresh based on some relative deviation from expected
+            # mass, given density of pfo? (and like print the list of those that
+            # passed?)
+
+            vol_from_mass = pfo_g / self.density_g_ml
+            mass_err = self.target_mass - pfo_g
+            # Using the volume this vial was actually commanded, which (when
+            # pipelining) may not have included the latest correction.
+            self.corrector.update(result['vol_ml'], vol_from_mass)
+            self.cv = self.corrector.correction()
+            self.vol_ml = self.target_vol_ml + self.cv
+            # TODO probably delete these prints
+            print('pfo vol from mass: {:.2f} mL'.format(vol_from_mass))
+            print('mass_err: {:.2f}'.format(mass_err))
+            print('using new vol correction of: {:.2f}'.format(self.cv))
+            print('new commanded volume: {:.2f}'.format(self.vol_ml))
+            #
+
+            if self.drip_waiter is not None:
+                self.drip_waiter.update(result['drip_wait_s'],
+                    result['vol_ml'], pfo_g, self.density_g_ml)
+
+        curr_time = self.clock.time()
+        time_taken = curr_time - self.last_time
+        self.last_time = curr_time
+
+        if weighed:
+            row = dict(self.run_info)
+            row.update(n=n, col=col_letter, row=row_num,
+                empty_vial_g=empty_vial_g, pfo_g=pfo_g,
+                target_vol=self.target_vol_ml, vol_correction=self.cv,
+                drip_wait=result['drip_wait_s'],
+                start_syringe_vol=curr_syringe_vol,
+                vol_from_mass=vol_from_mass, num_this_run=self.num_this_run,
+                time_taken=time_taken, commanded_vol_ml=result['vol_ml'])
+            self.store.add(**row)
+
+        if self.vial_map is not None:
+            fields = {'n': n}
+            failed = result['interrupted_dispense']
+            if weighed:
+                fields.update(empty_vial_g=empty_vial_g,
+                    full_vial_g=full_vial_g)
+                if (self.fill_tolerance_ml is not None and
+                    abs(vol_from_mass - self.target_vol_ml) >
+                    self.fill_tolerance_ml):
+                    print('Aliquot #{} ({}{}) is {:.2f} mL off target. '
+                        'Marking it failed.'.format(n, col_letter, row_num,
+                        vol_from_mass - self.target_vol_ml))
+                    failed = True
+            self.vial_map.set(result['i'], result['j'],
+                'failed' if failed else 'filled', **fields)
+
+        self.num_this_run += 1
+        if self.journal is not None:
+            # Written along with this vial being done, by the scheduler.
+            self.journal.state.update(corrector=vars(self.corrector),
+                num_this_run=self.num_this_run)
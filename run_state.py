@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+A journal of where an aliquoting run is, so it can pick up where it left off
+after a crash or power loss: which vials are done, what the current vial has
+been through (see scheduler.SerialScheduler), and the volume correction.
+(What is left in the syringe is kept by syringes.SyringeLedger.)
+
+Each update rewrites the whole (small) JSON file: to a temporary file, which
+is fsync'd and then renamed over the old one, so the file on disk is always
+either the old state or the new one.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import json
+import os
+import time
+
+
+RUN_STATE_FILE = 'run_state.json'
+
+
+def write_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    # Atomic on POSIX, so a crash leaves either the old or the new file.
+    os.rename(tmp_path, path)
+    # So the rename itself survives a power loss.
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class RunJournal(object):
+    """The state of one run, written to path on every update.
+
+    state['status'] is 'running' until finish is called, so a file that is
+    still 'running' at startup means the run was interrupted.
+    """
+    def __init__(self, path=RUN_STATE_FILE, state=None):
+        self.path = path
+        self.state = state if state is not None else {'status': 'running'}
+        self.n_writes = 0
+
+    @classmethod
+    def load(cls, path=RUN_STATE_FILE):
+        """Returns the journal saved at path, or None if there is none.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return cls(path, state=json.load(f))
+
+    @classmethod
+    def interrupted(cls, path=RUN_STATE_FILE):
+        """Returns the journal at path if its run never finished, else None.
+        """
+        journal = cls.load(path)
+        if journal is None or journal.state.get('status') != 'running':
+            return None
+        return journal
+
+    def update(self, **fields):
+        """Sets fields in the state, and writes it.
+        """
+        self.state.update(fields)
+        self.state['updated'] = time.time()
+        write_atomic(self.path, json.dumps(self.state, indent=2,
+            sort_keys=True))
+        self.n_writes += 1
+
+    def finish(self):
+        """Records that the run completed, so it is not resumed.
+        """
+        self.update(status='done', vial=None)
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+
+"""
+Sequences the operations in workcell.Workcell over many vials, either one vial
+at a time, or pipelined so the gantry moves other vials while one is being
+filled or weighed.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import threading
+
+import tracing
+from workcell import PhaseTimer, grip_vial, release_vial
+
+
+def _new_result(clock, n, i, j, timer):
+    return {
+        'n': n,
+        'i': i,
+        'j': j,
+        'vol_ml': None,
+        'drip_wait_s': None,
+        'empty_vial_g': None,
+        'full_vial_g': None,
+        # Whether a dispense into this vial was cut short by the run being
+        # interrupted (see SerialScheduler.run).
+        'interrupted_dispense': False,
+        'start_time': clock.time(),
+        'end_time': None,
+        # Phase name (e.g. 'fetch', 'pump') -> seconds
+        'phase_times': timer.times
+    }
+
+
+def throughput_vials_per_hour(results):
+    """Returns vials/hour over the span of results (dicts from a scheduler).
+    """
+    if len(results) == 0:
+        return None
+    start = min(r['start_time'] for r in results)
+    end = max(r['end_time'] for r in results)
+    if end <= start:
+        return None
+    return len(results) / ((end - start) / 3600.0)
+
+
+def print_throughput(results):
+    rate = throughput_vials_per_hour(results)
+    if rate is None:
+        return
+    elapsed_s = (max(r['end_time'] for r in results) -
+        min(r['start_time'] for r in results))
+    print('{} vials in {:.1f} minutes ({:.1f} vials/hour)'.format(
+        len(results), elapsed_s / 60.0, rate))
+
+
+# Phases that pick up or set down the vial, so if one is interrupted, whether
+# the gripper is still holding the vial has to be checked.
+GRIP_CHANGING_PHASES = ('fetch', 'weigh_empty', 'fill_on_scale', 'weigh_full',
+    'put_back')
+
+
+class SerialScheduler(object):
+    """Takes each vial through the whole cycle before starting the next.
+
+    The vial is held under the pump while it is filled, or, if the workcell
+    has a mass feedback dispenser, set down on the scale (under the pump) and
+    filled there.
+
+    journal: a run_state.RunJournal. If not None, the current vial's progress
+        (phases done, the phase in progress, measurements so far, and whether
+        the gripper is holding it) is written to it at every phase boundary,
+        as 'vial', so an interrupted run can be resumed (see run).
+    """
+    def __init__(self, workcell, journal=None):
+        self.workcell = workcell
+        self.journal = journal
+
+    def run(self, vials, get_volume, on_done, get_drip_wait=None,
+        resume=None):
+        """Aliquots into each vial, returning a list of result dicts.
+
+        vials: iterable of (n, i, j), where (i, j) are vial box indices.
+        get_volume: called with no arguments to get the volume (mL) to
+            dispense, right before each dispense.
+        on_done: called with the result dict for each vial, once it is back
+            in the box. If the run is interrupted right after, it may be
+            called again for the same vial when resumed.
+        get_drip_wait: called like get_volume, to get seconds to wait for drops
+            to fall after each dispense. Defaults to workcell.drop_wait_s.
+        resume: the 'vial' state from the journal of an interrupted run, to
+            carry on with the first of vials (which must be the same vial)
+            from where it stopped. Phases already done are not repeated, and
+            if a dispense was interrupted it is never restarted (the result
+            then has 'interrupted_dispense' set). If resume['phase'] (the
+            phase in progress) is one of GRIP_CHANGING_PHASES,
+            resume['holding'] must be set to whether the gripper is holding
+            the vial now.
+        """
+        results = []
+        for n, i, j in vials:
+            if resume is not None and resume['n'] != n:
+                raise ValueError('resuming vial {}, but first vial is {}'.format(
+                    resume['n'], n))
+            with tracing.tags(vial=n), tracing.span('aliquot'):
+                result = self._aliquot(n, i, j, get_volume, get_drip_wait,
+                    resume)
+            resume = None
+            on_done(result)
+            results.append(result)
+            if self.journal is not None:
+                self.journal.update(vial=None, last_done=n)
+        return results
+
+    def _recover(self, state, done):
+        """Gets the robot and gripper ready to continue the resumed vial.
+        """
+        wc = self.workcell
+        phase = state['phase']
+        if phase is not None:
+            print('Resuming aliquot #{}, interrupted during {}'.format(
+                state['n'], phase))
+        else:
+            print('Resuming aliquot #{}, after {}'.format(state['n'],
+                ', '.join(state['done']) or 'nothing'))
+
+        if phase in ('pump', 'fill_on_scale'):
+            # Dispensing again could overfill. weigh_full still measures what
+            # actually went in.
+            print('Dispense was interrupted. Not repeating it.')
+            done.add(phase)
+        elif phase == 'fetch' and state['holding']:
+            done.add('fetch')
+        elif phase == 'put_back' and not state['holding']:
+            done.add('put_back')
+
+        near_pump = ('travel_to_pump' in done or phase == 'travel_to_pump'
+            ) and 'travel_from_pump' not in done
+        wc.retreat(near_pump=near_pump)
+        # The servo may have been reset.
+        if state['holding']:
+            grip_vial(wc.robot)
+        else:
+            release_vial(wc.robot)
+
+        # Phases done under the outlet have to be back there.
+        if not ('pump' in done and 'drip_wait' in done):
+            done.discard('travel_to_pump')
+
+        if phase == 'fill_on_scale' and not state['holding']:
+            wc.pick('scale')
+
+    def _aliquot(self, n, i, j, get_volume, get_drip_wait, resume=None):
+        wc = self.workcell
+        # Phases already done (for a resumed vial), and the journal entry.
+        done = set()
+        state = {'n': n, 'i': i, 'j': j, 'done': [], 'phase': None,
+            'holding': False, 'result': {}}
+
+        def on_phase(name, finished):
+            if finished:
+                done.add(name)
+                state['done'].append(name)
+                state['phase'] = None
+                if name == 'fetch':
+                    state['holding'] = True
+                elif name == 'put_back':
+                    state['holding'] = False
+                    result['end_time'] = wc.clock.time()
+            else:
+                state['phase'] = name
+            if self.journal is None:
+                return
+            state['result'] = dict((k, v) for k, v in result.items()
+                if k != 'phase_times')
+            self.journal.update(vial=state)
+
+        timer = PhaseTimer(wc.clock, on_phase=on_phase)
+        result = _new_result(wc.clock, n, i, j, timer)
+        print('Aliquot #{}'.format(n))
+        col_letter, row_num = wc.vialbox.coord_label(i, j)
+        print('{}{} (i={}, j={})'.format(col_letter, row_num, i, j))
+
+        if resume is not None:
+            state.update(resume)
+            state['done'] = list(resume['done'])
+            result.update(resume['result'])
+            done.update(state['done'])
+            self._recover(resume, done)
+            if resume['phase'] in ('pump', 'fill_on_scale'):
+                result['interrupted_dispense'] = True
+            state['phase'] = None
+
+        # Grips a vial and moves to working height.
+        if 'fetch' not in done:
+            with timer.phase('fetch'):
+                wc.get_vial(i, j)
+
+        if wc.dispenser is not None:
+            if 'fill_on_scale' not in done:
+                with timer.phase('fill_on_scale'):
+                    (result['empty_vial_g'], result['full_vial_g'],
+                        result['vol_ml']) = wc.fill_vial_on_scale()
+            if 'put_back' not in done:
+                with timer.phase('put_back'):
+                    wc.put_vial(i, j)
+            return result
+
+        if wc.scale is not None and 'weigh_empty' not in done:
+            with timer.phase('weigh_empty'):
+                result['empty_vial_g'] = wc.weigh_vial()
+
+        if result['vol_ml'] is None:
+            result['vol_ml'] = get_volume()
+            result['drip_wait_s'] = _drip_wait(wc, get_drip_wait)
+        wc.fill_vial(result['vol_ml'], drip_wait_s=result['drip_wait_s'],
+            timer=timer, skip=done)
+
+        if wc.scale is not None and 'weigh_full' not in done:
+            with timer.phase('weigh_full'):
+                result['full_vial_g'] = wc.weigh_vial()
+
+        if 'put_back' not in done:
+            with timer.phase('put_back'):
+                wc.put_vial(i, j)
+        return result
+
+
+def _drip_wait(workcell, get_drip_wait):
+    if get_drip_wait is None:
+        return workcell.drop_wait_s
+    return get_drip_wait()
+
+
+class _Aborted(Exception):
+    pass
+
+
+class PipelinedScheduler(object):
+    """Keeps several vials in flight, each in its own thread.
+
+    Each vial goes box -> [scale] -> [staging] -> pump -> [scale] -> box,
+    skipping stations the workcell does not have. The pump station needs a
+    platform under the pump outlet, so the vial can be left there while it
+    fills and drips.
+
+    The gripper and each station are resources that only one vial can hold at
+    a time. A vial acquires the station it is moving to before the gripper,
+    and holds each station until it has been moved off of it. The number of
+    vials in flight is limited so that can never deadlock (e.g. with one
+    vial at the pump waiting for the scale, and another on the scale waiting
+    for the pump).
+
+    With a scale, a staging station is required for any overlap: while vial N
+    is at the pump, vial N-1 is weighed and returned, and vial N+1 is fetched,
+    weighed empty, and staged.
+    """
+    def __init__(self, workcell, max_in_flight=None):
+        stations = workcell.stations
+        if workcell.dispenser is not None:
+            raise ValueError('mass feedback dispensing is only supported by '
+                'SerialScheduler')
+        if 'pump' not in stations:
+            raise ValueError('pipelining requires a platform under the pump '
+                '(set pump_platform_z)')
+
+        route = []
+        if 'scale' in stations:
+            route.append(('scale', 'weigh_empty'))
+        if 'staging' in stations:
+            route.append(('staging', None))
+        route.append(('pump', 'fill'))
+        if 'scale' in stations:
+            route.append(('scale', 'weigh_full'))
+        self.route = route
+
+        if max_in_flight is None:
+            # The scale is visited twice, so the vials in flight need one less
+            # station than there are, to always leave one free.
+            max_in_flight = len(stations)
+            if 'scale' in stations:
+                max_in_flight -= 1
+            max_in_flight = max(max_in_flight, 1)
+        self.max_in_flight = max_in_flight
+
+        self.workcell = workcell
+        # Or the clock's own, if it has them (e.g. simulation.VirtualClock, so
+        # time can pass while threads wait on each other).
+        self._threading = getattr(workcell.clock, 'threading', threading)
+        self._cond = self._threading.Condition()
+        # Resource name -> n of the vial holding it (or None)
+        self._holders = dict([(s, None) for s in stations + ['gripper']])
+        self._callback_lock = threading.Lock()
+        self._error = None
+
+    def _acquire(self, resource, n):
+        with self._cond:
+            while self._holders[resource] is not None:
+                if self._error is not None:
+                    raise _Aborted()
+                self._cond.wait()
+            if self._error is not None:
+                raise _Aborted()
+            self._holders[resource] = n
+
+    def _release(self, resource):
+        with self._cond:
+            self._holders[resource] = None
+            self._cond.notify_all()
+
+    def _fail(self, err):
+        with self._cond:
+            if self._error is None:
+                self._error = err
+            self._cond.notify_all()
+
+    def _transfer(self, n, i, j, src, dst, timer):
+        """Moves vial n from src to dst (None meaning its place in the box).
+        """
+        wc = self.workcell
+        with timer.phase('wait'):
+            if dst is not None:
+                self._acquire(dst, n)
+            self._acquire('gripper', n)
+
+        if src is None:
+            phase = 'fetch'
+        elif dst is None:
+            phase = 'put_back'
+        elif dst == 'pump':
+            phase = 'travel_to_pump'
+        elif src == 'pump':
+            phase = 'travel_from_pump'
+        else:
+            phase = 'move_to_' + dst
+        try:
+            with timer.phase(phase):
+                if src is None:
+                    col_letter, row_num = wc.vialbox.coord_label(i, j)
+                    print('Aliquot #{} ({}{}, i={}, j={})'.format(n,
+                        col_letter, row_num, i, j))
+                    wc.get_vial(i, j)
+                else:
+                    wc.pick(src)
+
+                if dst is None:
+                    wc.put_vial(i, j)
+                else:
+                    wc.place(dst)
+        finally:
+            self._release('gripper')
+        if src is not None:
+            self._release(src)
+
+    def _process(self, n, i, j, get_volume, on_done, get_drip_wait, results):
+        with tracing.tags(vial=n), tracing.span('aliquot'):
+            self._process_vial(n, i, j, get_volume, on_done, get_drip_wait,
+                results)
+
+    def _process_vial(self, n, i, j, get_volume, on_done, get_drip_wait,
+        results):
+        wc = self.workcell
+        timer = PhaseTimer(wc.clock)
+        result = _new_result(wc.clock, n, i, j, timer)
+        try:
+            at = None
+            for station, action in self.route:
+                self._transfer(n, i, j, at, station, timer)
+                at = station
+
+                if action == 'weigh_empty':
+                    with timer.phase('weigh_empty'):
+                        result['empty_vial_g'] = wc.read_scale()
+
+                elif action == 'weigh_full':
+                    with timer.phase('weigh_full'):
+                        result['full_vial_g'] = wc.read_scale()
+
+                elif action == 'fill':
+                    with self._callback_lock:
+                        result['vol_ml'] = get_volume()
+                        result['drip_wait_s'] = _drip_wait(wc, get_drip_wait)
+                    with timer.phase('pump'):
+                        wc.start_dispense(result['vol_ml']).wait()
+                    with timer.phase('drip_wait'):
+                        wc.drip_wait(result['drip_wait_s'])
+
+            self._transfer(n, i, j, at, None, timer)
+
+            result['end_time'] = wc.clock.time()
+            with self._callback_lock:
+                on_done(result)
+                results.append(result)
+
+        except _Aborted:
+            pass
+        except Exception as err:
+            self._fail(err)
+            raise
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def run(self, vials, get_volume, on_done, get_drip_wait=None):
+        """Same as SerialScheduler.run, but with vials processed concurrently.
+
+        Results are returned in the order vials finished. get_volume is called
+        when each dispense starts, so a correction computed in on_done may
+        not reach the very next vial.
+        """
+        self._error = None
+        self._in_flight = 0
+        results = []
+        threads = []
+        for n, i, j in vials:
+            with self._cond:
+                while (self._in_flight >= self.max_in_flight and
+                    self._error is None):
+                    self._cond.wait()
+                if self._error is not None:
+                    break
+                self._in_flight += 1
+
+            t = self._threading.Thread(target=self._process,
+                args=(n, i, j, get_volume, on_done, get_drip_wait, results),
+                name='vial {}'.format(n))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        with self._cond:
+            while self._in_flight > 0:
+                self._cond.wait()
+        for t in threads:
+            t.join()
+
+        if self._error is not None:
+            raise self._error
+        return results
+
+
+class DeckScheduler(object):
+    """Runs vials across the racks of a deck.Deck with another scheduler,
+    one rack at a time, having each rack swapped for a fresh one once it is
+    done (if the run comes back to it), while the other racks are worked on.
+
+    ijs: (i, j) of every aliquot # in the run, from the first (as from
+        deck.Deck.stream), so which racks are done is known when resuming.
+    swaps: a deck.RackSwaps. Defaults to one that asks the operator.
+    vial_map: a vial_map.VialMap, to mark every slot of a swapped rack present
+        in.
+    """
+    def __init__(self, scheduler, deck, ijs, swaps=None, vial_map=None):
+        import deck as deck_module
+
+        self.scheduler = scheduler
+        self.workcell = scheduler.workcell
+        self.deck = deck
+        self.ijs = [tuple(ij) for ij in ijs]
+        if swaps is None:
+            swaps = deck_module.RackSwaps()
+        self.swaps = swaps
+        self.vial_map = vial_map
+
+    def _used_from(self, r, n):
+        """Returns whether any vial from n on is in rack r.
+        """
+        return any(self.deck.rack_of(i) == r for i, _ in self.ijs[n:])
+
+    def run(self, vials, get_volume, on_done, get_drip_wait=None,
+        resume=None):
+        """Same as SerialScheduler.run.
+
+        vials need not be every aliquot # in ijs (e.g. skipping slots already
+        filled).
+        resume is only supported if scheduler supports it.
+        """
+        vials = list(vials)
+        if len(vials) == 0:
+            return []
+
+        # Each load of a rack (between swaps), as aliquot #s.
+        loads = [(r, [n for n, _, _ in load]) for r, load in
+            self.deck.segments([(n, i, j) for n, (i, j) in
+            enumerate(self.ijs)])]
+        load_of = dict((n, k) for k, (_, ns) in enumerate(loads) for n in ns)
+
+        # Racks finished before this run started (e.g. before a resume), or
+        # with nothing to fill in it, that are used again, may not have been
+        # swapped yet.
+        start_n = vials[0][0]
+        now = load_of[start_n]
+        r_now, now_ns = loads[now]
+        to_fill = set(vial[0] for vial in vials)
+        for k, (r, ns) in enumerate(loads):
+            if k == now or (k > now and any(n in to_fill for n in ns)):
+                continue
+            # If the load start_n is in was started before (even just the
+            # vial being resumed), the rack was swapped since.
+            if k < now and r == r_now and (now_ns[0] < start_n or
+                resume is not None):
+                continue
+            name = self.deck.names[r]
+            if name not in self.swaps.pending and self._used_from(r,
+                ns[-1] + 1):
+                self.swaps.request(name)
+
+        def done(result):
+            on_done(result)
+            self.swaps.poll()
+
+        segments = []
+        for vial in vials:
+            k = load_of[vial[0]]
+            if len(segments) == 0 or segments[-1][0] != k:
+                segments.append((k, []))
+            segments[-1][1].append(vial)
+
+        results = []
+        for k, segment in segments:
+            r, ns = loads[k]
+            name = self.deck.names[r]
+            if self.swaps.wait(name) and self.vial_map is not None:
+                self.vial_map.reset(self.deck.rack_ijs(r))
+            kwargs = dict()
+            if resume is not None:
+                kwargs['resume'] = resume
+                resume = None
+            results.extend(self.scheduler.run(segment, get_volume, done,
+                get_drip_wait=get_drip_wait, **kwargs))
+            if self._used_from(r, ns[-1] + 1):
+                self.swaps.request(name)
+        return results
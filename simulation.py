@@ -0,0 +1,763 @@
+#!/usr/bin/env python
+
+"""
+Simulated robot, pump, scale and vial box, for trying out workcell.Workcell
+sequencing (see scheduler.py) without hardware.
+
+The simulated devices share a SimulatedWorld, which tracks which vial is where
+(by XY position), so that the scale reads whatever the pump put in the vial on
+it. Robot move times come from the feed rates and acceleration in
+smoothie_config.
+
+Everything takes a clock. With a VirtualClock, time only passes when something
+sleeps, so a run takes only as long as the code does. With a
+ScaledClock, time passes in real time, optionally sped up.
+
+The pump can also be a real wpi_al1000.AL1000 talking to a
+fake_al1000.FakeAL1000 over a pty (make_workcell(pty_pump=True)).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import heapq
+import itertools
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+from workcell import Workcell, grip_vial, release_vial
+from syringes import SyringeLedger
+from weighing import StreamingScale
+from mass_feedback import MassFeedbackDispenser
+from motion import SmoothieMotion
+from motion_batch import Z2_AXIS
+
+
+class VirtualClock(object):
+    """Time that only passes when sleep is called.
+
+    Several threads can sleep on it if they are started and wait on each other
+    with the Thread and Condition in its threading attribute (as
+    PipelinedScheduler does). Time then only passes once all of them are
+    sleeping or waiting, and goes straight to the earliest wake up. If all of
+    them are waiting on each other, RuntimeError is raised (a deadlock).
+    """
+    def __init__(self, start=None):
+        self.now = time.time() if start is None else start
+        self.threading = _VirtualThreading(self)
+
+        self._lock = threading.Condition()
+        # Threads not sleeping or waiting, starting with the one using the
+        # clock.
+        self._running = 1
+        # Heap of (wake up time, key) for each sleeping thread.
+        self._sleepers = []
+        # Keys of sleepers whose time has come.
+        self._woken = set()
+        self._keys = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        with self._lock:
+            key = next(self._keys)
+            heapq.heappush(self._sleepers, (self.now + seconds, key))
+            self._running -= 1
+            self._advance()
+            while key not in self._woken:
+                self._lock.wait()
+            self._woken.remove(key)
+
+    def _advance(self):
+        # (with _lock held)
+        if self._running > 0 or len(self._sleepers) == 0:
+            return
+        self.now = max(self.now, self._sleepers[0][0])
+        # Counted as running from here, so time can't pass again before they
+        # get going.
+        while len(self._sleepers) > 0 and self._sleepers[0][0] <= self.now:
+            self._woken.add(heapq.heappop(self._sleepers)[1])
+            self._running += 1
+        self._lock.notify_all()
+
+    def _block(self, waiting=False):
+        with self._lock:
+            if waiting and self._running == 1 and len(self._sleepers) == 0:
+                raise RuntimeError('deadlock: every thread is waiting on '
+                    'another')
+            self._running -= 1
+            self._advance()
+
+    def _unblock(self, n):
+        with self._lock:
+            self._running += n
+
+
+class _VirtualThreading(object):
+    """Stands in for the threading module, for threads using a VirtualClock.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+
+    def Thread(self, **kwargs):
+        return _VirtualThread(self.clock, **kwargs)
+
+    def Condition(self):
+        return _VirtualCondition(self.clock)
+
+
+class _VirtualThread(threading.Thread):
+    def __init__(self, clock, **kwargs):
+        threading.Thread.__init__(self, **kwargs)
+        self._clock = clock
+
+    def start(self):
+        # Running from now, so no time passes before it gets going.
+        self._clock._unblock(1)
+        threading.Thread.start(self)
+
+    def run(self):
+        try:
+            threading.Thread.run(self)
+        finally:
+            self._clock._block()
+
+
+class _VirtualCondition(object):
+    """A threading.Condition (only wait and notify_all) whose waiting
+    threads the clock knows about.
+    """
+    def __init__(self, clock):
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._n_waiting = 0
+
+    def __enter__(self):
+        return self._cond.__enter__()
+
+    def __exit__(self, *args):
+        return self._cond.__exit__(*args)
+
+    def wait(self):
+        self._clock._block(waiting=True)
+        self._n_waiting += 1
+        self._cond.wait()
+
+    def notify_all(self):
+        # Running from now, as for sleepers that are woken.
+        self._clock._unblock(self._n_waiting)
+        self._n_waiting = 0
+        self._cond.notify_all()
+
+
+class ScaledClock(object):
+    """Real time, passing speedup times faster.
+    """
+    def __init__(self, speedup=1.0):
+        self.speedup = speedup
+        self._start = time.time()
+
+    def time(self):
+        return self._start + (time.time() - self._start) * self.speedup
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speedup)
+
+
+def _key(xy):
+    return (round(xy[0], 1), round(xy[1], 1))
+
+
+class SimulatedWorld(object):
+    """Which vial (represented by its mass in grams) is where.
+    """
+    def __init__(self, clock=time, empty_vial_g=20.0, empty_vial_sd_g=0.1,
+        density_g_ml=0.85, seed=None):
+        self.clock = clock
+        self.empty_vial_g = empty_vial_g
+        self.empty_vial_sd_g = empty_vial_sd_g
+        self.density_g_ml = density_g_ml
+        self.rng = random.Random(seed)
+
+        # Rounded XY -> mass of vial set down there.
+        self.vials = dict()
+        # Mass of vial in the gripper, or None.
+        self.held = None
+        # Liquid that went somewhere other than a vial (mL).
+        self.spilled_ml = 0.0
+        # (time, rounded XY, grams) of liquid added to vials not in the
+        # gripper, so a scale can lag behind it.
+        self.additions = []
+
+    def new_vial(self):
+        return self.rng.gauss(self.empty_vial_g, self.empty_vial_sd_g)
+
+    def clear(self, xys):
+        """Removes the vials put down at xys (e.g. for a vial box swapped for
+        one of empty vials).
+        """
+        for xy in xys:
+            self.vials.pop(_key(xy), None)
+
+    def add_liquid(self, xy, ml, robot):
+        """Adds ml of liquid to whatever vial is under xy.
+        """
+        if self.held is not None and _key(robot.xy) == _key(xy):
+            self.held += ml * self.density_g_ml
+        elif _key(xy) in self.vials:
+            self.vials[_key(xy)] += ml * self.density_g_ml
+            self.additions.append((self.clock.time(), _key(xy),
+                ml * self.density_g_ml))
+        else:
+            self.spilled_ml += ml
+
+
+class _SimulatedSmoothie(object):
+    """Runs G-code as the smoothie would: G0 moves are queued (and replied to
+    right away), and anything else waits for queued moves to finish.
+    """
+    def __init__(self, robot):
+        self.robot = robot
+        # Clock time queued moves will be done by.
+        self.busy_until = None
+        self.n_commands = 0
+
+    def wait_idle(self):
+        if self.busy_until is not None:
+            self.robot._sleep(self.busy_until - self.robot.clock.time())
+            self.busy_until = None
+
+    def _queue(self, move_s):
+        start = self.robot.clock.time()
+        if self.busy_until is not None:
+            start = max(start, self.busy_until)
+        self.robot._servo_done_by(start)
+        self.busy_until = start + move_s()
+
+    def sendCmd(self, cmd):
+        self.n_commands += 1
+        words = cmd.split()
+        robot = self.robot
+        if len(words) > 0 and words[0] == 'G0':
+            axes = dict((w[0], float(w[1:])) for w in words[1:])
+            if 'X' in axes or 'Y' in axes:
+                xy = (axes.get('X', robot.xy[0]), axes.get('Y', robot.xy[1]))
+                self._queue(lambda: robot._move_xy_s(xy))
+            if Z2_AXIS in axes:
+                self._queue(lambda: robot._move_z2_s(axes[Z2_AXIS]))
+        else:
+            self.wait_idle()
+            if len(words) == 0:
+                pass
+            elif words[0] == 'M280':
+                robot._move_servo(float(words[-1].lstrip('S')))
+            elif words[0] == 'G4':
+                robot._sleep(float(words[-1].lstrip('P')) / 1000.0)
+        robot._sleep(robot.command_s)
+
+    def sendSyncCmd(self, cmd):
+        self.sendCmd(cmd)
+        self.wait_idle()
+
+
+class SimulatedRobot(object):
+    """Stands in for maple.robotutil.MAPLE, for the calls Workcell makes.
+
+    Moves take as long as motion (a SmoothieMotion, by default from
+    smoothie_config) says, plus command_s for each command. Gripper servo
+    positions above open_below count as closed.
+
+    The servo takes servo_s_per_unit seconds per unit change in S. If the
+    robot moves before the servo gets there, the grip (or release) does not
+    happen.
+    """
+    def __init__(self, world, motion=None, command_s=0.01, open_below=3.0,
+        servo_s_per_unit=0.0):
+        self.world = world
+        self.clock = world.clock
+        if motion is None:
+            motion = SmoothieMotion.from_config()
+        self.motion = motion
+        self.command_s = command_s
+        self.open_below = open_below
+        self.servo_s_per_unit = servo_s_per_unit
+        self.servo_s = None
+        # (S, clock time the servo gets there), until the robot next moves.
+        self._servo_pending = None
+
+        self.xy = (0.0, 0.0)
+        self.z2 = 0.0
+        # Also kept here, as benchmark.instrument replaces smoothie.
+        self._smoothie = _SimulatedSmoothie(self)
+        self.smoothie = self._smoothie
+        self.n_moves = 0
+        # Total seconds spent moving.
+        self.move_time_s = 0.0
+
+    def _sleep(self, seconds):
+        self.clock.sleep(seconds)
+
+    def _move_xy_s(self, xy):
+        """Returns how long moving to xy takes, and counts it as done.
+        """
+        self.n_moves += 1
+        seconds = self.motion.xy_time_s(self.xy, xy)
+        self.move_time_s += seconds
+        self.xy = tuple(xy)
+        return seconds
+
+    def _move_z2_s(self, z):
+        self.n_moves += 1
+        seconds = self.motion.z_time_s(self.z2, z)
+        self.move_time_s += seconds
+        self.z2 = z
+        return seconds
+
+    def moveXY(self, xy):
+        self._smoothie.wait_idle()
+        self._servo_done_by(self.clock.time())
+        self._sleep(self.command_s + self._move_xy_s(xy))
+
+    def moveZ2(self, z):
+        self._smoothie.wait_idle()
+        self._servo_done_by(self.clock.time())
+        self._sleep(self.command_s + self._move_z2_s(z))
+
+    def dwell_ms(self, ms):
+        self._smoothie.wait_idle()
+        self._sleep(ms / 1000.0)
+
+    def _move_servo(self, s_position):
+        now = self.clock.time()
+        self._servo_done_by(now)
+        travel_s = 0.0
+        if self.servo_s is not None:
+            travel_s = self.servo_s_per_unit * abs(s_position - self.servo_s)
+        self.servo_s = s_position
+        self._servo_pending = (s_position, now + travel_s)
+
+    def _servo_done_by(self, t):
+        """Grips or releases as last commanded, if the servo got there by t
+        (when something else started).
+        """
+        if self._servo_pending is None:
+            return
+        s_position, done_time = self._servo_pending
+        self._servo_pending = None
+        if t < done_time:
+            return
+
+        world = self.world
+        if s_position >= self.open_below:
+            if world.held is None:
+                # Anywhere without a vial we have put there is a (full) vial
+                # box slot, with an empty vial.
+                world.held = world.vials.pop(_key(self.xy), None)
+                if world.held is None:
+                    world.held = world.new_vial()
+        elif world.held is not None:
+            world.vials[_key(self.xy)] = world.held
+            world.held = None
+
+
+class SimulatedVialBox(object):
+    """Stands in for aliquot.ScintillationVialBox.
+    """
+    def __init__(self, robot, offset=(751.0, -14.5), n_cols=7, n_rows=8,
+        anchor_spacing=29.0, vial_grip_height=59.5, start_letter='D',
+        start_num=2):
+        self.robot = robot
+        self.offset = offset
+        self.n_cols = n_cols
+        self.n_rows = n_rows
+        self.anchor_spacing = anchor_spacing
+        self.flymanip_working_height = vial_grip_height
+
+        self.letters = [chr(x) for x in
+            range(ord(start_letter), ord(start_letter) + n_cols)][::-1]
+        self.nums = list(range(start_num, start_num + n_rows))
+
+    def anchor_center(self, i, j):
+        to_first_anchor = self.anchor_spacing / 2.0
+        return (self.offset[0] + to_first_anchor + i * self.anchor_spacing,
+            self.offset[1] + to_first_anchor + j * self.anchor_spacing)
+
+    def get_indices(self, i, j):
+        self.robot.moveXY(self.anchor_center(i, j))
+        release_vial(self.robot)
+        self.robot.moveZ2(self.flymanip_working_height)
+        grip_vial(self.robot)
+        self.robot.moveZ2(0)
+
+    def put_indices(self, i, j):
+        self.robot.moveXY(self.anchor_center(i, j))
+        self.robot.moveZ2(self.flymanip_working_height - 1)
+        release_vial(self.robot)
+        self.robot.moveZ2(12)
+
+    def coord_label(self, i, j):
+        return self.letters[i], self.nums[j]
+
+
+class _SimulatedDispense(object):
+    """Delivers liquid at a constant rate, as it is polled.
+    """
+    def __init__(self, pump, ml, rate, poll_interval_s=0.25):
+        self.pump = pump
+        self.clock = pump.clock
+        self.ml = ml
+        self.poll_interval_s = poll_interval_s
+        self.start_time = self.clock.time()
+        self.expected_duration_s = (ml / rate) * 60.0
+        self.end_time = None
+        self.error = None
+        self.cancelled = False
+        self.delivered_ml = 0.0
+
+    @property
+    def volume_dispensed(self):
+        return self.delivered_ml
+
+    def _deliver_until(self, fraction):
+        ml = self.ml * fraction - self.delivered_ml
+        if ml > 0:
+            self.delivered_ml += ml
+            self.pump._deliver(ml)
+
+    def _fraction(self):
+        return min((self.clock.time() - self.start_time) /
+            self.expected_duration_s, 1.0)
+
+    def poll(self):
+        if self.end_time is not None:
+            return True
+        fraction = self._fraction()
+        self._deliver_until(fraction)
+        if fraction < 1.0:
+            return False
+        self.end_time = self.clock.time()
+        self.pump.ledger.confirm(self.delivered_ml)
+        return True
+
+    def done(self):
+        return self.poll()
+
+    def wait(self, timeout=None):
+        if self.end_time is not None:
+            return True
+        # Nothing can happen in between that polling would catch, so this
+        # just sleeps until the end.
+        remaining = self.start_time + self.expected_duration_s - \
+            self.clock.time()
+        if timeout is not None and timeout < remaining:
+            self.clock.sleep(timeout)
+            return self.poll()
+        self.clock.sleep(remaining)
+        return self.poll()
+
+    def cancel(self):
+        if self.end_time is not None:
+            return
+        self._deliver_until(self._fraction())
+        self.end_time = self.clock.time()
+        self.cancelled = True
+        self.pump.ledger.confirm(self.delivered_ml)
+
+
+class SimulatedPump(object):
+    """Stands in for wpi_al1000.AL1000, for the calls Workcell makes.
+
+    Each dispense delivers ml * (1 + gain_error) + offset_ml (the offset
+    all at once, at the start).
+    """
+    def __init__(self, world, robot, pump_xy, rate=1.2, capacity=60.0,
+        offset_ml=0.0, gain_error=0.0):
+        self.world = world
+        self.clock = world.clock
+        self.robot = robot
+        self.pump_xy = pump_xy
+        self.rate = rate
+        self.capacity = capacity
+        self.offset_ml = offset_ml
+        self.gain_error = gain_error
+
+        self.max_rate = None
+        self.min_rate = None
+        self.volume_dispensed = 0.0
+        self.ledger = SyringeLedger(path=None)
+        self.ledger.load(capacity)
+
+    def _deliver(self, ml):
+        delivered = ml * (1 + self.gain_error)
+        self.volume_dispensed += delivered
+        self.world.add_liquid(self.pump_xy, delivered, self.robot)
+
+    def get_rate(self):
+        return self.rate
+
+    def set_rate(self, num, unit=False, transaction=None):
+        self.rate = num
+
+    def invalidate(self, *keys):
+        pass
+
+    def clear_vol_disp(self, direction='both'):
+        self.volume_dispensed = 0.0
+
+    def get_infused_ml(self):
+        return self.volume_dispensed
+
+    def can_dispense(self, ml):
+        return ml < self.ledger.left_ml
+
+    def refilled(self, ml=None):
+        self.ledger.load(self.capacity if ml is None else ml)
+
+    def dispense(self, ml, block=True, poll_interval_s=None):
+        self.ledger.start(ml)
+        handle = _SimulatedDispense(self, ml, self.rate,
+            poll_interval_s=poll_interval_s or 0.25)
+        if self.offset_ml != 0:
+            self.volume_dispensed += self.offset_ml
+            self.world.add_liquid(self.pump_xy, self.offset_ml, self.robot)
+        if block:
+            handle.wait()
+        return handle
+
+
+class SimulatedScale(object):
+    """Stands in for mettler_toledo_device.MettlerToledoDevice.
+
+    Readings approach the mass on the scale exponentially, with time constant
+    tau_s, plus gaussian noise with SD noise_g. Each immediate reading takes
+    sample_s. Liquid only starts counting delay_s after it leaves the pump (as
+    if it were in the air).
+    """
+    def __init__(self, world, scale_xy, tau_s=0.5, delay_s=0.0,
+        sample_s=0.1, noise_g=0.0):
+        self.world = world
+        self.clock = world.clock
+        self.scale_xy = scale_xy
+        self.tau_s = tau_s
+        self.delay_s = delay_s
+        self.sample_s = sample_s
+        self.noise_g = noise_g
+
+        self._shown_g = 0.0
+        self._last_read = None
+        # Subtracted from readings, as set by zero_stable.
+        self._zero_g = 0.0
+
+    def _true_weight(self):
+        key = _key(self.scale_xy)
+        weight = self.world.vials.get(key, 0.0)
+        cutoff = self.clock.time() - self.delay_s
+        # Older additions can't matter anymore.
+        self.world.additions = [a for a in self.world.additions
+            if a[0] > cutoff]
+        weight -= sum(g for t, k, g in self.world.additions if k == key)
+        return weight
+
+    def get_weight(self):
+        self.clock.sleep(self.sample_s)
+        now = self.clock.time()
+        target = self._true_weight()
+        if self._last_read is not None:
+            dt = now - self._last_read
+            self._shown_g = target + ((self._shown_g - target) *
+                math.exp(-dt / self.tau_s))
+        self._last_read = now
+
+        weight = self._shown_g - self._zero_g
+        if self.noise_g > 0:
+            weight += self.world.rng.gauss(0, self.noise_g)
+        return [weight, 'g']
+
+    def get_weight_stable(self):
+        weight = self.get_weight()
+        if abs(self._shown_g - self._true_weight()) > 0.001:
+            return None
+        return weight
+
+    def zero_stable(self):
+        if abs(self._shown_g - self._true_weight()) > 0.001:
+            return False
+        self._zero_g = self._shown_g
+        return True
+
+
+def make_workcell(clock=None, speedup=1.0, staging=True, pump_platform=True,
+    motion=None, scale_tau_s=0.5, scale_delay_s=0.0, scale_noise_g=0.0005,
+    rate=1.2, drop_wait_s=20, refill_s=120.0, seed=None,
+    mass_feedback_g=None, pty_pump=False, batch_moves=False,
+    servo_s_per_unit=0.0, **pump_kwargs):
+    """Returns a Workcell of simulated devices, laid out as in aliquot.py.
+
+    clock: a VirtualClock or ScaledClock. Defaults to ScaledClock(speedup).
+    motion: a SmoothieMotion. Defaults to one from smoothie_config.
+    refill_s: how long refilling the syringe takes.
+    mass_feedback_g: if not None, the scale is put under the pump outlet, and
+        vials are filled on it to this mass, with a MassFeedbackDispenser.
+    pty_pump: if True, the pump is a wpi_al1000.AL1000 talking to a
+        fake_al1000.FakeAL1000, rather than a SimulatedPump. Only capacity is
+        supported in pump_kwargs then.
+    batch_moves: as for Workcell
+    servo_s_per_unit: as for SimulatedRobot
+    """
+    if clock is None:
+        clock = ScaledClock(speedup)
+    world = SimulatedWorld(clock=clock, seed=seed)
+    robot = SimulatedRobot(world, motion=motion,
+        servo_s_per_unit=servo_s_per_unit)
+    vialbox = SimulatedVialBox(robot)
+
+    syringepump_xy = (632, 179)
+    scale_xy = (632, 2)
+    if mass_feedback_g is not None:
+        scale_xy = syringepump_xy
+
+    if pty_pump:
+        import wpi_al1000
+        from fake_al1000 import FakeAL1000
+
+        capacity = pump_kwargs.pop('capacity', 60.0)
+        if len(pump_kwargs) > 0:
+            raise ValueError('unsupported with pty_pump: {}'.format(
+                list(pump_kwargs.keys())))
+        fake = FakeAL1000(clock=clock, capacity_ml=capacity,
+            on_deliver=lambda ml: world.add_liquid(syringepump_xy, ml, robot))
+        pump = wpi_al1000.AL1000(port=fake.port, clock=clock)
+        pump.set_syringe(family='B-D', cc=60)
+        pump.capacity = capacity
+        pump.refilled()
+        pump.set_rate(rate, unit='MM')
+
+        def refill_syringe():
+            clock.sleep(refill_s)
+            fake.total_infused_ml = 0.0
+    else:
+        pump = SimulatedPump(world, robot, syringepump_xy, rate=rate,
+            **pump_kwargs)
+
+        def refill_syringe():
+            clock.sleep(refill_s)
+
+    scale = SimulatedScale(world, scale_xy, tau_s=scale_tau_s,
+        delay_s=scale_delay_s, noise_g=scale_noise_g)
+    scale = StreamingScale(scale, clock=clock)
+
+    dispenser = None
+    if mass_feedback_g is not None:
+        dispenser = MassFeedbackDispenser(pump, scale, world.density_g_ml,
+            mass_feedback_g, coarse_rate=rate,
+            lag_s=scale_tau_s + scale_delay_s, clock=clock)
+
+    return Workcell(robot, vialbox, vialbox.anchor_center(0, 0), pump=pump,
+        pump_xy=syringepump_xy, pump_z=22,
+        pump_xy_approach=[(syringepump_xy[0], 160)],
+        pump_platform_z=40 if pump_platform else None,
+        scale=scale, scale_xy=scale_xy, scale_z=23,
+        staging_xy=(560, 100) if staging else None, staging_z=23,
+        drop_wait_s=drop_wait_s, dispenser=dispenser,
+        refill_syringe=refill_syringe, batch_moves=batch_moves, clock=clock)
+
+
+def vial_order(vialbox, n_vials, ijs=None):
+    """Returns (n, i, j) for n_vials vials, taken from the box in order,
+    starting again from the first slot once the box has been gone through.
+
+    ijs: the order of the slots. Defaults to index order.
+    """
+    if ijs is None:
+        n_rows = vialbox.n_rows
+        ijs = [(k // n_rows, k % n_rows)
+            for k in range(vialbox.n_cols * vialbox.n_rows)]
+    return [(n,) + tuple(ijs[n % len(ijs)]) for n in range(n_vials)]
+
+
+def simulate(n_vials, scheduler_class=None, vol_ml=2.0, quiet=True,
+    workcell=None, plan_path=False, **workcell_kwargs):
+    """Aliquots into n_vials vials on a simulated workcell.
+
+    Returns (results, workcell), with results as from scheduler_class.run.
+    Vials are taken from the box in vial_order.
+
+    scheduler_class: defaults to scheduler.SerialScheduler
+    quiet: if True, suppresses printing while running.
+    workcell: to use instead of making one with make_workcell(
+        **workcell_kwargs)
+    plan_path: if True, the slot order and approach are from
+        path_planner.plan (and the estimate is printed, even if quiet).
+    """
+    import scheduler
+    if scheduler_class is None:
+        scheduler_class = scheduler.SerialScheduler
+
+    if workcell is None:
+        workcell = make_workcell(**workcell_kwargs)
+    ijs = None
+    if plan_path:
+        import path_planner
+        vialbox = workcell.vialbox
+        ijs = [(k // vialbox.n_rows, k % vialbox.n_rows) for k in
+            range(min(n_vials, vialbox.n_cols * vialbox.n_rows))]
+        ijs, estimate = path_planner.plan(workcell, ijs,
+            motion=workcell.robot.motion)
+        path_planner.print_estimate(estimate)
+        workcell.approach_offset = path_planner.APPROACH_OFFSET
+    vials = vial_order(workcell.vialbox, n_vials, ijs=ijs)
+
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        results = scheduler_class(workcell).run(vials, lambda: vol_ml,
+            lambda result: None)
+    finally:
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return results, workcell
+
+
+def main():
+    """Compares serial and pipelined throughput on a simulated workcell.
+    """
+    from scheduler import (SerialScheduler, PipelinedScheduler,
+        throughput_vials_per_hour)
+
+    # In virtual time, as fast as possible.
+    n_vials = 1000
+    for name, scheduler_class in (('serial', SerialScheduler),
+        ('pipelined', PipelinedScheduler)):
+
+        start = time.time()
+        results, _ = simulate(n_vials, scheduler_class=scheduler_class,
+            clock=VirtualClock(), seed=0)
+        elapsed_s = time.time() - start
+        print('{}, virtual time: {:.1f} vials/hour ({} vials simulated in '
+            '{:.2f}s)'.format(name, throughput_vials_per_hour(results),
+            n_vials, elapsed_s))
+
+    # Real time (sped up), as a check on the virtual time numbers.
+    n_vials = 6
+    speedup = 100.0
+    for name, scheduler_class in (('serial', SerialScheduler),
+        ('pipelined', PipelinedScheduler)):
+
+        results, _ = simulate(n_vials, scheduler_class=scheduler_class,
+            speedup=speedup, seed=0)
+        print('{}, {:.0f}x real time: {:.1f} vials/hour'.format(name,
+            speedup, throughput_vials_per_hour(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+Gets devices ready in background threads (the robot homing, connecting to
+the pump, waking and zeroing the scale) while aliquot.py asks its questions,
+and checks that each device actually responds before anything uses it.
+
+    tasks = startup.Startup()
+    tasks.start('robot', maple.robotutil.MAPLE, config_path)
+    tasks.start('pump', startup.connect_pump, '/dev/ttyUSB0')
+    cc = tasks.input('Size of syringe in mL? ')
+    pump = tasks.result('pump')
+
+A device that fails (e.g. a pump that is off, whose serial port still opens)
+is reported as soon as it does, and raised as a StartupError at the next
+question (or result), rather than after everything else is set up.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import threading
+import time
+import traceback
+
+import tracing
+
+try:
+    input = raw_input
+except NameError:
+    pass
+
+
+class StartupError(RuntimeError):
+    pass
+
+
+class Startup(object):
+    """Runs named setup tasks, each in its own thread.
+    """
+    def __init__(self):
+        self._threads = dict()
+        self._results = dict()
+        # name -> (exception, formatted traceback)
+        self._errors = dict()
+        # name -> seconds the task took
+        self.durations_s = dict()
+
+    def start(self, name, fn, *args, **kwargs):
+        """Starts fn(*args, **kwargs) in a thread. Its return value is
+        result(name).
+        """
+        def run():
+            start = time.time()
+            try:
+                with tracing.span('startup', device=name):
+                    self._results[name] = fn(*args, **kwargs)
+            except Exception as err:
+                self._errors[name] = (err, traceback.format_exc())
+                print('\n{} failed: {}'.format(name, err))
+            finally:
+                self.durations_s[name] = time.time() - start
+
+        thread = threading.Thread(target=run, name='startup {}'.format(name))
+        # So a failure elsewhere doesn't leave the program waiting on it.
+        thread.daemon = True
+        self._threads[name] = thread
+        thread.start()
+
+    def done(self, name):
+        return not self._threads[name].is_alive()
+
+    def check(self):
+        """Raises StartupError if any task has failed so far.
+        """
+        if len(self._errors) == 0:
+            return
+        name = sorted(self._errors)[0]
+        err, tb = self._errors[name]
+        if isinstance(err, StartupError):
+            # Already says what is wrong.
+            raise StartupError('{} failed: {}'.format(name, err))
+        raise StartupError('{} failed: {!r}\n{}'.format(name, err, tb))
+
+    def input(self, prompt):
+        """Same as input, but first (and after) checks no task has failed.
+        """
+        self.check()
+        answer = input(prompt)
+        self.check()
+        return answer
+
+    def result(self, name, timeout_s=None):
+        """Waits for the task name to finish, and returns its result.
+
+        Raises StartupError if it (or any other task) failed, or if it is not
+        done within timeout_s.
+        """
+        thread = self._threads[name]
+        deadline = None if timeout_s is None else time.time() + timeout_s
+        if thread.is_alive():
+            print('Waiting for {}...'.format(name))
+        # In short joins, so Ctrl-C still works (under Python 2).
+        while thread.is_alive():
+            if deadline is not None and time.time() > deadline:
+                raise StartupError('{} not ready within {} seconds'.format(
+                    name, timeout_s))
+            thread.join(0.1)
+        self.check()
+        return self._results[name]
+
+    def print_durations(self):
+        print('Startup: {}'.format(', '.join('{} {:.1f}s'.format(name, s)
+            for name, s in sorted(self.durations_s.items()))))
+
+
+def connect_pump(port, **kwargs):
+    """Returns a wpi_al1000.AL1000 on port, once it has replied, with its
+    ledger reconciled with it.
+
+    kwargs are passed to AL1000.
+    """
+    import wpi_al1000
+
+    pump = wpi_al1000.AL1000(port=port, **kwargs)
+    try:
+        firmware = pump.get_firmware()
+    except wpi_al1000.AL1000Timeout:
+        raise StartupError('no reply from pump on {} (is it on?)'.format(port))
+    print('Pump firmware: {}'.format(firmware))
+    pump.reconcile_ledger()
+    return pump
+
+
+def connect_scale(port, zero=True):
+    """Returns a weighing.StreamingScale for the Mettler Toledo scale on port,
+    zeroed if zero is True.
+    """
+    from mettler_toledo_device import MettlerToledoDevice
+    from weighing import StreamingScale, StabilityTimeout
+
+    scale = StreamingScale(MettlerToledoDevice(port=port))
+    # Also checks it is awake.
+    weight_g = scale.read_immediate()
+    if zero:
+        try:
+            scale.zero()
+        except StabilityTimeout as err:
+            raise StartupError('could not zero scale ({}). Is anything '
+                'touching it?'.format(err))
+        print('Scale zeroed.')
+    else:
+        print('Scale reads {} g (not zeroed).'.format(weight_g))
+    return scale
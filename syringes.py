@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""
+Syringes the AL-1000 can drive (syringes.json), with the rates the pump can
+run each at, and the fastest rate each can run a given liquid at without
+slipping in its clamp.
+
+    table = syringes.SyringeTable.load()
+    syringe = table.find(family='B-D', cc=60)
+    max_rate = table.safe_max_rate(syringe, 'pfo')
+
+The pump's rate limits (max_rate_ml_hr / min_rate_ul_hr, in the units of the
+AL-1000 manual's table) are in syringes.json for every entry. One without them
+can be looked up, but not pumped with.
+
+Slipping is modelled as the plunger force (back-pressure in the outlet
+tubing, which goes as viscosity * flow rate, times the bore area) exceeding
+what the clamp holds, so the rate it happens at goes as
+1 / (viscosity * area). That is scaled from the observations in syringes.json
+('slip'): the slowest rate seen to slip, and the fastest run without slipping,
+for one syringe and liquid. Other syringes and liquids are run at the same
+fraction of their slip rate as that fastest rate was.
+
+How much is left in the syringe on the pump is kept in syringe_ledger.json, by
+SyringeLedger (see wpi_al1000.AL1000.ledger).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import json
+import os
+import time
+
+from run_state import write_atomic
+
+
+SYRINGE_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'syringes.json')
+
+SYRINGE_LEDGER_FILE = 'syringe_ledger.json'
+
+
+class Syringe(object):
+    """One row of the syringe table. Rates are in mL/min.
+    """
+    def __init__(self, family, cc, diameter_mm, max_rate=None,
+        min_rate=None):
+        self.family = family
+        self.cc = cc
+        self.diameter_mm = diameter_mm
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+
+    def __repr__(self):
+        return 'Syringe({!r}, {!r}, {!r})'.format(self.family, self.cc,
+            self.diameter_mm)
+
+
+class SyringeTable(object):
+    def __init__(self, syringes, liquids=None, slip=None):
+        self.syringes = syringes
+        self.liquids = liquids if liquids is not None else dict()
+        self.slip = slip
+
+    @classmethod
+    def load(cls, path=SYRINGE_TABLE):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        syringes = []
+        for row in data['syringes']:
+            max_rate = row.get('max_rate_ml_hr')
+            min_rate = row.get('min_rate_ul_hr')
+            syringes.append(Syringe(row['family'], row['cc'],
+                row['diameter_mm'],
+                # mL/hr -> mL/min
+                max_rate=None if max_rate is None else max_rate / 60.0,
+                # uL/hr -> mL/min
+                min_rate=None if min_rate is None else min_rate / (60 * 1000.0)
+            ))
+        return cls(syringes, liquids=data.get('liquids'), slip=data.get('slip'))
+
+    def families(self, cc=None):
+        """Returns the families with a syringe of cc mL (or any size).
+        """
+        return sorted(set(s.family for s in self.syringes
+            if cc is None or s.cc == cc))
+
+    def find(self, family=None, cc=None, diameter_mm=None, tolerance_mm=0.1):
+        """Returns the Syringe matching family and cc, or (if diameter_mm is
+        given) the one with the closest diameter, within tolerance_mm, of
+        those matching whichever of family and cc are given.
+
+        Raises ValueError if there is none.
+        """
+        matches = [s for s in self.syringes if
+            (family is None or s.family.lower() == family.lower()) and
+            (cc is None or s.cc == cc)]
+        if diameter_mm is not None:
+            matches = sorted([s for s in matches
+                if abs(s.diameter_mm - diameter_mm) <= tolerance_mm],
+                key=lambda s: abs(s.diameter_mm - diameter_mm))
+        if len(matches) == 0 or (diameter_mm is None and len(matches) > 1):
+            raise ValueError('no single syringe matching family={}, cc={}, '
+                'diameter_mm={}. have:\n{}'.format(family, cc, diameter_mm,
+                [(f, sorted(s.cc for s in self.syringes if s.family == f))
+                for f in self.families()]))
+        return matches[0]
+
+    def rate_limits(self, syringe):
+        """Returns (min, max) rate (mL/min) the pump can run syringe at.
+
+        Raises ValueError if syringes.json doesn't have them.
+        """
+        if syringe.min_rate is None or syringe.max_rate is None:
+            raise ValueError('no rate limits for {} {}cc in {} (add '
+                'max_rate_ml_hr and min_rate_ul_hr from the AL-1000 '
+                "manual's table)".format(syringe.family, syringe.cc,
+                os.path.basename(SYRINGE_TABLE)))
+        return syringe.min_rate, syringe.max_rate
+
+    def liquid(self, name):
+        if name not in self.liquids:
+            raise ValueError('no data for liquid {}. have: {}'.format(name,
+                sorted(self.liquids)))
+        return self.liquids[name]
+
+    def slip_rate(self, syringe, liquid):
+        """Returns the rate (mL/min) syringe is expected to slip at, pumping
+        the named liquid.
+        """
+        reference = self.find(family=self.slip['family'], cc=self.slip['cc'])
+        viscosity_ratio = (self.liquid(self.slip['liquid'])['viscosity_cp'] /
+            self.liquid(liquid)['viscosity_cp'])
+        area_ratio = (reference.diameter_mm / syringe.diameter_mm)**2
+        return self.slip['rate_ml_min'] * viscosity_ratio * area_ratio
+
+    def safety_factor(self):
+        """Returns the fraction of the slip_rate that is safe to run at: the
+        fastest rate run without slipping over the slowest seen to slip.
+        """
+        return self.slip['ok_rate_ml_min'] / self.slip['rate_ml_min']
+
+    def safe_max_rate(self, syringe, liquid=None):
+        """Returns the fastest rate (mL/min) to run syringe at: the pump's
+        maximum, or (if liquid is given) a safety_factor below the slip_rate,
+        if that is slower.
+        """
+        max_rate = self.rate_limits(syringe)[1]
+        if liquid is None or self.slip is None:
+            return max_rate
+        return min(max_rate,
+            self.slip_rate(syringe, liquid) * self.safety_factor())
+
+
+class SyringeLedger(object):
+    """How much is left in the syringe on the pump, from what it was loaded
+    with and every dispense since, saved to path (unless None) on every
+    change. The pump's own dispensed volume (DIS) resets across serial
+    sessions, so this is what carries it across runs.
+
+    A dispense is counted in full (as pending) when it is started, and then
+    as what the pump says it infused once it stops. One that is never
+    confirmed (e.g. the program died during it) stays counted in full, unless
+    reconciled with the pump (see wpi_al1000.AL1000.reconcile_ledger).
+    """
+    # What is saved.
+    FIELDS = ('syringe', 'loaded_ml', 'dispensed_ml', 'pending_ml')
+
+    def __init__(self, path=SYRINGE_LEDGER_FILE):
+        self.path = path
+        # [family, cc, liquid] of the syringe, if known.
+        self.syringe = None
+        # mL in the syringe when it was last loaded (None if never).
+        self.loaded_ml = None
+        # mL confirmed dispensed since.
+        self.dispensed_ml = 0.0
+        # mL of a started dispense, not yet confirmed.
+        self.pending_ml = 0.0
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            for k in self.FIELDS:
+                setattr(self, k, saved[k])
+
+    @property
+    def left_ml(self):
+        """mL left in the syringe (None if it was never loaded).
+        """
+        if self.loaded_ml is None:
+            return None
+        return self.loaded_ml - self.dispensed_ml - self.pending_ml
+
+    def _save(self):
+        if self.path is None:
+            return
+        state = dict((k, getattr(self, k)) for k in self.FIELDS)
+        state['updated'] = time.time()
+        write_atomic(self.path, json.dumps(state, indent=2, sort_keys=True))
+
+    def load(self, ml, syringe=None):
+        """Records the syringe as (re)filled, with ml in it.
+
+        syringe: [family, cc, liquid]. Defaults to the syringe already
+            recorded.
+        """
+        if syringe is not None:
+            self.syringe = list(syringe)
+        self.loaded_ml = ml
+        self.dispensed_ml = 0.0
+        self.pending_ml = 0.0
+        self._save()
+
+    def start(self, ml):
+        """Counts a dispense of ml as started.
+        """
+        # A previous one that was never confirmed is taken to have finished.
+        self.dispensed_ml += self.pending_ml
+        self.pending_ml = ml
+        self._save()
+
+    def confirm(self, ml):
+        """Counts the started dispense as having infused ml.
+        """
+        self.dispensed_ml += ml
+        self.pending_ml = 0.0
+        self._save()
+
+
+def main():
+    table = SyringeTable.load()
+    print('{:<10} {:>3} {:>7} {:>9} {:>9} {}'.format('family', 'cc', 'diam',
+        'min', 'max', ' '.join('{:>9}'.format(n) for n in sorted(
+        table.liquids))))
+    for s in table.syringes:
+        if s.max_rate is None:
+            print('{:<10} {:>3} {:>7.3f} (no rate limits)'.format(s.family,
+                s.cc, s.diameter_mm))
+            continue
+        min_rate, max_rate = table.rate_limits(s)
+        print('{:<10} {:>3} {:>7.3f} {:>9.5f} {:>9.3f} {}'.format(s.family,
+            s.cc, s.diameter_mm, min_rate, max_rate, ' '.join(
+            '{:>9.3f}'.format(table.safe_max_rate(s, n))
+            for n in sorted(table.liquids))))
+    print('(mL/min. Columns after max: safe max rate for each liquid)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+
+import pytest
+
+# The modules are at the top level of the repo, not in a package.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+
+from fake_al1000 import FakeAL1000
+import wpi_al1000
+
+
+@pytest.fixture
+def fake():
+    fake = FakeAL1000()
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def pump(fake):
+    pump = wpi_al1000.AL1000(port=fake.port, timeout=0.5)
+    yield pump
+    pump.serial.close()
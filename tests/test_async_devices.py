@@ -0,0 +1,120 @@
+from __future__ import print_function
+from __future__ import division
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import simulation
+from simulation import VirtualClock, SimulatedWorld, SimulatedScale
+from weighing import StreamingScale
+from async_devices import AsyncDevice, AsyncAL1000, AsyncScale
+
+
+class SlowDevice(object):
+    """Logs the real (start, end) time of each call to work, and how many
+    calls were in it at once.
+    """
+    def __init__(self):
+        self.calls = []
+        self.max_inside = 0
+        self._inside = 0
+        self._lock = threading.Lock()
+
+    def work(self, seconds):
+        with self._lock:
+            self._inside += 1
+            self.max_inside = max(self.max_inside, self._inside)
+        start = time.time()
+        time.sleep(seconds)
+        self.calls.append((start, time.time()))
+        with self._lock:
+            self._inside -= 1
+
+
+def _gather(*calls):
+    async def run():
+        return await asyncio.gather(*calls)
+    return asyncio.run(run())
+
+
+def test_read_stable_uses_scale_clock():
+    clock = VirtualClock()
+    world = SimulatedWorld(clock=clock, seed=0)
+    xy = (632, 2)
+    world.vials[simulation._key(xy)] = 20.0
+    scale = StreamingScale(SimulatedScale(world, xy, tau_s=2.0), clock=clock,
+        min_interval_s=0.5, verbose=False)
+    ascale = AsyncScale(scale)
+    try:
+        start = time.time()
+        weight_g = asyncio.run(ascale.read_stable())
+        real_s = time.time() - start
+    finally:
+        ascale.close()
+
+    assert abs(weight_g - 20.0) < 0.01
+    # Settling took many virtual seconds, of 0.5s waits, but no real ones.
+    assert len(scale.settle_times_s) == 1
+    assert scale.settle_times_s[0] > 5.0
+    assert real_s < 1.0
+
+
+def test_calls_on_one_device_run_one_at_a_time():
+    device = SlowDevice()
+    adev = AsyncDevice(device)
+    try:
+        _gather(*[adev.work(0.05) for _ in range(4)])
+    finally:
+        adev.close()
+
+    assert device.max_inside == 1
+    calls = sorted(device.calls)
+    assert all(end <= next_start for (_, end), (next_start, _) in
+        zip(calls, calls[1:]))
+
+
+def test_calls_on_different_devices_overlap():
+    devices = [SlowDevice() for _ in range(3)]
+    adevs = [AsyncDevice(d, name='dev{}'.format(k))
+        for k, d in enumerate(devices)]
+    try:
+        start = time.time()
+        _gather(*[adev.work(0.2) for adev in adevs])
+        elapsed_s = time.time() - start
+    finally:
+        for adev in adevs:
+            adev.close()
+
+    # Run one after another, they would take 0.6s.
+    assert elapsed_s < 0.4
+    assert max(d.calls[0][0] for d in devices) < min(
+        d.calls[0][1] for d in devices)
+
+
+def test_cancelled_dispense_stops_pump(fake, pump):
+    pump.set_syringe(family='B-D', cc=60)
+    pump.set_rate(20.0, unit='MM')
+    apump = AsyncAL1000(pump)
+
+    async def dispense_then_cancel():
+        task = asyncio.ensure_future(apump.dispense(50.0,
+            poll_interval_s=0.02))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        asyncio.run(dispense_then_cancel())
+    finally:
+        apump.close()
+
+    assert fake.prompt == 'S'
+    # Stopped well short of the 50 mL asked for, and the ledger says so.
+    assert 0 < fake.infused_ml < 5.0
+    assert pump.ledger.pending_ml == 0
+    assert pump.ledger.dispensed_ml == pytest.approx(fake.infused_ml,
+        abs=0.001)
@@ -0,0 +1,33 @@
+from __future__ import print_function
+from __future__ import division
+
+import calibration
+
+
+DENSITY_G_ML = 0.85
+
+
+def _rows(run, n, vol_ml, delivered_ml, drip_wait):
+    return [{'run_start_timestamp': run, 'target_vol': 2.0,
+        'commanded_vol_ml': vol_ml, 'pfo_g': delivered_ml * DENSITY_G_ML,
+        'drip_wait': drip_wait, 'vol_correction': vol_ml - 2.0}
+        for _ in range(n)]
+
+
+def mixed_history():
+    """Open loop runs at two drip waits, then a mass feedback run (recorded
+    without a drip wait) that delivered more than it was commanded.
+    """
+    return (_rows('1', 5, 2.02, 2.0, 20.0) + _rows('2', 5, 2.02, 2.0, 10.0) +
+        _rows('3', 10, 2.0, 2.2, None))
+
+
+def test_learn_drip_wait_skips_mass_feedback_rows():
+    assert calibration.learn_drip_wait(mixed_history(), 20.0,
+        DENSITY_G_ML) == 10.0
+
+
+def test_corrector_seeded_from_open_loop_rows_only():
+    corrector = calibration.make_corrector(mixed_history(), DENSITY_G_ML)
+    # The open loop runs delivered 0.02 mL under what they were commanded.
+    assert abs(corrector.correction() - 0.02) < 1e-9
@@ -0,0 +1,27 @@
+from __future__ import print_function
+from __future__ import division
+
+import io
+import select
+
+import deck
+
+
+def _no_select(*args):
+    # As on Windows, for anything but a socket.
+    raise OSError(10038, 'An operation was attempted on something that is '
+        'not a socket')
+
+
+def test_rack_swaps_without_select(monkeypatch):
+    monkeypatch.setattr(select, 'select', _no_select)
+    monkeypatch.setattr('sys.stdin', io.StringIO(u'\n\n'))
+    swaps = deck.RackSwaps()
+    swaps.request('A')
+    swaps.request('B')
+
+    swaps.poll()
+    assert swaps.pending == ['A', 'B']
+    # Each press is read (blocking) once the run needs the rack.
+    assert swaps.wait('B')
+    assert swaps.pending == []
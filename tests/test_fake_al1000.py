@@ -0,0 +1,105 @@
+from __future__ import print_function
+from __future__ import division
+
+import pytest
+
+from fake_al1000 import FakeAL1000
+from simulation import VirtualClock
+import wpi_al1000
+from wpi_al1000 import AL1000Error
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+
+@pytest.fixture
+def fake(clock):
+    fake = FakeAL1000(clock=clock)
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def pump(fake, clock):
+    pump = wpi_al1000.AL1000(port=fake.port, timeout=0.5, clock=clock)
+    yield pump
+    pump.serial.close()
+
+
+def send(pump, *commands):
+    with pump.transaction() as t:
+        for c in commands:
+            t.add(c)
+    return t.replies
+
+
+def infused_ml(pump):
+    infused, _ = wpi_al1000.parse_vol_disp(send(pump, 'DIS')[0])
+    return infused
+
+
+def test_stp_pauses_then_stops(fake, pump, clock):
+    send(pump, 'RAT1.0MM', 'VOL2.0', 'DIRINF', 'RUN')
+    assert pump.last_prompt == 'I'
+    clock.sleep(30)
+
+    # The first STP pauses the phase...
+    send(pump, 'STP')
+    assert pump.last_prompt == 'P'
+    assert infused_ml(pump) == pytest.approx(0.5)
+    clock.sleep(30)
+    assert infused_ml(pump) == pytest.approx(0.5)
+    # (settings that can't change mid-phase are still refused)
+    assert send(pump, 'VOL')[0] == '2.000ML'
+    with pytest.raises(AL1000Error) as excinfo:
+        send(pump, 'VOL1.0')
+    assert excinfo.value.code == '?NA'
+
+    # ...and RUN resumes it, for just what was left.
+    send(pump, 'RUN')
+    assert pump.last_prompt == 'I'
+    clock.sleep(120)
+    assert infused_ml(pump) == pytest.approx(2.0)
+    assert pump.last_prompt == 'S'
+
+    # A second STP stops it, so RUN starts the whole volume again.
+    send(pump, 'CLDINF', 'RUN')
+    clock.sleep(30)
+    send(pump, 'STP', 'STP')
+    assert pump.last_prompt == 'S'
+    assert infused_ml(pump) == pytest.approx(0.5)
+    send(pump, 'RUN')
+    clock.sleep(120)
+    assert infused_ml(pump) == pytest.approx(2.5)
+
+
+def test_stalls_at_capacity(fake, pump, clock):
+    fake.capacity_ml = 1.5
+    pump.set_syringe(family='B-D', cc=60)
+    pump.set_rate(1.0, unit='MM')
+
+    pump.dispense(1.0)
+    assert fake.total_infused_ml == pytest.approx(1.0)
+
+    with pytest.raises(AL1000Error) as excinfo:
+        pump.dispense(1.0)
+    err = excinfo.value
+    assert err.code == '?S'
+    assert err.prompt == 'A'
+    # Stopped where the syringe ran out, not at the end of the phase.
+    assert fake.total_infused_ml == pytest.approx(1.5)
+    assert fake.infused_ml == pytest.approx(0.5)
+    # The alarm is only reported once.
+    assert send(pump, 'DIR') == ['INF']
+    assert pump.last_prompt == 'S'
+    assert pump.ledger.pending_ml == 0
+
+    # Until refilled, any RUN stalls right away.
+    send(pump, 'CLDINF', 'RUN')
+    clock.sleep(1)
+    with pytest.raises(AL1000Error) as excinfo:
+        send(pump, 'DIS')
+    assert excinfo.value.code == '?S'
+    assert fake.total_infused_ml == pytest.approx(1.5)
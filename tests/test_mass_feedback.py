@@ -0,0 +1,58 @@
+from __future__ import print_function
+from __future__ import division
+
+import pytest
+
+import simulation
+from simulation import (VirtualClock, SimulatedWorld, SimulatedRobot,
+    SimulatedPump, SimulatedScale)
+from weighing import StreamingScale
+from mass_feedback import MassFeedbackDispenser
+
+
+class SpikingScale(object):
+    """Passes reads through to scale, except that the spike_at-th immediate
+    reading is spike_g heavier (e.g. a drop landing on the rim).
+    """
+    def __init__(self, scale, spike_at, spike_g):
+        self.scale = scale
+        self.spike_at = spike_at
+        self.spike_g = spike_g
+        self.n_immediate = 0
+
+    def read_immediate(self):
+        self.n_immediate += 1
+        weight_g = self.scale.read_immediate()
+        if self.n_immediate == self.spike_at:
+            weight_g += self.spike_g
+        return weight_g
+
+    def read_stable(self, timeout_s=None):
+        return self.scale.read_stable(timeout_s=timeout_s)
+
+
+def test_pulse_stopped_early_counts_only_what_was_dispensed():
+    clock = VirtualClock()
+    world = SimulatedWorld(clock=clock, seed=0)
+    robot = SimulatedRobot(world)
+    xy = (632, 179)
+    empty_g = world.new_vial()
+    world.vials[simulation._key(xy)] = empty_g
+    pump = SimulatedPump(world, robot, xy, rate=1.2)
+    scale = StreamingScale(SimulatedScale(world, xy, tau_s=0.1),
+        clock=clock, verbose=False)
+    # Partway through the first fine pulse (each reading takes 0.1s, and a
+    # full pulse ~15s).
+    scale = SpikingScale(scale, spike_at=20, spike_g=1.0)
+
+    target_g = 1.7
+    dispenser = MassFeedbackDispenser(pump, scale, world.density_g_ml,
+        target_g, lag_s=0.1, clock=clock)
+    result = dispenser.dispense()
+
+    # The spike stopped one pulse, and more were needed after it.
+    assert result['n_pulses'] > 1
+    dispensed_ml = pump.ledger.dispensed_ml
+    assert result['vol_ml'] == pytest.approx(dispensed_ml)
+    liquid_g = world.vials[simulation._key(xy)] - empty_g
+    assert result['vol_ml'] == pytest.approx(liquid_g / world.density_g_ml)
@@ -0,0 +1,29 @@
+from __future__ import print_function
+from __future__ import division
+
+import json
+
+import pytest
+
+import run_config
+
+
+def test_defaults_match_schema():
+    for section in run_config.SCHEMA:
+        assert set(run_config.DEFAULTS[section]) == set(
+            run_config.SCHEMA[section])
+    run_config.validate(run_config.DEFAULTS)
+
+
+def test_run_flags_from_file(tmpdir):
+    path = str(tmpdir.join('aliquot_config.json'))
+    with open(path, 'w') as f:
+        json.dump({'run': {'pipelined': True, 'trace': True}}, f)
+    run = run_config.load(path)['run']
+    assert run['pipelined'] and run['trace']
+    assert not run['report_timing'] and not run['calibrate_gripper']
+
+    with open(path, 'w') as f:
+        json.dump({'run': {'calibrate_gripper': 'yes'}}, f)
+    with pytest.raises(run_config.ConfigError, match='calibrate_gripper'):
+        run_config.load(path)
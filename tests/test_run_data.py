@@ -0,0 +1,58 @@
+from __future__ import print_function
+from __future__ import division
+
+import sqlite3
+
+import numpy as np
+
+import run_data
+import calibration
+import analysis
+
+
+def _row(run, n, commanded=None, correction=0.1):
+    return dict(run_start_timestamp=run, n=n, target_vol=2.0,
+        vol_correction=correction, pfo_g=1.7, commanded_vol_ml=commanded)
+
+
+def test_migrates_old_database(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    with conn:
+        for statement in run_data.MIGRATIONS[0]:
+            conn.execute(statement)
+        conn.execute('PRAGMA user_version = 1')
+        conn.execute('INSERT INTO aliquots (run_start_timestamp, n, '
+            'target_vol) VALUES (?, ?, ?)', ('1', 0, 2.0))
+    conn.close()
+
+    with run_data.RunData(path) as store:
+        version = store.conn.execute('PRAGMA user_version').fetchone()[0]
+        assert version == run_data.SCHEMA_VERSION
+        store.add(**_row('2', 0, commanded=2.05))
+        rows = store.rows()
+    assert rows[0]['commanded_vol_ml'] is None
+    assert rows[0]['target_vol'] == 2.0
+    assert rows[1]['commanded_vol_ml'] == 2.05
+
+
+def test_commanded_volumes_recorded_or_inferred(tmp_path):
+    rows = [
+        # Old rows: inferred from the previous row's correction.
+        _row('1', 0, correction=0.1),
+        _row('1', 1, correction=0.2),
+        # New rows (e.g. pipelined, where the corrections interleave):
+        # as recorded.
+        _row('2', 0, commanded=2.3, correction=0.1),
+        _row('2', 1, commanded=2.3, correction=0.2)
+    ]
+    expected = [None, 2.1, 2.3, 2.3]
+    assert calibration.commanded_volumes(rows) == expected
+
+    with run_data.RunData(str(tmp_path / 'new.db')) as store:
+        for row in rows:
+            store.add(**row)
+        assert calibration.commanded_volumes(store.rows()) == expected
+        commanded = analysis.commanded_ml(analysis.load(store))
+    assert np.isnan(commanded[0])
+    assert np.allclose(commanded[1:], expected[1:])
@@ -0,0 +1,111 @@
+from __future__ import print_function
+from __future__ import division
+
+import pytest
+
+import simulation
+from calibration import ConstantCorrection
+from run_data import RunData
+from run_recorder import RunRecorder
+from simulation import VirtualClock
+from scheduler import (SerialScheduler, PipelinedScheduler,
+    throughput_vials_per_hour)
+
+
+class RecordingScheduler(PipelinedScheduler):
+    """Logs (time, resource, vial, 'acquire' / 'release') as the vials take
+    and give up resources.
+    """
+    def __init__(self, workcell, **kwargs):
+        super(RecordingScheduler, self).__init__(workcell, **kwargs)
+        self.log = []
+
+    def _acquire(self, resource, n):
+        super(RecordingScheduler, self)._acquire(resource, n)
+        self.log.append((self.workcell.clock.time(), resource, n, 'acquire'))
+
+    def _release(self, resource):
+        n = self._holders[resource]
+        self.log.append((self.workcell.clock.time(), resource, n, 'release'))
+        super(RecordingScheduler, self)._release(resource)
+
+
+@pytest.mark.parametrize('staging', [True, False])
+def test_pipelined_never_shares_a_resource(staging):
+    n_vials = 12
+    vol_ml = 2.0
+    wc = simulation.make_workcell(clock=VirtualClock(), staging=staging,
+        scale_noise_g=0.0, seed=0)
+    scheduler = RecordingScheduler(wc)
+    results, _ = simulation.simulate(n_vials, workcell=wc,
+        scheduler_class=lambda workcell: scheduler, vol_ml=vol_ml)
+    assert sorted(r['n'] for r in results) == list(range(n_vials))
+
+    holders = dict()
+    for t, resource, n, event in scheduler.log:
+        if event == 'acquire':
+            assert holders.get(resource) is None, \
+                'vial {} took {} from vial {} at {}'.format(n, resource,
+                holders[resource], t)
+            holders[resource] = n
+        else:
+            assert holders[resource] == n
+            holders[resource] = None
+    assert all(n is None for n in holders.values())
+
+    # Each vial was weighed with just its own liquid in it.
+    world = wc.robot.world
+    for r in results:
+        assert r['full_vial_g'] - r['empty_vial_g'] == pytest.approx(
+            vol_ml * world.density_g_ml, abs=0.01)
+    assert world.spilled_ml == 0
+
+
+def test_pipelined_overlaps_vials():
+    results = dict()
+    for scheduler_class in (SerialScheduler, PipelinedScheduler):
+        results[scheduler_class], _ = simulation.simulate(8,
+            scheduler_class=scheduler_class, clock=VirtualClock(), seed=0)
+    assert (throughput_vials_per_hour(results[PipelinedScheduler]) >
+        throughput_vials_per_hour(results[SerialScheduler]))
+
+
+# (The vial thread that finds the deadlock also raises it.)
+@pytest.mark.filterwarnings(
+    'ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_one_more_vial_in_flight_deadlocks():
+    clock = VirtualClock()
+    wc = simulation.make_workcell(clock=clock, seed=0)
+    assert 'scale' in wc.stations
+    default = PipelinedScheduler(wc)
+    assert default.max_in_flight == len(wc.stations) - 1
+
+    scheduler = PipelinedScheduler(wc, max_in_flight=len(wc.stations))
+    with pytest.raises(RuntimeError, match='deadlock'):
+        scheduler.run(simulation.vial_order(wc.vialbox, 6), lambda: 2.0,
+            lambda result: None)
+
+
+def test_resume_mass_feedback_vial_stopped_mid_fill(tmpdir):
+    wc = simulation.make_workcell(clock=VirtualClock(), mass_feedback_g=1.7,
+        seed=0)
+    store = RunData(str(tmpdir.join('run_data.db')))
+    recorder = RunRecorder(wc.vialbox, ConstantCorrection(0.0), 2.0,
+        wc.robot.world.density_g_ml, store=store, pump=wc.pump,
+        clock=wc.clock)
+    # As journaled with the vial set down on the scale, partway through
+    # filling it (so before fill_on_scale could say how much went in).
+    resume = {'n': 0, 'i': 0, 'j': 0, 'done': ['fetch'],
+        'phase': 'fill_on_scale', 'holding': False,
+        'result': {'vol_ml': None, 'empty_vial_g': None}}
+
+    results = SerialScheduler(wc).run(simulation.vial_order(wc.vialbox, 2),
+        recorder.get_volume, recorder.on_done, resume=resume)
+
+    assert results[0]['interrupted_dispense']
+    assert results[0]['vol_ml'] is None
+    assert not results[1]['interrupted_dispense']
+    # Only the vial filled start to finish says anything about the pump.
+    rows = store.rows()
+    assert [r['n'] for r in rows] == [1]
+    assert rows[0]['commanded_vol_ml'] == pytest.approx(results[1]['vol_ml'])
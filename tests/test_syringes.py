@@ -0,0 +1,38 @@
+from __future__ import print_function
+from __future__ import division
+
+import pytest
+
+import syringes
+
+
+@pytest.fixture
+def table():
+    return syringes.SyringeTable.load()
+
+
+def test_rate_limits_from_manual(table):
+    min_rate, max_rate = table.rate_limits(table.find(family='B-D', cc=60))
+    assert max_rate == pytest.approx(1699 / 60.0)
+    assert min_rate == pytest.approx(23.35 / 60000.0)
+
+
+def test_every_syringe_has_rate_limits(table):
+    for syringe in table.syringes:
+        min_rate, max_rate = table.rate_limits(syringe)
+        assert 0 < min_rate < max_rate
+
+
+def test_rate_limits_not_extrapolated(table):
+    syringe = syringes.Syringe('B-D', 20, 19.05)
+    with pytest.raises(ValueError, match='B-D 20cc'):
+        table.rate_limits(syringe)
+    with pytest.raises(ValueError):
+        table.safe_max_rate(syringe, 'pfo')
+
+
+def test_pfo_default_rate(table):
+    syringe = table.find(family='B-D', cc=60)
+    assert table.safe_max_rate(syringe, 'pfo') <= 1.2
+    assert table.safe_max_rate(syringe, 'pfo') == pytest.approx(
+        table.slip['ok_rate_ml_min'])
@@ -0,0 +1,224 @@
+from __future__ import print_function
+from __future__ import division
+
+import time
+
+import pytest
+
+import wpi_al1000
+from wpi_al1000 import STX, ETX, AL1000Error, AL1000Timeout
+import fake_al1000
+
+
+def test_reply_split_across_reads(fake, pump):
+    fake.faults['DIA'] = 'split'
+    start = time.time()
+    assert pump.get_diam() == 26.59
+    assert time.time() - start >= fake_al1000.SPLIT_S
+
+
+def test_missing_etx_times_out_at_deadline(fake, pump):
+    fake.faults['VER'] = 'no_etx'
+    start = time.time()
+    with pytest.raises(AL1000Timeout):
+        pump.get_firmware()
+    elapsed_s = time.time() - start
+    assert pump.timeout <= elapsed_s < pump.timeout + 0.25
+
+    # The partial reply is not taken as (part of) the next one.
+    del fake.faults['VER']
+    assert pump.get_firmware() == 'NE1000V3.928'
+
+
+def test_stale_bytes_discarded(fake, pump):
+    fake.send_raw(STX + b'00S?' + ETX)
+    deadline = time.time() + 1.0
+    while pump.serial.in_waiting == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    assert pump.serial.in_waiting > 0
+
+    assert pump.get_diam() == 26.59
+    assert pump.last_prompt == 'S'
+
+
+def test_command_stats(fake, pump):
+    fake.reply_delay_s = 0.02
+    with pump.transaction() as t:
+        t.add('DIA')
+        t.add('VER')
+        t.add('DIA')
+
+    dia = pump.command_stats['DIA']
+    assert dia.count == 2
+    assert dia.bytes_sent == 2 * len(b'DIA\r')
+    # <STX> 00 S 26.59 <ETX>
+    assert dia.bytes_received == 2 * 10
+    ver = pump.command_stats['VER']
+    assert ver.count == 1
+    assert ver.bytes_received == len(b'\x0200SNE1000V3.928\x03')
+
+    # Latency is from the one write, so replies read later took longer.
+    assert ver.max_latency_s >= 2 * fake.reply_delay_s
+    assert dia.max_latency_s >= 3 * fake.reply_delay_s
+    assert dia.total_latency_s >= dia.max_latency_s
+    assert dia.mean_latency_s == pytest.approx(dia.total_latency_s / 2)
+
+
+def test_transaction_replies_in_command_order(fake, pump):
+    fake.faults['VER'] = 'split'
+    with pump.transaction() as t:
+        dir_idx = t.add('DIRWDR')
+        t.add('VOL2.5')
+        t.add('VER')
+        t.add('DIR')
+        t.add('VOL')
+        t.add('DIA')
+    assert dir_idx == 0
+    assert t.replies == ['', '', 'NE1000V3.928', 'WDR', '2.500ML', '26.59']
+    # All in one write.
+    assert fake.direction == 'WDR'
+    assert fake.volume == 2.5
+
+
+@pytest.mark.parametrize('code', ['?NA', '?OOR', '?COM'])
+def test_transaction_raises_first_error_after_draining(fake, pump, code):
+    pump.get_diam()
+    fake.faults['VOL'] = code
+    fake.faults['DIR'] = '?'
+    with pytest.raises(AL1000Error) as excinfo:
+        with pump.transaction() as t:
+            t.add('DIA')
+            t.add('VOL2.5')
+            t.add('DIRWDR')
+            t.add('VER')
+
+    err = excinfo.value
+    assert err.command == 'VOL2.5'
+    assert err.code == code
+    assert err.replies == ['26.59', code, '?', 'NE1000V3.928']
+    assert pump.command_stats['VER'].count == 1
+    assert t.replies is None
+    assert fake.volume == 0.0
+
+    # Nothing left unread to be taken as the reply to the next command.
+    del fake.faults['VOL']
+    assert pump.get_vol() == 0.0
+
+
+def test_timeout_invalidates_cached_settings(fake, pump):
+    pump.get_diam()
+    pump.set_vol(1.0)
+    # The pump applies the new volume, but the batch's replies are lost.
+    fake.faults['VER'] = 'drop'
+    with pytest.raises(AL1000Timeout):
+        with pump.transaction() as t:
+            pump.set_vol(2.0, transaction=t)
+            t.add('VER')
+    assert fake.volume == 2.0
+
+    del fake.faults['VER']
+    pump.set_vol(1.0)
+    assert fake.volume == 1.0
+
+    fake.faults['VOL'] = 'drop'
+    with pytest.raises(AL1000Timeout):
+        pump.set_vol(3.0)
+    del fake.faults['VOL']
+    pump.set_vol(1.0)
+    assert fake.volume == 1.0
+
+
+@pytest.mark.parametrize('alarm', ['?R', '?S'])
+def test_transaction_raises_alarms(fake, pump, alarm):
+    pump.get_diam()
+    fake.alarm = alarm
+    with pytest.raises(AL1000Error) as excinfo:
+        with pump.transaction() as t:
+            t.add('DIA')
+            t.add('VER')
+
+    err = excinfo.value
+    assert err.command == 'DIA'
+    assert err.code == alarm
+    assert err.prompt == 'A'
+    assert err.replies == [alarm, 'NE1000V3.928']
+    assert str(err).endswith('({})'.format(wpi_al1000.ALARM_CODES[alarm]))
+    if alarm == '?R':
+        # Nothing known about the settings survives a power cycle.
+        assert pump._cache == dict()
+
+
+def test_dispense_error_stops_pump_and_settles_ledger(fake, pump):
+    pump.set_syringe(family='B-D', cc=60)
+    # So RUN starts a phase, even though the VOL for this dispense fails.
+    fake.volume = 5.0
+    fake.faults['VOL'] = '?OOR'
+    with pytest.raises(AL1000Error):
+        pump.dispense(1.0, block=False)
+
+    assert fake.prompt == 'S'
+    assert fake.infused_ml < 5.0
+    assert pump.ledger.pending_ml == 0
+    assert pump.ledger.dispensed_ml == pytest.approx(fake.infused_ml,
+        abs=0.001)
+
+
+def test_dispense_timeout_stops_pump_and_settles_ledger(fake, pump):
+    pump.set_syringe(family='B-D', cc=60)
+    fake.faults['RUN'] = 'drop'
+    start = time.time()
+    with pytest.raises(AL1000Timeout):
+        pump.dispense(5.0, block=False)
+    assert time.time() - start >= pump.timeout
+
+    # RUN went through, so some was infused before STP.
+    assert fake.prompt == 'S'
+    assert 0 < fake.infused_ml < 5.0
+    assert pump.ledger.pending_ml == 0
+    assert pump.ledger.dispensed_ml == pytest.approx(fake.infused_ml,
+        abs=0.001)
+
+
+def test_dispense_poll_raises_error_replies(fake, pump):
+    pump.set_syringe(family='B-D', cc=60)
+    handle = pump.dispense(5.0, block=False)
+    fake.faults['DIS'] = '?COM'
+    with pytest.raises(AL1000Error) as excinfo:
+        handle.poll()
+    assert excinfo.value.code == '?COM'
+    assert handle.end_time is None
+
+    del fake.faults['DIS']
+    handle.cancel()
+    assert fake.prompt == 'S'
+    assert pump.ledger.dispensed_ml == pytest.approx(fake.infused_ml,
+        abs=0.001)
+
+
+def test_dispense_paused_counts_as_stopped(fake, pump):
+    pump.set_syringe(family='B-D', cc=60)
+    handle = pump.dispense(5.0, block=False)
+    time.sleep(0.2)
+    # As if paused from the pump's panel.
+    with fake._lock:
+        fake._update()
+        fake.prompt = 'P'
+
+    assert handle.wait(timeout=1.0)
+    assert fake.prompt == 'S'
+    assert 0 < handle.volume_dispensed < 5.0
+    assert pump.ledger.pending_ml == 0
+    assert pump.ledger.dispensed_ml == pytest.approx(fake.infused_ml,
+        abs=0.001)
+
+
+def test_dispense_stall_counts_what_was_infused(fake, pump):
+    pump.set_syringe(family='B-D', cc=60)
+    pump.set_rate(20.0, unit='MM')
+    fake.capacity_ml = 0.1
+    handle = pump.dispense(5.0, block=False, poll_interval_s=0.02)
+    with pytest.raises(AL1000Error) as excinfo:
+        handle.wait(timeout=2.0)
+    assert excinfo.value.code == '?S'
+    assert handle.volume_dispensed == pytest.approx(0.1, abs=0.001)
+    assert pump.ledger.dispensed_ml == pytest.approx(0.1, abs=0.001)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+Records spans (named intervals, tagged with device, command, vial, ...) and
+writes them as a Chrome trace JSON file, which can be opened in
+chrome://tracing or ui.perfetto.dev to see serial stalls and idle time on a
+timeline.
+
+    tracing.start('trace.json')
+    with tracing.span('weigh_vial', device='scale', vial=3):
+        ...
+    tracing.stop()
+
+Each device gets its own row, and spans without a device go on the row of the
+thread that made them. While tracing is not started, span returns a shared
+no-op context manager, so leaving the calls in costs next to nothing.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+_tracer = None
+_local = threading.local()
+
+
+class Tracer(object):
+    """Collects Chrome trace events in memory, until save is called.
+    """
+    def __init__(self, path, clock=time):
+        self.path = path
+        self.clock = clock
+        self.events = []
+        self._start = clock.time()
+        # Thread ident or device name -> Chrome trace tid
+        self._tids = dict()
+        self._lock = threading.Lock()
+
+    def _tid(self, device):
+        key = device if device is not None else threading.current_thread()
+        tid = self._tids.get(key)
+        if tid is not None:
+            return tid
+        with self._lock:
+            tid = self._tids.get(key)
+            if tid is None:
+                tid = len(self._tids) + 1
+                self._tids[key] = tid
+                name = device if device is not None else key.name
+                self.events.append({'name': 'thread_name', 'ph': 'M',
+                    'pid': 1, 'tid': tid, 'args': {'name': name}})
+        return tid
+
+    def _us(self, t):
+        return (t - self._start) * 1e6
+
+    def add(self, name, start, end, device=None, args=None):
+        """Records a span from clock time start to end.
+        """
+        event = {'name': name, 'ph': 'X', 'pid': 1, 'tid': self._tid(device),
+            'ts': self._us(start), 'dur': self._us(end) - self._us(start)}
+        if device is not None:
+            event['cat'] = device
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def instant(self, name, device=None, args=None):
+        event = {'name': name, 'ph': 'i', 's': 't', 'pid': 1,
+            'tid': self._tid(device), 'ts': self._us(self.clock.time())}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'},
+                f)
+
+
+def start(path, clock=time):
+    """Starts recording spans, to be written to path by stop.
+    """
+    global _tracer
+    if _tracer is not None:
+        raise RuntimeError('already tracing to {}'.format(_tracer.path))
+    _tracer = Tracer(path, clock=clock)
+    return _tracer
+
+
+def stop():
+    """Stops recording, and writes the trace file.
+    """
+    global _tracer
+    tracer = _tracer
+    if tracer is None:
+        return None
+    _tracer = None
+    tracer.save()
+    return tracer.path
+
+
+def enabled():
+    return _tracer is not None
+
+
+def _current_tags():
+    return getattr(_local, 'tags', None)
+
+
+@contextmanager
+def _span(tracer, name, device, tags):
+    start = tracer.clock.time()
+    try:
+        yield
+    finally:
+        args = _current_tags()
+        if args:
+            args = dict(args)
+            args.update(tags)
+        else:
+            args = tags
+        tracer.add(name, start, tracer.clock.time(), device=device,
+            args=args)
+
+
+def span(name, device=None, **tags):
+    """Returns a context manager recording its body as a span.
+
+    device: name of the row to put the span on (e.g. 'pump'). Defaults to the
+        current thread.
+    tags: recorded with the span (e.g. command='RUN')
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _span(tracer, name, device, tags)
+
+
+def instant(name, device=None, **tags):
+    """Records a point event (e.g. an alarm), if tracing.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return
+    args = dict(_current_tags() or {})
+    args.update(tags)
+    tracer.instant(name, device=device, args=args)
+
+
+@contextmanager
+def tags(**new_tags):
+    """Adds tags (e.g. vial=n) to all spans made by this thread in the body.
+    """
+    old = _current_tags()
+    merged = dict(old or {})
+    merged.update(new_tags)
+    _local.tags = merged
+    try:
+        yield
+    finally:
+        _local.tags = old
+
+
+def _traced(method, device, method_name):
+    def traced(*args, **kwargs):
+        if _tracer is None:
+            return method(*args, **kwargs)
+        with span(method_name, device=device,
+            args=', '.join(repr(a) for a in args)):
+            return method(*args, **kwargs)
+    return traced
+
+
+def trace_methods(obj, device, method_names):
+    """Records a span for every call of each of obj's methods in
+    method_names, with the arguments as the 'args' tag.
+
+    For devices whose code is not in this repository (e.g. the MAPLE robot).
+    Only calls made while tracing are recorded. Returns a function that
+    undoes this.
+    """
+    # Name -> instance attribute it replaced (None if it was on the class)
+    replaced = dict()
+    for method_name in method_names:
+        replaced[method_name] = obj.__dict__.get(method_name)
+        # Instance attributes take precedence over the class methods.
+        setattr(obj, method_name, _traced(getattr(obj, method_name), device,
+            method_name))
+
+    def undo():
+        for method_name, original in replaced.items():
+            if original is None:
+                delattr(obj, method_name)
+            else:
+                setattr(obj, method_name, original)
+    return undo
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""
+What is in every vial box slot, saved to vial_map.json on every change, so a
+run can carry on with a partly done box, or redo failed vials, without the
+operator saying which.
+
+Each slot is one of:
+empty: no vial
+present: an empty vial, to be filled
+out: its vial was taken from it, and has not been recorded as done since
+filled: its vial was filled (with the aliquot # and measured masses)
+failed: filling its vial was interrupted, or its mass was out of tolerance
+skipped: not to be used (e.g. filled before there was a vial map)
+
+    vial_map = VialMap(deck, racks)
+    vial_map.state(i, j)
+    vial_map.first('present')
+    vial_map.set(i, j, 'out')
+
+Lookups by slot, and of the first slot in a state, don't depend on the number
+of slots. Slots are kept per rack position (offset and region used), so each
+position keeps its state across runs that use it with others. A position
+never used before starts as all present.
+
+    ./vial_map.py                    # each rack's slots
+    ./vial_map.py --set empty A:D3   # e.g. a slot missing a vial
+    ./vial_map.py --reset A          # e.g. a fresh box of empty vials
+
+(racks by name, as last used)
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import os
+import time
+from collections import OrderedDict
+
+from run_state import write_atomic
+
+
+VIAL_MAP_FILE = 'vial_map.json'
+
+STATES = ('empty', 'present', 'out', 'filled', 'failed', 'skipped')
+
+# For printing maps.
+STATE_CHARS = {
+    'empty': '.',
+    'present': 'o',
+    'out': '>',
+    'filled': '#',
+    'failed': 'x',
+    'skipped': '-'
+}
+
+
+# What identifies a rack position.
+LAYOUT_KEYS = ('offset', 'letters', 'nums')
+
+
+def _same_layout(saved, rack):
+    # (lists, as read back from JSON)
+    return all(saved[k] == list(rack[k]) for k in LAYOUT_KEYS)
+
+
+def _load(path):
+    if not os.path.exists(path):
+        return {'racks': []}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _save(path, data):
+    write_atomic(path, json.dumps(data, indent=1, sort_keys=True))
+
+
+class VialMap(object):
+    """The state of every slot of a deck.Deck.
+
+    racks: the deck's racks, as from run_config.racks.
+    """
+    def __init__(self, deck, racks, path=VIAL_MAP_FILE):
+        self.deck = deck
+        self.path = path
+        # Slots in the order first looks through them.
+        self._order = deck.stream(deck.n_slots)
+
+        # Rack positions in the file that are not on this deck are kept as
+        # they are.
+        self._data = _load(path)
+        # deck (i, j) -> {'state': ..., and any measurements}
+        self._slots = dict()
+        for r, rack in enumerate(racks):
+            saved = [x for x in self._data['racks'] if _same_layout(x, rack)]
+            if len(saved) > 0:
+                saved = saved[0]
+            else:
+                saved = dict((k, list(rack[k])) for k in LAYOUT_KEYS)
+                saved['slots'] = dict()
+                self._data['racks'].append(saved)
+            saved['name'] = rack['name']
+            saved['used'] = time.time()
+            for i, j in deck.rack_ijs(r):
+                label = deck.rack_label(i, j)
+                if label not in saved['slots']:
+                    saved['slots'][label] = {'state': 'present'}
+                self._slots[(i, j)] = saved['slots'][label]
+        self._index()
+        _save(self.path, self._data)
+
+    def _index(self):
+        # state -> slots in that state, in order (as keys).
+        self._by_state = dict((s, OrderedDict()) for s in STATES)
+        for ij in self._order:
+            self._by_state[self._slots[ij]['state']][ij] = None
+
+    def state(self, i, j):
+        return self._slots[(i, j)]['state']
+
+    def get(self, i, j):
+        """Returns a copy of everything recorded for the slot.
+        """
+        return dict(self._slots[(i, j)])
+
+    def first(self, state):
+        """Returns (i, j) of the first slot in state, or None.
+
+        Slots are in deck index order, except that those set to state since
+        the map was loaded (or reset) go after the rest.
+        """
+        for ij in self._by_state[state]:
+            return ij
+        return None
+
+    def slots(self, state):
+        """Returns (i, j) of every slot in state, in the order of first.
+        """
+        return list(self._by_state[state])
+
+    def count(self, state):
+        return len(self._by_state[state])
+
+    def counts(self):
+        return dict((s, len(slots)) for s, slots in self._by_state.items())
+
+    def set(self, i, j, state, **fields):
+        """Sets the state of slot (i, j) (and any measurements), and saves.
+        """
+        if state not in STATES:
+            raise ValueError('unknown state {!r}. states: {}'.format(state,
+                STATES))
+        entry = self._slots[(i, j)]
+        del self._by_state[entry['state']][(i, j)]
+        if state in ('empty', 'present'):
+            # Nothing recorded is about the vial there now.
+            entry.clear()
+        entry.update(fields)
+        entry['state'] = state
+        entry['updated'] = time.time()
+        self._by_state[state][(i, j)] = None
+        _save(self.path, self._data)
+
+    def reset(self, ijs, state='present', from_states=None):
+        """Sets the state of all of ijs (that are in one of from_states, if
+        given), saving once.
+        """
+        for ij in ijs:
+            entry = self._slots[tuple(ij)]
+            if from_states is not None and entry['state'] not in from_states:
+                continue
+            entry.clear()
+            entry['state'] = state
+            entry['updated'] = time.time()
+        self._index()
+        _save(self.path, self._data)
+
+
+def run_vials(vial_map, n_vials, rack_ijs=None, swap_racks=False):
+    """Returns (ijs, ns) for a run filling n_vials vials: aliquot #n is in
+    slot ijs[n] (as from deck.Deck.stream, with rack_ijs), and ns are the
+    aliquot #s to fill.
+
+    The first time through the racks, only present slots are filled. After
+    that (if swap_racks), every slot is, as the racks will have been swapped
+    for ones of empty vials. Otherwise ns may be short of n_vials.
+    """
+    deck = vial_map.deck
+    order = deck.stream(deck.n_slots, rack_ijs=rack_ijs)
+    ijs = []
+    ns = []
+    while len(ns) < n_vials:
+        n = len(ijs)
+        if n == len(order) and not swap_racks:
+            break
+        i, j = order[n % len(order)]
+        if n >= len(order) or vial_map.state(i, j) == 'present':
+            ns.append(n)
+        ijs.append((i, j))
+    return ijs, ns
+
+
+def print_out_vials(vial_map):
+    """Warns about slots whose vials were taken out and not recorded as done
+    (e.g. if a run was stopped), which are not filled until set otherwise.
+    """
+    out = vial_map.slots('out')
+    if len(out) == 0:
+        return
+    print('The vials from {} were taken out and not recorded as done. Check '
+        'them, and set their state with ./vial_map.py --set'.format(', '.join(
+        '{}{}'.format(*vial_map.deck.coord_label(i, j)) for i, j in out)))
+
+
+def print_vial_counts(vial_map):
+    counts = vial_map.counts()
+    print('Vial map: ' + ', '.join('{} {}'.format(counts[s], s)
+        for s in STATES if counts[s] > 0))
+
+
+def _letters_nums(rack):
+    letters = [chr(x) for x in range(ord(rack['letters'][0]),
+        ord(rack['letters'][1]) + 1)]
+    nums = list(range(rack['nums'][0], rack['nums'][1] + 1))
+    return letters, nums
+
+
+def _rack_named(data, name):
+    """Returns the rack position in a vial map file last used as rack name,
+    or None.
+    """
+    named = [x for x in data['racks'] if x['name'] == name]
+    if len(named) == 0:
+        return None
+    return max(named, key=lambda x: x['used'])
+
+
+def print_map(data):
+    """Prints a grid of each rack position's slots (see STATE_CHARS), from the
+    data in a vial map file.
+    """
+    print('  '.join('{} {}'.format(STATE_CHARS[s], s) for s in STATES))
+    for rack in sorted(data['racks'], key=lambda x: (x['name'], -x['used'])):
+        letters, nums = _letters_nums(rack)
+        counts = dict()
+        print('\nRack {} (at {}, last used {})'.format(rack['name'],
+            rack['offset'], time.strftime('%Y-%m-%d %H:%M',
+            time.localtime(rack['used']))))
+        print('   ' + ' '.join(letters))
+        for num in nums:
+            chars = []
+            for letter in letters:
+                state = rack['slots'].get('{}{}'.format(letter, num),
+                    {'state': 'present'})['state']
+                counts[state] = counts.get(state, 0) + 1
+                chars.append(STATE_CHARS[state])
+            print('{:>2} {}'.format(num, ' '.join(chars)))
+        print(', '.join('{} {}'.format(counts[s], s) for s in STATES
+            if s in counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shows or changes what is '
+        'in each vial box slot.')
+    parser.add_argument('--map', default=VIAL_MAP_FILE,
+        help='(default: %(default)s)')
+    parser.add_argument('--set', nargs='+', metavar=('STATE', 'SLOT'),
+        help='sets slots (e.g. A:D3) to STATE (one of: {})'.format(
+        ', '.join(STATES)))
+    parser.add_argument('--reset', nargs='+', metavar='RACK',
+        help='sets every slot of the racks to present (e.g. after putting '
+        'in a box of empty vials)')
+    args = parser.parse_args()
+
+    data = _load(args.map)
+    if args.set is not None:
+        state = args.set[0]
+        if state not in STATES or len(args.set) < 2:
+            parser.error('--set takes a state ({}) and slots'.format(
+                ', '.join(STATES)))
+        for slot in args.set[1:]:
+            name, _, label = slot.rpartition(':')
+            rack = _rack_named(data, name)
+            if rack is None:
+                parser.error('no rack {!r} in {} (slots are e.g. A:D3)'.format(
+                    name, args.map))
+            letters, nums = _letters_nums(rack)
+            if label not in ['{}{}'.format(l, n) for l in letters
+                for n in nums]:
+                parser.error('no slot {} in rack {}'.format(label, name))
+            rack['slots'][label] = {'state': state, 'updated': time.time()}
+    if args.reset is not None:
+        for name in args.reset:
+            rack = _rack_named(data, name)
+            if rack is None:
+                parser.error('no rack {!r} in {}'.format(name, args.map))
+            rack['slots'] = dict()
+    if args.set is not None or args.reset is not None:
+        _save(args.map, data)
+    print_map(data)
+
+
+if __name__ == '__main__':
+    main()
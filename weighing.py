@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+Decides for ourselves when the scale has settled, from a stream of immediate
+(possibly unstable) readings, rather than repeatedly asking the scale for a
+stable weight.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import time
+from collections import deque
+
+import tracing
+
+
+class StabilityTimeout(IOError):
+    pass
+
+
+class StabilityDetector(object):
+    """Considers a stream of (time, weight) samples stable once the last
+    `window` of them have a standard deviation of at most max_sd_g and a
+    least-squares slope of at most max_slope_g_s in magnitude.
+    """
+    def __init__(self, window=5, max_sd_g=0.002, max_slope_g_s=0.002):
+        if window < 2:
+            raise ValueError('window must be at least 2 samples')
+        self.window = window
+        self.max_sd_g = max_sd_g
+        self.max_slope_g_s = max_slope_g_s
+        self.samples = deque(maxlen=window)
+
+    def reset(self):
+        self.samples.clear()
+
+    def add(self, t, weight):
+        """Adds a sample, returning whether the window is now stable.
+        """
+        self.samples.append((t, weight))
+        return self.is_stable()
+
+    def is_stable(self):
+        n = len(self.samples)
+        if n < self.window:
+            return False
+
+        mean_t = sum(t for t, _ in self.samples) / n
+        mean_w = sum(w for _, w in self.samples) / n
+        var_w = sum((w - mean_w)**2 for _, w in self.samples) / (n - 1)
+        if var_w**0.5 > self.max_sd_g:
+            return False
+
+        ss_t = sum((t - mean_t)**2 for t, _ in self.samples)
+        if ss_t > 0:
+            slope = sum((t - mean_t) * (w - mean_w)
+                for t, w in self.samples) / ss_t
+            if abs(slope) > self.max_slope_g_s:
+                return False
+        return True
+
+    def value(self):
+        """Returns the mean weight over the current window.
+        """
+        return sum(w for _, w in self.samples) / len(self.samples)
+
+
+def read_until_stable(detector, read, clock, timeout_s, min_interval_s=0.0):
+    """Calls read (returning a weight) until detector is satisfied with the
+    readings, at most every min_interval_s.
+
+    Returns (mean weight over the stable window, seconds it took). Raises
+    StabilityTimeout if not stable within timeout_s.
+    """
+    detector.reset()
+    start = clock.time()
+    deadline = start + timeout_s
+    last_read = None
+    while True:
+        now = clock.time()
+        if now > deadline:
+            raise StabilityTimeout('weight not stable within {} seconds '
+                '(last readings: {})'.format(timeout_s,
+                [w for _, w in detector.samples]))
+
+        if last_read is not None and min_interval_s > 0:
+            wait_s = last_read + min_interval_s - now
+            if wait_s > 0:
+                clock.sleep(wait_s)
+        last_read = clock.time()
+
+        if detector.add(last_read, read()):
+            break
+    return detector.value(), clock.time() - start
+
+
+class StreamingScale(object):
+    """Wraps a mettler_toledo_device.MettlerToledoDevice (or anything with
+    get_weight and zero_stable), reading immediate weights as fast as the scale
+    will give them, until a StabilityDetector is satisfied.
+    """
+    def __init__(self, scale, window=5, max_sd_g=0.002, max_slope_g_s=0.002,
+        timeout_s=30.0, min_interval_s=0.0, verbose=True, clock=time):
+        """
+        timeout_s: default limit on how long any one read_stable / zero call
+            can take.
+        min_interval_s: minimum time between immediate reads. 0 reads at the
+            rate the scale answers.
+        clock: provides time() and sleep(). Defaults to the time module.
+        """
+        self.scale = scale
+        self.detector = StabilityDetector(window=window, max_sd_g=max_sd_g,
+            max_slope_g_s=max_slope_g_s)
+        self.timeout_s = timeout_s
+        self.min_interval_s = min_interval_s
+        self.verbose = verbose
+        self.clock = clock
+
+        # Seconds from the start of each read_stable call until stable, for
+        # tuning how long to wait after setting a vial down.
+        self.settle_times_s = []
+
+    def read_immediate(self):
+        """Returns the current weight in grams, stable or not.
+        """
+        # First two elements are float value and str repr of unit (e.g. 'g')
+        with tracing.span('read_immediate', device='scale'):
+            ret = self.scale.get_weight()
+        assert ret[1] == 'g', \
+            'expected scale units in grams (got {})'.format(ret[1])
+        return ret[0]
+
+    def read_stable(self, timeout_s=None, read=None):
+        """Returns weight in grams, as soon as readings are stable.
+
+        Raises StabilityTimeout if they are not stable within timeout_s.
+
+        read: called for each reading. Defaults to read_immediate.
+        """
+        if timeout_s is None:
+            timeout_s = self.timeout_s
+        if read is None:
+            read = self.read_immediate
+
+        with tracing.span('read_stable', device='scale'):
+            if self.verbose:
+                print('Waiting for stable weight... ', end='')
+                sys.stdout.flush()
+
+            weight_g, settle_time_s = read_until_stable(self.detector, read,
+                self.clock, timeout_s, min_interval_s=self.min_interval_s)
+
+            self.settle_times_s.append(settle_time_s)
+            if self.verbose:
+                print('done ({:.1f}s)'.format(settle_time_s))
+            return weight_g
+
+    def zero(self, timeout_s=None):
+        """Zeroes the scale, once readings are stable.
+        """
+        if timeout_s is None:
+            timeout_s = self.timeout_s
+        deadline = self.clock.time() + timeout_s
+
+        self.read_stable(timeout_s=timeout_s)
+        while not self.scale.zero_stable():
+            if self.clock.time() > deadline:
+                raise StabilityTimeout('could not zero scale within {} '
+                    'seconds'.format(timeout_s))
+            self.clock.sleep(self.min_interval_s)
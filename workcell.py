@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+
+"""
+The individual robot / pump / scale operations that make up aliquoting a vial,
+so they can be sequenced either one vial at a time or pipelined (see
+scheduler.py).
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import tracing
+from motion_batch import MotionBatch
+from run_state import write_atomic
+
+
+try:
+    input = raw_input
+except NameError:
+    pass
+
+
+# Gripper timing and positions, written by Gripper.save_config.
+GRIPPER_CONFIG = 'gripper_config.json'
+
+
+def move_gripper_servo(robot, s_position):
+    """
+    Supposedly S5 is fully to the left and S10 is fully to the right...
+    So how is S0 "off"? Less than 5? More than 10? Interpretation of the #?
+
+    According to reprap docs: "`Snnn` Angle or microseconds"
+
+    Empirically:
+    S2.7 seems about fully open (2.5 strains a little)
+    S11.1 seems most closed, non-strained, position w/ (1/16"?) Viton pads
+    S11.25 will strain them a little
+
+    Requires different Smoothieware configuration than default MAPLE.
+    Use smoothie_config in this repository.
+    """
+    # TODO add trailing newline in sendSyncCmd/sendCmd automatically
+    cmd = 'M280 S{}\n'.format(s_position)
+    robot.smoothie.sendSyncCmd(cmd)
+
+
+class Gripper(object):
+    """The gripper servo, waiting after each move only as long as the servo
+    takes to get there.
+
+    Args:
+        open_s / closed_s: S positions (see move_gripper_servo) to release and
+            grip at. Depend on the type of vial.
+        s_per_unit: seconds the servo takes per unit change in S, as measured
+            by Workcell.calibrate_gripper. If None, gripping waits
+            uncalibrated_grip_s and releasing does not wait.
+        margin_s: added to each calibrated wait.
+    """
+    def __init__(self, open_s=2.65, closed_s=4.3, s_per_unit=None,
+        margin_s=0.1, uncalibrated_grip_s=1.0):
+        # 2.7 also works for open. 4.3 might help keep the vial slightly
+        # straigher than 4.5? it is definitely a little looser
+        self.open_s = open_s
+        self.closed_s = closed_s
+        self.s_per_unit = s_per_unit
+        self.margin_s = margin_s
+        self.uncalibrated_grip_s = uncalibrated_grip_s
+        # Last S commanded (None if not known)
+        self.position = None
+
+    @classmethod
+    def from_config(cls, path=GRIPPER_CONFIG, vial_type=None):
+        """Returns a Gripper with settings for vial_type from a JSON file
+        (as written by save_config), or the defaults if it does not exist.
+        """
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as f:
+            config = json.load(f)
+
+        kwargs = dict()
+        if config.get('s_per_unit') is not None:
+            kwargs['s_per_unit'] = config['s_per_unit']
+        if 'margin_s' in config:
+            kwargs['margin_s'] = config['margin_s']
+        if vial_type is not None:
+            positions = config.get('vial_types', {}).get(vial_type)
+            if positions is None:
+                raise KeyError('no gripper positions for vial type {!r} in '
+                    '{}'.format(vial_type, path))
+            kwargs['open_s'] = positions['open']
+            kwargs['closed_s'] = positions['closed']
+        return cls(**kwargs)
+
+    def save_config(self, path=GRIPPER_CONFIG, vial_type=None):
+        """Saves s_per_unit and margin_s (and positions, for vial_type) to
+        path, keeping positions for other vial types already in it.
+        """
+        config = dict()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                config = json.load(f)
+        config['s_per_unit'] = self.s_per_unit
+        config['margin_s'] = self.margin_s
+        if vial_type is not None:
+            config.setdefault('vial_types', {})[vial_type] = {
+                'open': self.open_s, 'closed': self.closed_s}
+        write_atomic(path, json.dumps(config, indent=2, sort_keys=True))
+
+    def travel_s(self, s_position):
+        """Returns seconds to wait after commanding s_position.
+        """
+        if self.s_per_unit is None:
+            if s_position != self.open_s:
+                return self.uncalibrated_grip_s
+            return 0.0
+        if self.position is None:
+            # Could be anywhere, so as if from the far end of the positions
+            # used.
+            delta = max(abs(s_position - self.open_s),
+                abs(s_position - self.closed_s))
+        else:
+            delta = abs(s_position - self.position)
+        if delta == 0:
+            return 0.0
+        return self.s_per_unit * delta + self.margin_s
+
+    def move(self, robot, s_position, wait_s=None):
+        """Moves the servo to s_position, and waits until it gets there.
+
+        wait_s: to wait instead of travel_s(s_position)
+        """
+        if wait_s is None:
+            wait_s = self.travel_s(s_position)
+        move_gripper_servo(robot, s_position)
+        self.position = s_position
+        if wait_s > 0:
+            robot.dwell_ms(wait_s * 1000)
+
+    def grip(self, robot, wait_s=None):
+        self.move(robot, self.closed_s, wait_s=wait_s)
+
+    def release(self, robot, wait_s=None):
+        self.move(robot, self.open_s, wait_s=wait_s)
+
+
+# Used by grip_vial and release_vial. See set_gripper.
+_gripper = Gripper()
+
+
+def set_gripper(gripper):
+    """Sets the Gripper grip_vial and release_vial use (e.g. one from
+    Gripper.from_config).
+    """
+    global _gripper
+    _gripper = gripper
+
+
+def get_gripper():
+    return _gripper
+
+
+def grip_vial(robot, pos=None):
+    """Grips at pos (default: the gripper's closed_s), waiting as long as the
+    servo takes (see Gripper).
+    """
+    if pos is None:
+        _gripper.grip(robot)
+    else:
+        _gripper.move(robot, pos)
+
+
+def release_vial(robot):
+    _gripper.release(robot)
+
+
+def trace_robot(robot):
+    """Records spans for robot moves and smoothie commands, while tracing.
+
+    Returns a function that undoes this. See tracing.trace_methods.
+    """
+    undo_robot = tracing.trace_methods(robot, 'robot',
+        ('moveXY', 'moveZ2', 'dwell_ms'))
+    undo_smoothie = tracing.trace_methods(robot.smoothie, 'smoothie',
+        ('sendSyncCmd', 'sendCmd'))
+
+    def undo():
+        undo_smoothie()
+        undo_robot()
+    return undo
+
+
+class PhaseTimer(object):
+    """Adds up clock time spent in each named phase of an aliquot cycle.
+
+    on_phase: if not None, called with (name, done) as each phase starts
+        (done=False) and once it has finished without error (done=True).
+    """
+    def __init__(self, clock=time, on_phase=None):
+        self.clock = clock
+        self.on_phase = on_phase
+        # Phase name -> seconds
+        self.times = dict()
+
+    @contextmanager
+    def phase(self, name):
+        if self.on_phase is not None:
+            self.on_phase(name, False)
+        start = self.clock.time()
+        try:
+            with tracing.span(name, phase=True):
+                yield
+        finally:
+            self.times[name] = (self.times.get(name, 0.0) +
+                self.clock.time() - start)
+        if self.on_phase is not None:
+            self.on_phase(name, True)
+
+
+class Workcell(object):
+    """The robot, vial box, pump and scale, and where they all are.
+
+    Positions are in smoothie coordinates, with Z2 at 0 as the safe travel
+    height.
+
+    The stations a vial can be set down at (for pipelining) are:
+    'scale': on the scale
+    'pump': on a platform under the pump outlet (needs pump_platform_z)
+    'staging': on a platform anywhere else (needs staging_xy and staging_z)
+    """
+    def __init__(self, robot, vialbox, approach_from, pump=None,
+        pump_xy=None, pump_z=None, pump_xy_approach=(), pump_platform_z=None,
+        scale=None, scale_xy=None, scale_z=None, staging_xy=None,
+        staging_z=None, drop_wait_s=20, dispenser=None, refill_syringe=None,
+        approach_offset=None, batch_moves=False, smoothie_port=None,
+        vial_map=None, clock=time):
+        """
+        approach_from: XY the gripper moves to before any vial box get / put,
+            to keep backlash consistent. Or a function of the slot (i, j)
+            returning it, e.g. deck.Deck.approach_from.
+        approach_offset: if not None, (dX, dY) of the last move onto each vial
+            box slot, which then starts from the slot's XY minus this, rather
+            than from approach_from. See path_planner.py.
+        batch_moves: if True, the robot commands for each step (e.g. getting a
+            vial) are sent as one G-code stream, only waiting for the robot to
+            stop before reading the scale or running the pump. Phase times
+            (see PhaseTimer) then include the end of the previous step's
+            motion. See motion_batch.py.
+        smoothie_port: the smoothie's serial port, to stream batches to
+            directly (see motion_batch.MotionBatch).
+        pump_z: Z2 to hold a gripped vial at, under the pump outlet.
+        pump_xy_approach: XY waypoints to get from the box side of the
+            workspace to just outside the pump outlet.
+        pump_platform_z: Z2 to release a vial at, if there is a platform under
+            the pump outlet.
+        scale: a weighing.StreamingScale
+        dispenser: a mass_feedback.MassFeedbackDispenser, if the scale is under
+            the pump outlet (scale_xy), to fill vials on the scale by mass.
+        refill_syringe: called with no arguments when the syringe needs to be
+            refilled. Defaults to prompting for it to be done by hand.
+        vial_map: a vial_map.VialMap, to mark slots out in as their vials are
+            taken.
+        clock: provides time() and sleep(). Defaults to the time module.
+        """
+        self.robot = robot
+        self.vialbox = vialbox
+        self.approach_from = approach_from
+        self.approach_offset = approach_offset
+        self.batch_moves = batch_moves
+        self.smoothie_port = smoothie_port
+
+        self.pump = pump
+        self.pump_xy = pump_xy
+        self.pump_z = pump_z
+        self.pump_xy_approach = list(pump_xy_approach)
+        self.pump_platform_z = pump_platform_z
+
+        self.scale = scale
+        self.scale_xy = scale_xy
+        self.scale_z = scale_z
+
+        self.staging_xy = staging_xy
+        self.staging_z = staging_z
+
+        self.drop_wait_s = drop_wait_s
+        self.dispenser = dispenser
+        self.refill_syringe = refill_syringe
+        self.vial_map = vial_map
+        self.clock = clock
+
+    @property
+    def stations(self):
+        """Names of places a vial can be set down, other than the vial box.
+        """
+        stations = []
+        if self.scale is not None:
+            stations.append('scale')
+        if self.staging_xy is not None:
+            stations.append('staging')
+        if self.pump_platform_z is not None:
+            stations.append('pump')
+        return stations
+
+    @contextmanager
+    def _moves(self, sync=False):
+        """Yields what to call robot methods on: a MotionBatch (also given to
+        the vial box) if batch_moves, otherwise the robot.
+
+        sync: if True, waits for the robot to stop at the end.
+        """
+        if not self.batch_moves:
+            yield self.robot
+            return
+
+        batch = MotionBatch(self.robot, port=self.smoothie_port)
+        vialbox_robot = self.vialbox.robot
+        self.vialbox.robot = batch
+        try:
+            yield batch
+        finally:
+            self.vialbox.robot = vialbox_robot
+        batch.send(sync=sync)
+
+    def approach_xy(self, i, j):
+        """Returns XY to move to before moving onto vial box slot (i, j).
+        """
+        if self.approach_offset is None:
+            if callable(self.approach_from):
+                return self.approach_from(i, j)
+            return self.approach_from
+        x, y = self.vialbox.anchor_center(i, j)
+        return (x - self.approach_offset[0], y - self.approach_offset[1])
+
+    def get_vial(self, i, j):
+        """Grips vial (i, j) from the box and moves to travel height.
+        """
+        with tracing.span('get_indices', i=i, j=j), self._moves() as robot:
+            # To keep backlash more consistent.
+            robot.moveXY(self.approach_xy(i, j))
+            self.vialbox.get_indices(i, j)
+        if self.vial_map is not None:
+            self.vial_map.set(i, j, 'out')
+
+    def put_vial(self, i, j):
+        """Returns the gripped vial to (i, j) in the box.
+        """
+        with tracing.span('put_indices', i=i, j=j), self._moves() as robot:
+            # To keep backlash more consistent.
+            robot.moveXY(self.approach_xy(i, j))
+            self.vialbox.put_indices(i, j)
+
+    def place(self, station):
+        """Sets the gripped vial down at station (see stations).
+        """
+        with tracing.span('place', station=station):
+            return getattr(self, 'place_on_' + station)()
+
+    def pick(self, station):
+        """Grips the vial at station and moves to travel height.
+        """
+        with tracing.span('pick', station=station):
+            return getattr(self, 'pick_from_' + station)()
+
+    def _approach_pump(self, robot):
+        for xy in self.pump_xy_approach:
+            robot.moveXY(xy)
+
+    def _leave_pump(self, robot):
+        robot.moveXY(self.pump_xy_approach[-1])
+        #zvial_travel = robot.z2_to_worksurface - 2 * vial_grip_height - 3
+        # (to simplify things for now)
+        zvial_travel = 0
+        robot.moveZ2(zvial_travel)
+        for xy in self.pump_xy_approach[:-1][::-1]:
+            robot.moveXY(xy)
+
+    def check_pump_volume(self, vol_ml):
+        """Prompts for a syringe refill if there is not enough left for vol_ml
+        (by the pump's ledger, so this doesn't talk to the pump).
+        """
+        have_vol = self.pump.can_dispense(vol_ml)
+        if not have_vol:
+            if self.refill_syringe is not None:
+                self.refill_syringe()
+            else:
+                input('Re-fill syringe and press Enter to continue...')
+            # Refilling may involve changing settings from the keypad.
+            self.pump.invalidate()
+            self.pump.refilled()
+
+    def start_dispense(self, vol_ml):
+        """Starts the pump, returning a handle to wait on.
+        """
+        self.check_pump_volume(vol_ml)
+        return self.pump.dispense(vol_ml, block=False)
+
+    def drip_wait(self, seconds=None):
+        """Waits for drops to fall from the pump outlet (default drop_wait_s).
+        """
+        if seconds is None:
+            seconds = self.drop_wait_s
+        print('Waiting {} seconds for drops to fall... '.format(seconds),
+            end='')
+        sys.stdout.flush()
+        self.clock.sleep(seconds)
+        print('done')
+
+    def fill_vial(self, vol_ml, drip_wait_s=None, timer=None, skip=()):
+        """Moves vial under syringe pump output.
+        Assumes Z2 is at appropriate travel height already.
+
+        timer: a PhaseTimer to record time spent in each step in.
+        skip: names of steps (phases) not to do, e.g. those already done
+            before a run was interrupted.
+        """
+        if timer is None:
+            timer = PhaseTimer(self.clock)
+
+        with tracing.span('fill_vial', vol_ml=vol_ml):
+            self._fill_vial(vol_ml, drip_wait_s, timer, skip)
+
+    def _fill_vial(self, vol_ml, drip_wait_s, timer, skip):
+        if 'check_volume' not in skip:
+            with timer.phase('check_volume'):
+                self.check_pump_volume(vol_ml)
+
+        if 'travel_to_pump' not in skip:
+            with timer.phase('travel_to_pump'), \
+                self._moves(sync=True) as robot:
+
+                self._approach_pump(robot)
+                # Only doing this after gripper is no longer over box,
+                # as a good height here might crash into box.
+                robot.moveZ2(self.pump_z)
+                robot.moveXY(self.pump_xy)
+
+        if 'pump' not in skip:
+            with timer.phase('pump'):
+                self.pump.dispense(vol_ml)
+        if 'drip_wait' not in skip:
+            with timer.phase('drip_wait'):
+                self.drip_wait(drip_wait_s)
+
+        if 'travel_from_pump' not in skip:
+            with timer.phase('travel_from_pump'), self._moves() as robot:
+                self._leave_pump(robot)
+
+    def retreat(self, near_pump=False):
+        """Moves to travel height from wherever the robot was left (e.g. by an
+        interrupted run).
+
+        near_pump: if True, first backs out from under the pump outlet.
+        """
+        if near_pump:
+            self._leave_pump(self.robot)
+        else:
+            self.robot.moveZ2(0)
+
+    def place_on_pump(self):
+        # Synced, as the pump may be started as soon as this returns.
+        with self._moves(sync=True) as robot:
+            self._approach_pump(robot)
+            robot.moveZ2(self.pump_platform_z)
+            robot.moveXY(self.pump_xy)
+            release_vial(robot)
+            # Can't go straight up without hitting the outlet.
+            self._leave_pump(robot)
+
+    def pick_from_pump(self):
+        with self._moves() as robot:
+            self._approach_pump(robot)
+            robot.moveZ2(self.pump_platform_z)
+            robot.moveXY(self.pump_xy)
+            grip_vial(robot)
+            self._leave_pump(robot)
+
+    def place_on_scale(self):
+        # Synced, as the scale is read as soon as this returns.
+        with self._moves(sync=True) as robot:
+            # just to be safe. could delete later.
+            robot.moveZ2(0)
+            #
+            robot.moveXY(self.scale_xy)
+            robot.moveZ2(self.scale_z - 0.5)
+
+            release_vial(robot)
+            robot.moveZ2(0)
+
+    def read_scale(self):
+        """Returns weight in grams, as soon as readings are stable.
+        """
+        return self.scale.read_stable()
+
+    def pick_from_scale(self):
+        with self._moves() as robot:
+            robot.moveZ2(0)
+            robot.moveXY(self.scale_xy)
+            robot.moveZ2(self.scale_z)
+            grip_vial(robot)
+
+            #zvial_travel = robot.z2_to_worksurface - 2 * vial_grip_height - 3
+            # (to simplify things for now)
+            zvial_travel = 0
+            robot.moveZ2(zvial_travel)
+
+    def weigh_vial(self):
+        """Returns vial weight in grams. Assumes start at safe Z height.
+        """
+        with tracing.span('weigh_vial'):
+            self.place_on_scale()
+            weight = self.read_scale()
+            self.pick_from_scale()
+        return weight
+
+    def fill_vial_on_scale(self):
+        """Fills the gripped vial on the scale, by mass.
+
+        Returns (empty vial weight, full vial weight, mL commanded).
+        """
+        with tracing.span('fill_vial_on_scale'):
+            self.place_on_scale()
+            empty_g = self.read_scale()
+            ret = self.dispenser.dispense(tare_g=empty_g)
+            self.pick_from_scale()
+        return empty_g, ret['final_g'], ret['vol_ml']
+
+    def calibrate_gripper(self, gripper=None, lift_mm=10.0, max_wait_s=2.0,
+        resolution_s=0.02):
+        """Measures how long the gripper servo takes to grip and to release a
+        vial, and sets gripper.s_per_unit from the slower of the two.
+
+        Needs an empty gripper and a vial on the scale. For each wait tried,
+        the vial is gripped (or released) with that wait, the gripper is
+        lifted lift_mm, and the scale says whether the vial came up with it.
+        The shortest wait that works is found by bisection, down to
+        resolution_s. The vial is left on the scale.
+
+        gripper: defaults to the one grip_vial and release_vial use.
+        """
+        if gripper is None:
+            gripper = get_gripper()
+        robot = self.robot
+        robot.moveZ2(0)
+        robot.moveXY(self.scale_xy)
+        gripper.release(robot, wait_s=max_wait_s)
+        robot.moveZ2(self.scale_z)
+        vial_g = self.read_scale()
+        lifted_z = self.scale_z - lift_mm
+
+        def vial_lifted(grip_wait_s, release_wait_s=None):
+            """Grips (then releases, if release_wait_s is not None), lifts,
+            and returns whether the vial came up. Leaves the vial released on
+            the scale.
+            """
+            gripper.grip(robot, wait_s=grip_wait_s)
+            if release_wait_s is not None:
+                gripper.release(robot, wait_s=release_wait_s)
+            robot.moveZ2(lifted_z)
+            lifted = self.read_scale() < vial_g / 2
+            robot.moveZ2(self.scale_z)
+            gripper.release(robot, wait_s=max_wait_s)
+            return lifted
+
+        def shortest(works):
+            low = 0.0
+            high = max_wait_s
+            if not works(high):
+                raise RuntimeError('gripper not done moving after {} '
+                    'seconds'.format(max_wait_s))
+            while high - low > resolution_s:
+                mid = (low + high) / 2
+                if works(mid):
+                    high = mid
+                else:
+                    low = mid
+            return high
+
+        grip_s = shortest(vial_lifted)
+        release_s = shortest(lambda wait_s: not vial_lifted(max_wait_s,
+            wait_s))
+        robot.moveZ2(0)
+
+        delta = abs(gripper.closed_s - gripper.open_s)
+        gripper.s_per_unit = max(grip_s, release_s) / delta
+        print('Gripper takes {:.2f}s to grip and {:.2f}s to release ({:.3f}s '
+            'per unit of S)'.format(grip_s, release_s, gripper.s_per_unit))
+        return gripper
+
+    def place_on_staging(self):
+        with self._moves() as robot:
+            robot.moveZ2(0)
+            robot.moveXY(self.staging_xy)
+            robot.moveZ2(self.staging_z)
+            release_vial(robot)
+            robot.moveZ2(0)
+
+    def pick_from_staging(self):
+        with self._moves() as robot:
+            robot.moveZ2(0)
+            robot.moveXY(self.staging_xy)
+            robot.moveZ2(self.staging_z)
+            grip_vial(robot)
+            robot.moveZ2(0)
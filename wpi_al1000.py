@@ -17,6 +17,321 @@ import warnings
 import serial
 import crc16
 
+import tracing
+import syringes
+
+
+# Basic mode replies are framed as:
+# <STX> <2 digit address> <prompt character> [data] <ETX>
+STX = b'\x02'
+ETX = b'\x03'
+
+# From the "Prompts" section of the manual. The prompt in each reply reflects
+# the state of the pump at the time the command was processed.
+PROMPTS = {
+    'I': 'infusing',
+    'W': 'withdrawing',
+    'S': 'stopped',
+    'P': 'paused',
+    'T': 'pause phase',
+    'U': 'waiting for user trigger',
+    'X': 'purging',
+    'A': 'alarm'
+}
+# These take the place of the data in a reply.
+ERROR_CODES = {
+    '?': 'command not recognized',
+    '?NA': 'command not currently applicable',
+    '?OOR': 'command data out of range',
+    '?COM': 'invalid communications packet',
+    '?IGN': 'command ignored due to a simultaneous new phase start'
+}
+# The data following an 'A' (alarm) prompt.
+ALARM_CODES = {
+    '?R': 'pump was reset (power was interrupted)',
+    '?S': 'pump motor stalled',
+    '?T': 'safe mode communications timeout',
+    '?E': 'pumping program error',
+    '?O': 'pumping program phase is out of range'
+}
+
+
+class AL1000Timeout(IOError):
+    """Raised when a reply doesn't arrive in time.
+
+    replies: data from the replies to the commands before the one that timed
+        out, if it was one of a batch (see Transaction).
+    """
+    replies = None
+
+
+class AL1000Error(Exception):
+    """Raised when the pump replies to a command with an error or alarm code.
+
+    replies: for an error raised from a batch of commands (see Transaction),
+        the data from every reply, in order, so callers can tell which of the
+        other commands took.
+    """
+    def __init__(self, command, code, prompt=None):
+        self.command = command
+        self.code = code
+        self.prompt = prompt
+        self.replies = None
+        if prompt == 'A':
+            description = ALARM_CODES.get(code, 'unknown alarm')
+        else:
+            description = ERROR_CODES.get(code, 'unknown error')
+        super(AL1000Error, self).__init__('{!r} -> {} ({})'.format(
+            command, code, description))
+
+
+class Transaction(object):
+    """Queues commands to be written to the pump in one burst.
+
+    Use via AL1000.transaction():
+
+        with pump.transaction() as t:
+            t.add('DIRINF')
+            t.add('VOL2.000')
+        # t.replies now has the data from each reply, in order.
+
+    Replies are matched to commands by order, and AL1000Error is raised for the
+    first reply with an error code, after all replies have been read (so later
+    commands are not left with unread replies).
+    """
+    def __init__(self, pump, timeout=None):
+        self.pump = pump
+        self.timeout = timeout
+        self.commands = []
+        self.replies = None
+        # (key, value) pairs to apply to the pump's settings cache, in order,
+        # once all commands succeed. value=None invalidates key.
+        self.cache_updates = []
+
+    def add(self, command, cache_updates=()):
+        """Queues command, returning index of its eventual reply in replies.
+        """
+        if self.replies is not None:
+            raise RuntimeError('transaction was already sent')
+        self.commands.append(command)
+        self.cache_updates.extend(cache_updates)
+        return len(self.commands) - 1
+
+    def send(self):
+        if self.replies is not None:
+            raise RuntimeError('transaction was already sent')
+        try:
+            self.replies = self.pump._send_commands(self.commands,
+                timeout=self.timeout)
+        except Exception:
+            # We don't know which of the settings actually took (after a
+            # timeout, possibly all of them).
+            self.pump.invalidate(*[k for k, _ in self.cache_updates])
+            raise
+        self.pump._update_cache(self.cache_updates)
+        return self.replies
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and len(self.commands) > 0:
+            self.send()
+
+
+class CommandStats(object):
+    """Counts bytes and round-trip latency for one kind of command.
+    """
+    def __init__(self):
+        self.count = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_latency_s = 0.0
+        self.max_latency_s = 0.0
+
+    def record(self, bytes_sent, bytes_received, latency_s):
+        self.count += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.total_latency_s += latency_s
+        self.max_latency_s = max(self.max_latency_s, latency_s)
+
+    @property
+    def mean_latency_s(self):
+        if self.count == 0:
+            return None
+        return self.total_latency_s / self.count
+
+    def __repr__(self):
+        return ('CommandStats(count={}, bytes_sent={}, bytes_received={}, '
+            'total_latency_s={:.3f}, max_latency_s={:.3f})').format(
+            self.count, self.bytes_sent, self.bytes_received,
+            self.total_latency_s, self.max_latency_s)
+
+
+class Dispense(object):
+    """Handle on a dispense that has been started with AL1000.dispense.
+
+    The pump is considered done when it reports the stopped prompt, or the
+    paused one (which is then made a stop). An alarm prompt (e.g. a motor
+    stall, which is what should happen at the end of the syringe) also ends
+    the dispense, and is raised as an AL1000Error from wait.
+    """
+    def __init__(self, pump, ml, rate, poll_interval_s=0.25):
+        """
+        rate: mL/min, used only to estimate when the dispense should finish.
+        """
+        self.pump = pump
+        self.clock = pump.clock
+        self.ml = ml
+        self.poll_interval_s = poll_interval_s
+        self.start_time = self.clock.time()
+        self.expected_duration_s = (ml / rate) * 60.0
+        self.end_time = None
+
+        # Prompt and infused volume (mL) as of the last poll.
+        self.prompt = pump.last_prompt
+        self.volume_dispensed = None
+        self.error = None
+        self.cancelled = False
+
+    def poll(self):
+        """Checks pump status once, returning whether the dispense is over.
+        """
+        if self.end_time is not None:
+            return True
+
+        ret = self.pump._send_command('DIS')
+        self.prompt = self.pump.last_prompt
+        if self.prompt == 'A':
+            self.error = AL1000Error('DIS', ret, prompt=self.prompt)
+        elif ret in ERROR_CODES:
+            # Says nothing about the dispense, which may still be going.
+            raise AL1000Error('DIS', ret, prompt=self.prompt)
+        else:
+            self.volume_dispensed, _ = parse_vol_disp(ret)
+
+        if self.prompt == 'P':
+            # Paused (from the panel, or by an STP from elsewhere). A later
+            # RUN would resume it, so it is stopped for good.
+            print('Pump was paused during a dispense. Stopping it.')
+            self.pump.stop_program()
+
+        if self.prompt in ('S', 'A', 'P'):
+            self.end_time = self.clock.time()
+            if self.prompt == 'A':
+                # The alarm replaced the volume in the reply.
+                self.volume_dispensed = self._infused_after_alarm()
+            else:
+                # Valid until the next RUN.
+                self.pump._cache['volume_dispensed'] = ret
+            # (counted from 0 at the start of this dispense)
+            self.pump.ledger.confirm(self.ml if self.volume_dispensed is None
+                else self.volume_dispensed)
+        return self.end_time is not None
+
+    def _infused_after_alarm(self):
+        """Returns mL infused, asked again once the alarm is reported, or None
+        if the pump won't say.
+        """
+        try:
+            ret = self.pump._send_command('DIS')
+        except (AL1000Error, AL1000Timeout):
+            return None
+        if self.pump.last_prompt == 'A' or ret in ERROR_CODES:
+            return None
+        return parse_vol_disp(ret)[0]
+
+    def done(self):
+        """Returns whether the dispense is over (polling the pump if needed).
+        """
+        return self.poll()
+
+    def wait(self, timeout=None):
+        """Polls until the dispense is over or timeout seconds have passed.
+
+        Returns whether the dispense is over. Raises AL1000Error if the pump
+        went into an alarm state (e.g. stalled).
+        """
+        deadline = None if timeout is None else self.clock.time() + timeout
+        while not self.poll():
+            if deadline is None:
+                self.clock.sleep(self.poll_interval_s)
+                continue
+            remaining = deadline - self.clock.time()
+            if remaining <= 0:
+                return False
+            self.clock.sleep(min(self.poll_interval_s, remaining))
+
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def cancel(self):
+        """Stops the pump, if the dispense is not already over.
+        """
+        if self.end_time is not None:
+            return
+        self.pump.stop_program()
+        # STP only pauses a running program, and a later RUN would resume it,
+        # so a second STP is needed to actually stop it.
+        if self.pump.last_prompt == 'P':
+            self.pump.stop_program()
+        self.cancelled = True
+        self.end_time = self.clock.time()
+        self.volume_dispensed = self.pump.get_infused_ml()
+        self.pump.ledger.confirm(self.volume_dispensed)
+
+
+def parse_reply(reply):
+    """Returns (address, prompt, data) str tuple from one reply frame.
+
+    Anything before the last STX (e.g. line noise or the tail of an earlier
+    reply) is ignored.
+    """
+    start = reply.rfind(STX)
+    if start == -1 or not reply.endswith(ETX):
+        raise ValueError('malformed reply: {!r}'.format(reply))
+    frame = reply[start + 1:-1].decode('ascii')
+    if len(frame) < 3:
+        raise ValueError('malformed reply: {!r}'.format(reply))
+    return frame[:2], frame[2], frame[3:]
+
+
+def parse_vol_disp(ret):
+    """Returns (infused, withdrawn) volumes in mL from reply to 'DIS' query.
+
+    Replies look like 'I1.200W0.000ML'.
+    """
+    infused, withdrawn = ret[1:-2].split('W')
+    infused = float(infused)
+    withdrawn = float(withdrawn)
+    unit = ret[-2:]
+    if unit == 'UL':
+        infused = infused / 1000.0
+        withdrawn = withdrawn / 1000.0
+    elif unit != 'ML':
+        raise ValueError('unexpected volume unit: {}'.format(unit))
+    return infused, withdrawn
+
+
+def _to_ml_per_min(rate, units):
+    """Converts rate in units (e.g. 'UH', see AL1000.set_rate) to mL/min.
+    """
+    vol_unit_char, time_unit_char = units
+    if vol_unit_char == 'U':
+        rate = rate / 1000.0
+    elif vol_unit_char != 'M':
+        raise ValueError('unexpected volume unit code: {}'.format(
+            vol_unit_char))
+
+    if time_unit_char == 'H':
+        rate = rate / 60.0
+    elif time_unit_char != 'M':
+        raise ValueError('unexpected time unit code: {}'.format(
+            time_unit_char))
+    return rate
+
 
 def _format_float(num):
     """Returns str w/ float formatted as per the manual.
@@ -33,23 +348,68 @@ def _format_float(num):
 
 class AL1000(object):
     """Driver for the AL1000 syringe pump"""
+
+    # diameter: mm
+    # rate: mL/min
+    # units: rate units code last sent / reported (see set_rate)
+    # direction: 'INF' or 'WDR'
+    # volume: target volume, in mL
+    # volume_dispensed: raw reply to 'DIS'
+    CACHED_SETTINGS = ('diameter', 'rate', 'units', 'direction', 'volume',
+        'volume_dispensed')
     
-    def __init__(self, port="/dev/ttyUSB0", baudrate=19200):
+    def __init__(self, port="/dev/ttyUSB0", baudrate=19200, timeout=1.0,
+        clock=time, ledger=None):
+        """
+        timeout: default seconds to wait for the reply to each command.
+        clock: provides time() and sleep(), for timing dispenses. Defaults to
+            the time module. See simulation.VirtualClock. Serial timeouts are
+            always in real time.
+        ledger: a syringes.SyringeLedger, to keep track of what is left in the
+            syringe with. Defaults to one that is not saved.
+        """
         # TODO does this need to be changed for safe mode?
         self.serial = serial.Serial(
-            port=port, baudrate=baudrate, timeout=1,
+            port=port, baudrate=baudrate, timeout=timeout,
             parity=serial.PARITY_NONE,
             bytesize=serial.EIGHTBITS,
             stopbits=serial.STOPBITS_ONE,
             
         )
         self.safe_mode = False
+        self.timeout = timeout
+        self.clock = clock
+
+        # Prompt character from the most recent reply. See PROMPTS.
+        self.last_prompt = None
+        # Command mnemonic (e.g. 'RAT') -> CommandStats
+        self.command_stats = dict()
+
+        # Default for how often a Dispense checks whether the pump has stopped.
+        self.poll_interval_s = 0.25
 
+        # Write-through cache of pump settings, so redundant commands can be
+        # skipped. Keys are those in CACHED_SETTINGS. Missing keys mean the
+        # value is unknown, and will be queried from the pump.
+        self._cache = dict()
+
+        # mL the syringe holds when full (see set_syringe).
         self.capacity = None
         self.max_rate = None
         self.min_rate = None
+        if ledger is None:
+            ledger = syringes.SyringeLedger(path=None)
+        self.ledger = ledger
+
+    def _send_command(self, command, timeout=None):
+        return self._send_commands([command], timeout=timeout, check=False)[0]
 
-    def _send_command(self, command):
+    def transaction(self, timeout=None):
+        """Returns a Transaction to batch several commands into one write.
+        """
+        return Transaction(self, timeout=timeout)
+
+    def _send_commands(self, commands, timeout=None, check=True):
         # TODO switch all communication to safe mode protocol once i get that
         # working
         '''
@@ -88,33 +448,165 @@ class AL1000(object):
         # TODO TODO TODO are replies to safe mode commands in diff format?
         return ret[4:-1]
         '''
-        formatted_command = command + "\r"
-        self.serial.write(formatted_command.encode("ascii"))
-        time.sleep(0.5)
-        waiting = self.serial.inWaiting()
-        reply = self.serial.read(waiting)
+        if timeout is None:
+            timeout = self.timeout
+
+        with tracing.span(' '.join(c[:3] for c in commands), device='pump',
+            commands=commands):
+            replies, first_error = self._write_and_read(commands, timeout)
+
+        if check and first_error is not None:
+            raise first_error
+        return replies
+
+    def _write_and_read(self, commands, timeout):
+        """Returns (replies, AL1000Error for first error or None).
+        """
+        formatted_commands = [(c + "\r").encode("ascii") for c in commands]
+        # Anything still in the buffer can only be stale, and would otherwise
+        # be mistaken for the reply to one of these commands.
+        self.serial.reset_input_buffer()
+        start = time.time()
+        self.serial.write(b''.join(formatted_commands))
+
+        replies = []
+        first_error = None
+        for command, formatted_command in zip(commands, formatted_commands):
+            try:
+                reply = self._read_reply(timeout)
+            except AL1000Timeout as err:
+                err.replies = replies
+                raise
+            latency_s = time.time() - start
+
+            mnemonic = command[:3]
+            if mnemonic not in self.command_stats:
+                self.command_stats[mnemonic] = CommandStats()
+            self.command_stats[mnemonic].record(len(formatted_command),
+                len(reply), latency_s)
+
+            try:
+                _, prompt, data = parse_reply(reply)
+            except (UnicodeDecodeError, ValueError) as err:
+                print('command:', command)
+                print('reply:', reply)
+                raise
+            self.last_prompt = prompt
+
+            if prompt == 'A' and data == '?R':
+                # Power was interrupted, so we can't trust anything we think we
+                # know about the settings.
+                self.invalidate()
+
+            if first_error is None and (prompt == 'A' or data in ERROR_CODES):
+                first_error = AL1000Error(command, data, prompt=prompt)
+                tracing.instant('error', device='pump', command=command,
+                    reply=data)
+            replies.append(data)
+        if first_error is not None:
+            first_error.replies = replies
+        return replies, first_error
+
+    def _read_reply(self, timeout):
+        """Returns bytes up to and including the ETX ending the next reply.
+
+        Returns as soon as the ETX arrives, rather than waiting out timeout.
+        """
+        deadline = time.time() + timeout
+        reply = b''
+        while not reply.endswith(ETX):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise AL1000Timeout('no complete reply from pump within '
+                    '{} seconds (got {!r})'.format(timeout, reply))
+            self.serial.timeout = remaining
+            reply += self.serial.read_until(ETX)
+        return reply
+
+    def invalidate(self, *keys):
+        """Forgets cached values of settings in keys (all, if none passed).
+
+        Call after anything might have changed the pump settings behind the
+        back of this object (e.g. a power cycle or using the keypad).
+        """
+        if len(keys) == 0:
+            self._cache.clear()
+            return
+        for k in keys:
+            self._cache.pop(k, None)
+
+    def resync(self):
+        """Re-reads all cached settings from the pump, in one round-trip.
+        """
+        self.invalidate()
+        with self.transaction() as t:
+            for c in ('DIA', 'RAT', 'DIR', 'VOL', 'DIS'):
+                t.add(c)
+        dia, rat, direction, vol, dis = t.replies
+        self._cache['diameter'] = float(dia)
+        self._cache['rate'] = self._parse_rate(rat)
+        self._cache['units'] = rat[-2:]
+        self._cache['direction'] = direction
+        self._cache['volume'] = self._parse_vol(vol)
+        self._cache['volume_dispensed'] = dis
+
+    def _update_cache(self, updates):
+        for key, value in updates:
+            assert key in self.CACHED_SETTINGS
+            if value is None:
+                self._cache.pop(key, None)
+            else:
+                self._cache[key] = value
+
+    def _set(self, command, cache_updates, transaction=None):
+        """Sends (or queues on transaction) a command that changes settings.
+
+        cache_updates are applied to the cache only if the command succeeds.
+        """
+        if transaction is not None:
+            transaction.add(command, cache_updates=cache_updates)
+            return None
+
         try:
-            reply_unicode = reply.decode("ascii")
-            return reply_unicode[4:-1]
-        except UnicodeDecodeError as err:
-            print('command:', command)
-            print('reply:', reply)
+            ret = self._send_command(command)
+        except Exception:
+            # (e.g. a timeout, which the setting may or may not have taken)
+            self.invalidate(*[k for k, _ in cache_updates])
             raise
+        if self.last_prompt == 'A' or ret in ERROR_CODES:
+            self.invalidate(*[k for k, _ in cache_updates])
+        else:
+            self._update_cache(cache_updates)
+        return ret
+
+    def _volume_units(self):
+        """Returns 'ML' or 'UL', as implied by cached diameter, or None.
+
+        From the manual, volume units are set by the syringe diameter:
+        0.1-14.0mm -> uL, 14.01-50.0mm -> mL
+        """
+        diam = self._cache.get('diameter')
+        if diam is None:
+            return None
+        return 'UL' if diam <= 14.0 else 'ML'
 
     def get_firmware(self):
         """Returns the str firmware version
         """
         # TODO on first run one time, '?R' was returned,
         # but after that, 'NE1000V3.928' was... wait untli ?R isn't returned?
-        # what does that code mean?
+        # ('?R' is the alarm the pump sends after a power interruption. See
+        # ALARM_CODES.)
         return self._send_command("VER")
 
     def get_diam(self):
         """Returns the syringe diameter in mm
         """
-        return float(self._send_command('DIA'))
+        if 'diameter' not in self._cache:
+            self._cache['diameter'] = float(self._send_command('DIA'))
+        return self._cache['diameter']
 
-    def set_diam(self, diameter, warn=True):
+    def set_diam(self, diameter, warn=True, transaction=None):
         """Sets the syringe diameter in mm
 
         From the manual:
@@ -127,12 +619,28 @@ class AL1000(object):
         # TODO need to handle other things this changes (as docstring)?
         # TODO limit precision?
         # TODO TODO can this take a unit string suffix as w/ rate?
-        return self._send_command('DIA' + _format_float(diameter))
+        formatted = _format_float(diameter)
+        if self._cache.get('diameter') == float(formatted):
+            return None
+        # Since units can change, the other volumes (and the rate, to be safe)
+        # need to be re-read.
+        return self._set('DIA' + formatted, [('diameter', float(formatted)),
+            ('rate', None), ('units', None), ('volume', None),
+            ('volume_dispensed', None)], transaction=transaction)
 
     def get_rate(self):
         """Returns the pump rate in mL/min
         """
-        ret = self._send_command("RAT")
+        if 'rate' not in self._cache:
+            ret = self._send_command("RAT")
+            self._cache['rate'] = self._parse_rate(ret)
+            self._cache['units'] = ret[-2:]
+        return self._cache['rate']
+
+    @staticmethod
+    def _parse_rate(ret):
+        """Returns rate in mL/min from reply to a 'RAT' query.
+        """
         try:
             rate = float(ret[:-2])
         # For the case where the return value is something other than the rate
@@ -141,25 +649,11 @@ class AL1000(object):
             print('Unexpected reply to rate request:', str(ret))
             raise
 
-        vol_unit_char = ret[-2]
-        time_unit_char = ret[-1]
-        if vol_unit_char == 'U':
-            rate = rate / 1000.0
-        elif vol_unit_char != 'M':
-            raise ValueError('unexpected volume unit code: {}'.format(
-                vol_unit_char))
-
-        if time_unit_char == 'H':
-            rate = rate / 60.0
-        elif time_unit_char != 'M':
-            raise ValueError('unexpected time unit code: {}'.format(
-                time_unit_char))
-
-        return rate
+        return _to_ml_per_min(rate, ret[-2:])
 
     # TODO does this automatically get limited by current diam according to
     # table in manual? or should i implement that here? err if outside range?
-    def set_rate(self, num, unit=False):
+    def set_rate(self, num, unit=False, transaction=None):
         # TODO is 34.38 actually as high as it goes? if so, raise appropriate
         # error code here
         """Sets the pump rate.
@@ -178,7 +672,7 @@ class AL1000(object):
             warnings.warn('use set_syringe before set_rate to get rate ' +
                 'bounds checking')
         else:
-            # TODO include my ~viscosity state var in check here too
+            # (max_rate includes the liquid's limit, if set_syringe got one)
             if num > self.max_rate:
                 raise ValueError('rate > maximum for this syringe')
 
@@ -188,18 +682,44 @@ class AL1000(object):
         # TODO is False an appropriate default here? what's it mean?
         # is it not just selecting one of the other units?
         # should this even be supported?
+        formatted = _format_float(num)
         if unit == False:
-            self._send_command("FUNRAT")
-            return self._send_command("RAT" + _format_float(num))
+            unit = ''
+            units = self._cache.get('units')
         else:
-            self._send_command("FUNRAT")
-            return self._send_command("RAT" + _format_float(num) + unit)
+            units = unit
+
+        if units is None:
+            updates = [('rate', None), ('units', None)]
+        else:
+            rate = _to_ml_per_min(float(formatted), units)
+            if (self._cache.get('rate') == rate and
+                self._cache.get('units') == units):
+                return None
+            updates = [('rate', rate), ('units', units)]
+
+        if transaction is not None:
+            transaction.add("FUNRAT")
+            transaction.add("RAT" + formatted + unit, cache_updates=updates)
+            return None
+
+        with self.transaction() as t:
+            t.add("FUNRAT")
+            t.add("RAT" + formatted + unit, cache_updates=updates)
+        return t.replies[-1]
 
     # TODO rename to get/set_target_vol?
     def get_vol(self):
         """Gets target volume in mL
         """
-        ret = self._send_command('VOL')
+        if 'volume' not in self._cache:
+            self._cache['volume'] = self._parse_vol(self._send_command('VOL'))
+        return self._cache['volume']
+
+    @staticmethod
+    def _parse_vol(ret):
+        """Returns volume in mL from reply to a 'VOL' query.
+        """
         vol = float(ret[:-2])
         # factor into a general unit conversion fn?
         unit = ret[-2:]
@@ -209,7 +729,7 @@ class AL1000(object):
             raise ValueError('unexpected volume unit: {}'.format(unit))
         return vol
 
-    def set_vol(self, num):
+    def set_vol(self, num, transaction=None):
         # TODO TODO what exactly does this docstring mean?
         # TODO will it pump only after start_program? will this apply to that,
         # if no "phase" param given?
@@ -221,13 +741,32 @@ class AL1000(object):
         """
         # TODO need to limit precision of float w/ str formatting?
         # TODO accept unit string suffix? implement
-        return self._send_command("VOL" + _format_float(num))
+        formatted = _format_float(num)
+        units = self._volume_units()
+        if units is None:
+            vol = None
+        else:
+            vol = float(formatted)
+            if units == 'UL':
+                vol = vol / 1000.0
+            if self._cache.get('volume') == vol:
+                return None
+        return self._set("VOL" + formatted, [('volume', vol)],
+            transaction=transaction)
 
     def get_vol_disp(self):
         """Returns the dispensed volume since last reset.
         """
-        return self._send_command("DIS")
+        if 'volume_dispensed' not in self._cache:
+            self._cache['volume_dispensed'] = self._send_command("DIS")
+        return self._cache['volume_dispensed']
     
+    def get_infused_ml(self):
+        """Returns mL infused since last reset (see get_vol_disp).
+        """
+        infused, _ = parse_vol_disp(self.get_vol_disp())
+        return infused
+
     def clear_vol_disp(self, direction = "both"):
         """Clear pumped volume for one or more dircetions. 
         
@@ -235,13 +774,16 @@ class AL1000(object):
             direction (string): The pumping direction. Valid directions are: INF=inflation, WDR=withdrawn, both=both directions. Default is both
         
         """
+        updates = [('volume_dispensed', None)]
         if direction == "INF":
-            return self._send_command("CLDINF")
+            return self._set("CLDINF", updates)
         if direction == "WDR":
-            return self._send_command("CLDWDR")
+            return self._set("CLDWDR", updates)
         if direction == "both":
-            return self._send_command("CLDINF")
-            return self._send_command("CLDWDR")
+            with self.transaction() as t:
+                t.add("CLDINF")
+                t.add("CLDWDR", cache_updates=updates)
+            return t.replies[-1]
     
     # TODO what are valid values for "phase"? whats the point?
     def set_fun(self, phase):
@@ -269,17 +811,20 @@ class AL1000(object):
             self.safe_mode = True
         return self._send_command("SAF" + str(num))
 
-    def start_program(self):
-        return self._send_command("RUN")
+    def start_program(self, transaction=None):
+        return self._set("RUN", [('volume_dispensed', None)],
+            transaction=transaction)
 
     def stop_program(self):
-        return self._send_command("STP")
+        return self._set("STP", [('volume_dispensed', None)])
 
     def get_direction(self):
         """Returns the curret pumping direction"""
-        return self._send_command("DIR")
+        if 'direction' not in self._cache:
+            self._cache['direction'] = self._send_command("DIR")
+        return self._cache['direction']
 
-    def set_direction(self, direction):
+    def set_direction(self, direction, transaction=None):
         """Sets the pumping direction
         
         Args:
@@ -287,12 +832,16 @@ class AL1000(object):
                 directoin=WDR --> Pumping dirction set to Withdraw
                     directoin=REV --> Pumping dirction set to the reverse current pumping direction
         """
-        if direction == "INF":
-            return self._send_command("DIRINF")
-        if direction == "WDR":
-            return self._send_command("DIRWDR")
+        if direction in ("INF", "WDR"):
+            if self._cache.get('direction') == direction:
+                return None
+            return self._set("DIR" + direction, [('direction', direction)],
+                transaction=transaction)
         if direction == "REV":
-            return self._send_command("DIRREV")
+            reverse = {'INF': 'WDR', 'WDR': 'INF'}
+            return self._set("DIRREV",
+                [('direction', reverse.get(self._cache.get('direction')))],
+                transaction=transaction)
 
     def retract_pump(self):
         # TODO TODO what does "remember to stop manually" mean?  need to
@@ -309,121 +858,162 @@ class AL1000(object):
 
     def can_dispense(self, ml):
         """Returns whether the syringe should have enough volume left to
-        dispense the requested amount.
-        """
-        if self.capacity is None:
-            raise RuntimeError('set pump.capacity or call set_syringe first')
-
-        # TODO maybe provide some way to input actual current volume in
-        # syringe in case things need restarted (prompt w/ default assuming
-        # syringe is full?)
-
-        # Note that this seems to reset across serial sessions even if the
-        # pump maintains power, so it's only accurate if the syringe started
-        # completely full.
-        vd_str = self.get_vol_disp()
-        # Ignoring the "withdraw" part of the returned state
-        volume_dispensed = float(vd_str[1:6])
-        unit = vd_str[-2:]
-        if unit == 'UL':
-            volume_dispensed = volume_dispensed / 1000.0
+        dispense the requested amount, going by the ledger (so without asking
+        the pump).
+        """
+        left_ml = self.ledger.left_ml
+        if left_ml is None:
+            raise RuntimeError('call set_syringe or refilled first')
 
         # TODO need some buffer to avoid crashing in to the very end of the
         # syringe if it isn't totally fully (or even if it is?)?
-        if volume_dispensed + ml >= self.capacity:
-            return False
-        return True
+        return ml < left_ml
 
+    def refilled(self, ml=None):
+        """Records the syringe as refilled, to ml (default full).
+        """
+        if ml is None:
+            ml = self.capacity
+        self.ledger.load(ml)
+
+    def reconcile_ledger(self):
+        """Counts a dispense the ledger has as started but not finished (e.g.
+        if the program stopped during it) as what the pump says it infused,
+        if the pump still has that. Otherwise it stays counted in full.
+        """
+        pending_ml = self.ledger.pending_ml
+        if pending_ml == 0:
+            return
+        # Each dispense clears this first, so it is just the last one, unless
+        # it has been reset since (as it seems to be across serial sessions).
+        infused_ml = self.get_infused_ml()
+        if self.last_prompt == 'S' and 0 < infused_ml <= pending_ml:
+            print('An interrupted dispense of {:.3f} mL infused {:.3f} mL.'
+                .format(pending_ml, infused_ml))
+            self.ledger.confirm(infused_ml)
+        else:
+            print('Counting an interrupted dispense as all {:.3f} mL.'.format(
+                pending_ml))
+            self.ledger.confirm(pending_ml)
+
+    def _abort_dispense(self, cleared):
+        """Stops the pump after a dispense failed to start cleanly, and counts
+        what it infused (as far as it can tell) in the ledger.
 
-    def dispense(self, ml, block=True):
+        cleared: whether CLDINF is known to have gone through, so DIS is just
+            this dispense.
+        """
+        try:
+            self.stop_program()
+            if self.last_prompt == 'P':
+                self.stop_program()
+            if cleared:
+                self.ledger.confirm(self.get_infused_ml())
+            else:
+                self.reconcile_ledger()
+        except (AL1000Error, AL1000Timeout, ValueError) as err:
+            # Left pending, for reconcile_ledger on the next connect.
+            print('Could not stop the pump after a failed dispense '
+                '({})'.format(err))
+
+    def dispense(self, ml, block=True, poll_interval_s=None):
         """Dispenses volume in mL.
         
-        Returns False if syringe capacity is known and needs refilled capacity,
-        True otherwise.
+        Returns a Dispense handle. With block=False, the handle is returned
+        right after the pump starts, and can be used to wait on / poll / cancel
+        the dispense. With block=True, it is returned once the pump has
+        stopped. Whether there is enough in the syringe is up to the caller
+        (see can_dispense).
+
+        poll_interval_s: how often the handle should check pump status while
+            waiting. Defaults to self.poll_interval_s.
         """
-        if block:
-            # mL/min
-            rate = self.get_rate()
-            time_sec = (ml / rate) * 60.0
 
         # TODO retract pump first / detect when syringe needs to be changed /
         # motor is stalled?
         # TODO TODO is stall detection even working on our pump?
-        r1 = self.set_direction('INF')
-        # TODO is this actually ml?
-        r2 = self.set_vol(ml)
-        if self.capacity is not None:
-            if not self.can_dispense(ml):
-                return False
+        # All of the setup goes out with RUN, as one round-trip. The rate query
+        # is just so we know how long to wait.
+        # Any settings that are already as we want them are skipped, so for
+        # repeated dispenses of the same volume, this is often just CLDINF and
+        # RUN. Clearing the infused volume first means the Dispense reads
+        # just this dispense's volume, for the ledger.
+        self.ledger.start(ml)
+        try:
+            with self.transaction() as t:
+                self.set_direction('INF', transaction=t)
+                # TODO is this actually ml?
+                self.set_vol(ml, transaction=t)
+                rate_idx = None
+                if 'rate' not in self._cache:
+                    rate_idx = t.add('RAT')
+                clear_idx = t.add('CLDINF')
+                self.start_program(transaction=t)
+        except (AL1000Error, AL1000Timeout) as err:
+            # The pump will still have processed RUN, even if one of the setup
+            # commands failed, and may have if a reply was lost.
+            replies = err.replies or []
+            self._abort_dispense(cleared=(len(replies) > clear_idx and
+                replies[clear_idx] == ''))
+            raise
 
-        self.start_program()
-        # could subtract delay in start_program for communication?
-        print('Waiting {:.1f} seconds for pump to finish... '.format(time_sec),
-            end='')
+        if rate_idx is not None:
+            ret = t.replies[rate_idx]
+            self._cache['rate'] = self._parse_rate(ret)
+            self._cache['units'] = ret[-2:]
+        # mL/min
+        rate = self._cache['rate']
+
+        if poll_interval_s is None:
+            poll_interval_s = self.poll_interval_s
+        handle = Dispense(self, ml, rate, poll_interval_s=poll_interval_s)
+        if not block:
+            return handle
+
+        print('Waiting {:.1f} seconds for pump to finish... '.format(
+            handle.expected_duration_s), end='')
         sys.stdout.flush()
-        time.sleep(time_sec)
+        handle.wait()
         print('done')
-        return True
+        return handle
 
 
-    def set_syringe(self, family='B-D', cc=60):
+    def set_syringe(self, family='B-D', cc=60, liquid=None, table=None):
         """
-        Taken from table in page 60 of AL-1000 manual.
-        At least for BD, values measured w/ calipers seem pretty close
-        (within about a percent at worst), and so are values reported in
-        Harvard Apparatus Syringe Selection Guide.
+        Diameters and rate limits from syringes.json (see syringes.py), from
+        the table in page 60 of AL-1000 manual. At least for BD, values
+        measured w/ calipers seem pretty close (within about a percent at
+        worst), and so are values reported in Harvard Apparatus Syringe
+        Selection Guide.
 
         family: manufacturer / part series
+        liquid: name of a liquid in syringes.json. If given, max_rate is also
+            limited to what the syringe can pump it at without slipping.
+        table: a syringes.SyringeTable. Defaults to loading syringes.json.
         """
-        # TODO conver to some pandas dataframe
-        # As in Aladdin manual, max_rate units are ml/hr and
-        # min_rate units are ul/hr
-        # TODO convert all to ml/min before using
-        # TODO probably some list_syringes fn or something
-        syringes = {
-            'B-D': {
-                60: {
-                    'diameter': 26.59,
-                    # TODO determine whether these are appropriate for paraffin
-                    # oil empirically. maybe some scalar to modify all max_rate
-                    # by like something ~ viscosity?
-                    'max_rate': 1699,
-                    'min_rate': 23.35
-                }
-            },
-            # mfg is HSW. diameter from www.restek.com/norm-ject-specs
-            'NORM-JECT': {
-                20: {
-                    'diameter': 20.05,
-                    # TODO determine these empirically
-                    # taken from values for other 20mL syringes in WPI manual
-                    'max_rate': 900,
-                    'min_rate': 12
-                }
-            }
-        }
-        if family not in syringes or cc not in syringes[family]:
-            raise ValueError('no data for this syringe. have:\n{}'.format(
-                [(f, list(v.keys())) for f, v in syringes.items()]))
-        
-        # TODO use that pdf -> table stuff to read both pdfs in -> use whole
-        # table?
+        if table is None:
+            table = syringes.SyringeTable.load()
+        syringe = table.find(family=family, cc=cc)
+        # (raises before anything is changed, if the limits aren't known)
+        min_rate, max_rate = table.rate_limits(syringe)
 
         self.capacity = cc
-        data = syringes[family][cc]
-        # mL/hr -> mL/min
-        self.max_rate = data['max_rate'] / 60.0
-        # uL/hr -> mL/min
-        self.min_rate = data['min_rate'] / (60 * 1000.0)
-        diam = data['diameter']
-        self.set_diam(diam, warn=False)
+        # (a syringe of another liquid is taken to be another syringe)
+        if self.ledger.syringe != [syringe.family, syringe.cc, liquid]:
+            if self.ledger.syringe is not None:
+                print('Syringe is not the one in the ledger ({}). Assuming '
+                    'it is full.'.format(self.ledger.syringe))
+            self.ledger.load(cc, syringe=[syringe.family, syringe.cc, liquid])
+        self.min_rate, self.max_rate = min_rate, max_rate
+        if liquid is not None:
+            self.max_rate = table.safe_max_rate(syringe, liquid)
+        diam = syringe.diameter_mm
         print('Considering syringe ID to be {}mm'.format(diam))
-        # TODO implement some kind of viscosity attribute which scales max rate
-        # have that settable indep (0.5 is a hardcoded version of this now)
-        rate = self.max_rate# * 0.2
-        # TODO actually find an appropriate formula for pfo, so i dont have to
-        # set it after
-        self.set_rate(rate, unit='MM')
+        rate = self.max_rate
+        # In one round-trip, and only what has changed.
+        with self.transaction() as t:
+            self.set_diam(diam, warn=False, transaction=t)
+            self.set_rate(rate, unit='MM', transaction=t)
         # To reflect actual sig figs on pump + verify correct setting.
         #rate = self.get_rate()
         #print('Using rate of {} mL/min'.format(rate))